@@ -12,6 +12,8 @@ class ConnectionEventTypes(IntEnum):
     SSH_DISCONNECTED = 5
     SSH_CONNECTION_ERROR = 6
 
+    NETWORK_RESUMED = 7
+
 
 @dataclass
 class ConnectionEvent:
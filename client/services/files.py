@@ -43,30 +43,76 @@ class FileSynchronizer(QObject):
         self.__toCheckLater = None
         self.__eventQueue = Queue()
         self.__localFilesCache = []
+        self.__unmatchedLocalFiles = {}
 
         self.__detectorProcess = Process(target=startDetector, args=(self.__eventQueue, self.__syncDir))
         self.__logger = logger.getChild("FileSynchronizer")
         self.__shouldRun = True
 
     def syncFileList(self, remoteFiles):
+        self.beginFileListSync()
+        self.mergeRemoteFilesPage(remoteFiles)
+        self.finishFileListSync()
+
+    def beginFileListSync(self):
         self.__toCheckLater = {}
 
         localFiles = self.__scanLocalFiles()
         self.__localFilesCache = [*localFiles]
-        mergedFileList = self.__mergeLocalFilesWithRemoteFiles(localFiles, remoteFiles)
+        self.__unmatchedLocalFiles = localFiles
 
-        debugMessage = '\n'.join([f'{key}: {value.status.name}' for key, value in mergedFileList.items()])
-        self.__logger.debug(f"Merged Filelist: {debugMessage}")
+    def mergeRemoteFilesPage(self, remoteFiles):
+        for remoteFile in remoteFiles:
+            self.__publishMergedFile(self.__mergeRemoteFile(remoteFile))
+
+    def finishFileListSync(self):
+        # Whatever was not listed by the server only exists locally.
+        for _, fileData in self.__unmatchedLocalFiles.items():
+            self.__publishMergedFile(fileData)
+        self.__unmatchedLocalFiles = {}
+
+    def applyRemoteChanges(self, addedFiles, removedFiles, modifiedFiles):
+        for remoteFile in [*addedFiles, *modifiedFiles]:
+            localFile = self.__findLocalFile(remoteFile.fullPath)
+            if localFile is None or remoteFile.modified > localFile.modified:
+                remoteFile.status = FileStatuses.DOWNLOADING_FROM_CLOUD
+                self.__publishMergedFile(remoteFile)
+        for removedFile in removedFiles:
+            localFile = self.__findLocalFile(removedFile.fullPath)
+            if localFile and localFile.modified <= removedFile.modified:
+                # The detector picks up the removal and updates the UI.
+                self.__moveToTrash(removedFile.fullPath)
+
+    def __moveToTrash(self, fullPath):
+        # Remotely deleted files are not deleted locally, only moved next to the sync directory, so a wrongly reported
+        # removal can't cost the only copy of a file. The trash is outside of the sync directory, so it is not synced
+        # and the move is seen as a deletion.
+        syncDir = self.__syncDir.rstrip("/")
+        trashPath = os.path.join(os.path.dirname(syncDir), f".{os.path.basename(syncDir)}.trash", fullPath)
+        if os.path.exists(trashPath):
+            trashPath = f"{trashPath}.{int(time.time())}"
+        self.__logger.debug(f"Moving remotely deleted file to the trash: {fullPath}")
+        os.makedirs(os.path.dirname(trashPath), exist_ok=True)
+        shutil.move(f"{self.__syncDir}/{fullPath}", trashPath)
+
+    def __findLocalFile(self, path):
+        if path not in self.__localFilesCache:
+            return None
+        try:
+            return self.__createFileDataFromPath(path)
+        except FileNotFoundError:
+            return None
 
-        for _, fileData in mergedFileList.items():
-            # Created, so the UI makes a new entry
-            event = FileStatusEvent(eventType=FileEventTypes.CREATED, status=fileData.status, sourcePath=fileData.fullPath)
+    def __publishMergedFile(self, fileData):
+        self.__logger.debug(f"Merged file: {fileData.fullPath}: {fileData.status.name}")
+        # Created, so the UI makes a new entry
+        event = FileStatusEvent(eventType=FileEventTypes.CREATED, status=fileData.status, sourcePath=fileData.fullPath)
 
-            self.fileStatusChannel.emit(event)
-            if fileData.status != FileStatuses.SYNCED:
-                uuid = uuid4().hex
-                task = FileTask(uuid, fileData.status, fileData)
-                self.fileTaskChannel.emit(task)
+        self.fileStatusChannel.emit(event)
+        if fileData.status != FileStatuses.SYNCED:
+            uuid = uuid4().hex
+            task = FileTask(uuid, fileData.status, fileData)
+            self.fileTaskChannel.emit(task)
 
     def setSyncDir(self, syncDir):
         self.__syncDir = syncDir
@@ -133,26 +179,24 @@ class FileSynchronizer(QObject):
         self.__logger.debug(f"Emitting event {event}")
         self.fileStatusChannel.emit(event)
 
-    def __mergeLocalFilesWithRemoteFiles(self, localFiles, remoteFiles):
-        mergedFiles = localFiles
-        for remoteFile in remoteFiles:
-            if remoteFile.fullPath not in mergedFiles:
-                # Only Exists On Remote
-                remoteFile.status = FileStatuses.DOWNLOADING_FROM_CLOUD
-                mergedFiles[remoteFile.fullPath] = remoteFile
-            else:
-                # Exists on both.
-                if remoteFile.modified > mergedFiles[remoteFile.fullPath].modified:
-                    # Remote is newer.
-                    mergedFiles[remoteFile.fullPath].modified = remoteFile.modified
-                    mergedFiles[remoteFile.fullPath].status = FileStatuses.DOWNLOADING_FROM_CLOUD
-                elif remoteFile.modified < mergedFiles[remoteFile.fullPath].modified:
-                    # Local is newer.
-                    mergedFiles[remoteFile.fullPath].status = FileStatuses.UPLOADING_FROM_LOCAL
-                else:
-                    # Synced
-                    mergedFiles[remoteFile.fullPath].status = FileStatuses.SYNCED
-        return mergedFiles
+    def __mergeRemoteFile(self, remoteFile):
+        localFile = self.__unmatchedLocalFiles.pop(remoteFile.fullPath, None)
+        if localFile is None:
+            # Only Exists On Remote
+            remoteFile.status = FileStatuses.DOWNLOADING_FROM_CLOUD
+            return remoteFile
+        # Exists on both.
+        if remoteFile.modified > localFile.modified:
+            # Remote is newer.
+            localFile.modified = remoteFile.modified
+            localFile.status = FileStatuses.DOWNLOADING_FROM_CLOUD
+        elif remoteFile.modified < localFile.modified:
+            # Local is newer.
+            localFile.status = FileStatuses.UPLOADING_FROM_LOCAL
+        else:
+            # Synced
+            localFile.status = FileStatuses.SYNCED
+        return localFile
 
     def __scanLocalFiles(self):
         return {data.fullPath: data for data in self.__scantree(self.__syncDir)}
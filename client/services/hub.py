@@ -20,6 +20,7 @@ class ServiceHub(QObject):
     __instance = None
 
     filesChannel = pyqtSignal(object)
+    fileStatusBatchChannel = pyqtSignal(list)
     networkStatusChannel = pyqtSignal(object)
     sshStatusChannel = pyqtSignal(object)
     errorChannel = pyqtSignal(object)
@@ -54,6 +55,8 @@ class ServiceHub(QObject):
             self.__sshTaskQueu = None
 
             self.__fileTaskArchive = TaskArchive()
+            # Streamed downloads waiting for their data, by uuid, with the path of their file.
+            self.__streamedDownloads = {}
 
     def __shutDownThreadedService(self, service, serviceThread):
         service.stop()
@@ -65,6 +68,9 @@ class ServiceHub(QObject):
         self.__networkService = NetworkClient(self.__networkQueue)
         self.__networkService.messageArrived.connect(self.__onNetworkMessageArrived)
         self.__networkService.connectionStatusChanged.connect(self.__onNetworkConnectionEvent)
+        self.__networkService.uploadStreamFinished.connect(self.__onUploadStreamFinished)
+        self.__networkService.downloadStreamAborted.connect(self.__onDownloadStreamAborted)
+        self.__networkService.requestRejected.connect(self.__onRequestRejected)
         self.__networkThread = Thread(target=self.__networkService.run)
 
     def initFileSyncService(self):
@@ -168,6 +174,12 @@ class ServiceHub(QObject):
             self.__messageArchive[message.header.uuid] = callBack
         self.__networkQueue.put(message)
 
+    def getNetworkRoundTripTime(self):
+        return self.__networkService.roundTripTime.value if self.__networkService else None
+
+    def isFileDataStreamed(self):
+        return self.__networkService is not None and self.__networkService.fileDataStreaming
+
     def isNetworkServiceRunning(self):
         return self.__isNetworkServiceRunning
 
@@ -187,18 +199,33 @@ class ServiceHub(QObject):
     def syncRemoteAndLocalFiles(self, remoteFiles):
         self.__fileSyncService.syncFileList(remoteFiles)
 
+    def beginRemoteAndLocalFileSync(self):
+        self.__fileSyncService.beginFileListSync()
+
+    def syncRemoteFilesPage(self, remoteFiles):
+        self.__fileSyncService.mergeRemoteFilesPage(remoteFiles)
+
+    def finishRemoteAndLocalFileSync(self):
+        self.__fileSyncService.finishFileListSync()
+
     def enqueuSSHTask(self, task):
         self.__sshTaskQueu.put(task)
 
     def __onNetworkMessageArrived(self, message):
         if message.header.messageType == MessageTypes.FILE_STATUS_UPDATE:
-            message.data = FileData(**message.data)
-            statusChangeEvent = FileStatusEvent(FileEventTypes.STATUS_CHANGED, message.data.fullPath, message.data.status)
-            self.filesChannel.emit(statusChangeEvent)
-            if message.data.status == FileStatuses.DOWNLOADING_TO_LOCAL:
-                task = FileTask(message.header.uuid, FileStatuses.DOWNLOADING_TO_LOCAL, message.data)
-                self.__fileTaskArchive.addTask(message.data.fullPath, task)
-                self.enqueuSSHTask(task)
+            self.filesChannel.emit(self.__applyFileStatusUpdate(message.header.uuid, message.data))
+        elif message.header.messageType == MessageTypes.FILE_STATUS_UPDATE_BATCH:
+            events = [self.__applyFileStatusUpdate(update["uuid"], update["data"]) for update in message.data["updates"]]
+            self.fileStatusBatchChannel.emit(events)
+        elif message.header.messageType == MessageTypes.REMOTE_FILES_CHANGED:
+            self.__fileSyncService.applyRemoteChanges(
+                [FileData(**raw) for raw in message.data["added"]],
+                [FileData(**raw) for raw in message.data["removed"]],
+                [FileData(**raw) for raw in message.data["modified"]]
+            )
+        elif message.header.messageType == MessageTypes.PARTIAL_RESPONSE and message.header.uuid in self.__messageArchive:
+            # The callback stays registered until the final RESPONSE arrives.
+            self.__messageArchive[message.header.uuid](message.data)
         elif message.header.uuid in self.__messageArchive:
             self.__logger.debug(f"Response: {message.header} {message.data}")
             callBack = self.__messageArchive[message.header.uuid]
@@ -207,33 +234,80 @@ class ServiceHub(QObject):
         else:
             self.__logger.info(f"Unknown message: {message.header} {message.data}")
 
+    def __applyFileStatusUpdate(self, uuid, rawFileData):
+        fileData = FileData(**rawFileData)
+        if fileData.status == FileStatuses.DOWNLOADING_TO_LOCAL:
+            task = FileTask(uuid, FileStatuses.DOWNLOADING_TO_LOCAL, fileData)
+            if uuid in self.__streamedDownloads:
+                # The data already arrived over the network connection.
+                del self.__streamedDownloads[uuid]
+                self.__fileSyncService.finalizeDownload(task)
+            else:
+                self.__fileTaskArchive.addTask(fileData.fullPath, task)
+                self.enqueuSSHTask(task)
+
+        return FileStatusEvent(FileEventTypes.STATUS_CHANGED, fileData.fullPath, fileData.status)
+
     def __onNewFileTask(self, task):
         self.__logger.debug(f"New filetask: {task}")
         if task.taskType == FileStatuses.UPLOADING_FROM_LOCAL:
+            self.__discardStreamedDownloads(task.subject.fullPath)
             self.__fileTaskArchive.cancelTask(task.subject.fullPath)
             self.__fileTaskArchive.addTask(task.subject.fullPath, task)
 
             data = {"fullPath": task.subject.fullPath}
             message = NetworkMessage.Builder(MessageTypes.FILE_TASK_CANCELLED).withData(data).withUUID(task.uuid).build()
             self.sendNetworkMessage(message)
-            self.enqueuSSHTask(task)
+            if self.isFileDataStreamed():
+                self.__networkService.streamUpload(task)
+                self.sendNetworkMessage(self.__createUploadMessage(task, streamed=True))
+            else:
+                self.enqueuSSHTask(task)
         elif task.taskType == FileStatuses.DOWNLOADING_FROM_CLOUD:
             data = task.subject.serialize()
+            if self.isFileDataStreamed():
+                data["streamed"] = True
+                # A new download of the path supersedes the ones before it on the server.
+                self.__discardStreamedDownloads(task.subject.fullPath)
+                self.__streamedDownloads[task.uuid] = task.subject.fullPath
             message = NetworkMessage.Builder(MessageTypes.DOWNLOAD_FILE).withData(data).withUUID(task.uuid).build()
             self.sendNetworkMessage(message)
         elif task.taskType == FileStatuses.DELETED:
+            self.__discardStreamedDownloads(task.subject)
             self.__fileTaskArchive.cancelTask(task.subject)
             self.__fileTaskArchive.removeTask(task.subject)
             data = {"fullPath": task.subject}
             message = NetworkMessage.Builder(MessageTypes.DELETE_FILE).withData(data).withUUID(task.uuid).build()
             self.sendNetworkMessage(message)
         elif task.taskType == FileStatuses.MOVING:
+            self.__discardStreamedDownloads(task.subject["sourcePath"])
             self.__fileTaskArchive.cancelTask(task.subject["sourcePath"])
             self.__fileTaskArchive.cancelTask(task.subject["target"].fullPath)
             data = {"source": task.subject["sourcePath"], "target": task.subject["target"].serialize()}
             message = NetworkMessage.Builder(MessageTypes.MOVE_FILE).withData(data).withUUID(task.uuid).build()
             self.sendNetworkMessage(message, task.subject["moveResultCallBack"])
 
+    def __discardStreamedDownloads(self, fullPath):
+        # Cancelled downloads may never send their data, so they are not waited for.
+        self.__streamedDownloads = {uuid: path for uuid, path in self.__streamedDownloads.items() if path != fullPath}
+
+    def __onDownloadStreamAborted(self, uuid):
+        self.__streamedDownloads.pop(uuid, None)
+
+    def __onRequestRejected(self, message, error):
+        # The server never answers a rejected request, so its task is failed here instead of waiting for it forever.
+        callBack = self.__messageArchive.pop(message.header.uuid, None)
+        if message.header.messageType == MessageTypes.MOVE_FILE:
+            # Like after a failed move, the file is uploaded again to its new path.
+            if callBack:
+                callBack({"moveSuccessful": False, "from": message.data["source"], "to": message.data["target"]["fullPath"]})
+        elif message.header.messageType in [MessageTypes.UPLOAD_FILE, MessageTypes.DOWNLOAD_FILE]:
+            self.__streamedDownloads.pop(message.header.uuid, None)
+            task = self.__fileTaskArchive.getTask(message.data["fullPath"])
+            if task and task.uuid == message.header.uuid:
+                self.__fileTaskArchive.removeTask(message.data["fullPath"])
+        self.errorChannel.emit(f"The server rejected the {message.header.messageType.name} request: {error}")
+
     def __onNetworkConnectionEvent(self, event):
         self.networkStatusChannel.emit(event)
 
@@ -244,10 +318,7 @@ class ServiceHub(QObject):
         if not task.stale:
             if task.taskType == FileStatuses.UPLOADING_FROM_LOCAL:
                 event = FileStatusEvent(FileEventTypes.STATUS_CHANGED, task.subject.fullPath, FileStatuses.UPLOADING_TO_CLOUD)
-                localTime = time.localtime()
-                dstActive = True if localTime.tm_isdst == 1 else False
-                data = {"filename": task.subject.filename, "utcModified": task.subject.modified, "userTimezone": time.strftime("%z", localTime), "dstActive": dstActive, "path": task.subject.path, "size": task.subject.size, "fullPath": task.subject.fullPath}
-                message = NetworkMessage.Builder(MessageTypes.UPLOAD_FILE).withData(data).withUUID(task.uuid).build()
+                message = self.__createUploadMessage(task)
 
                 self.__fileTaskArchive.removeTask(task.subject.fullPath)
                 self.sendNetworkMessage(message)
@@ -258,5 +329,20 @@ class ServiceHub(QObject):
             else:
                 raise Exception(f"Unknown tasktype received from sshService: {task.taskType}")
 
+    def __onUploadStreamFinished(self, task):
+        if not task.stale:
+            if self.__fileTaskArchive.getTask(task.subject.fullPath) is task:
+                self.__fileTaskArchive.removeTask(task.subject.fullPath)
+            self.filesChannel.emit(FileStatusEvent(FileEventTypes.STATUS_CHANGED, task.subject.fullPath, FileStatuses.UPLOADING_TO_CLOUD))
+
+    def __createUploadMessage(self, task, streamed=False):
+        localTime = time.localtime()
+        dstActive = True if localTime.tm_isdst == 1 else False
+        data = {"filename": task.subject.filename, "utcModified": task.subject.modified, "userTimezone": time.strftime("%z", localTime), "dstActive": dstActive, "path": task.subject.path, "size": task.subject.size, "fullPath": task.subject.fullPath}
+        if streamed:
+            data["streamed"] = True
+
+        return NetworkMessage.Builder(MessageTypes.UPLOAD_FILE).withData(data).withUUID(task.uuid).build()
+
     def __onLocalFileStatusChanged(self, event):
         self.filesChannel.emit(event)
@@ -12,40 +12,117 @@ from uuid import uuid4
 from queue import Queue, Empty
 
 import paramiko
+import msgpack
 from Crypto.Cipher import AES
-from msgpack import Packer, Unpacker
 from PyQt5.QtCore import QObject, QSettings, pyqtSignal
 
 from model.file import FileStatuses
 from model.task import FileTask
 from model.networkevents import ConnectionEventTypes, ConnectionEvent
-from model.message import NetworkMessage, MessageTypes
+from model.message import NetworkMessage, MessageTypes, MessageCodec, MessageEncodings, MessageChannels
 from model.permission import WorkspacePermissionValidator
 
+from .transport import FrameReader, FrameWriter, FrameMultiplexer, FrameFormatError, FrameCompressor, SocketOptions, KeepaliveOptions, RoundTripTimeEstimator, SUPPORTED_COMPRESSIONS, MAX_FRAME_SIZE, HANDSHAKE_MAX_FRAME_SIZE
+
 
 logger = logging.getLogger(__name__)
 
 
+class FileUploadStream():
+    # Reads a local file into FILE_DATA messages, never more than a window ahead of the server's acknowledgements.
+    # Kept until the server closes its end, so the data can be sent again from where it stopped after a resume.
+
+    def __init__(self, task, chunkSize, window):
+        self.task = task
+        self.finished = False
+        self.finishReported = False
+        self.__chunkSize = chunkSize
+        self.__window = window
+        self.__handle = None
+        self.__sent = 0
+        self.__acknowledged = None
+
+    def acknowledge(self, offset, resumeFrom=None):
+        # The first acknowledgement arrives once the server is ready to take the data.
+        if self.__handle is None:
+            self.__handle = open(f"{QSettings().value('syncDir/path')}/{self.task.subject.fullPath}", "rb")
+        if resumeFrom is not None:
+            self.__handle.seek(resumeFrom)
+            self.__sent = resumeFrom
+            self.finished = False
+            self.__acknowledged = offset
+        else:
+            self.__acknowledged = max(self.__acknowledged or 0, offset)
+
+    def pause(self):
+        # Waits for the acknowledgement telling where the server wants the data to continue from.
+        self.__acknowledged = None
+
+    def canSend(self):
+        return self.__handle is not None and self.__acknowledged is not None and not self.finished and self.__sent - self.__acknowledged < self.__window
+
+    def nextMessage(self):
+        data = self.__handle.read(self.__chunkSize)
+        self.finished = len(data) < self.__chunkSize
+        message = NetworkMessage.Builder(MessageTypes.FILE_DATA).withUUID(self.task.uuid).withData({"offset": self.__sent, "data": data, "last": self.finished}).build()
+        self.__sent += len(data)
+
+        return message
+
+    def close(self):
+        if self.__handle:
+            self.__handle.close()
+            self.__handle = None
+
+
 class NetworkClient(QObject):
     messageArrived = pyqtSignal(NetworkMessage)
     connectionStatusChanged = pyqtSignal(ConnectionEvent)
+    uploadStreamFinished = pyqtSignal(FileTask)
+    downloadStreamAborted = pyqtSignal(str)
+    requestRejected = pyqtSignal(NetworkMessage, str)
+
+    _BATCHABLE_MESSAGE_TYPES = [
+        MessageTypes.UPLOAD_FILE, MessageTypes.DOWNLOAD_FILE,
+        MessageTypes.MOVE_FILE, MessageTypes.DELETE_FILE,
+        MessageTypes.FILE_TASK_CANCELLED
+    ]
+    # Queued messages are only framed while less than this many bytes wait to be sent.
+    _OUTPUT_HIGH_WATER_MARK = 1 << 16
+    # Seconds between attempts to reconnect and resume the session, doubled after every failed attempt.
+    _RECONNECT_DELAY = 1.0
+    _MAX_RECONNECT_DELAY = 16.0
 
     def __init__(self, outgoing_queue):
         super().__init__()
-        self._CHUNK_SIZE = 2048
         self._outgoing_queue = outgoing_queue
         self._hostInfo = None
         self._shouldRun = True
         self._logger = logger.getChild("NetworkClient")
 
         self._key = None
-        self._encoder = None
-        self._decoder = None
 
         self._socket = None
         self._isConnected = False
-
-        self._packer, self._unpacker = Packer(), Unpacker()
+        self._isSessionSetUp = False
+
+        self._codec = None
+        self._maxBatchSize = 0
+        # The messages of the batches waiting for their results, by batch uuid and message uuid.
+        self._pendingBatches = {}
+        self._keepaliveOptions = None
+        self._lastReceived = 0.0
+        self._lastPingSent = 0.0
+        self.roundTripTime = RoundTripTimeEstimator()
+        self._frameReader, self._frameWriter = None, None
+        self._multiplexer = None
+        self.fileDataStreaming = False
+        self._dataChunkSize, self._dataWindow = None, None
+        self._uploadStreams = {}
+        self._downloadStreams = {}
+        self._sessionToken = None
+        self._resumeToken = None
+        self._resumeGracePeriod = 0.0
         self._input, self._output, self._error = [], [], []
 
     def run(self):
@@ -56,19 +133,62 @@ class NetworkClient(QObject):
                     self._handleIncomingMessage(readable)
                     self._handleOutgoingMessage(writable)
                     self._handleErroneousSocket(in_error)
-                except ConnectionError as e:
+                    self._checkKeepalive()
+                except (ConnectionError, FrameFormatError) as e:
                     self._logger.error(f"Server disconnected: {e}")
-                    self.connectionStatusChanged.emit(ConnectionEvent(ConnectionEventTypes.NETWORK_DISCONNECTED, {"message": str(e)}))
                     self._handleErroneousSocket([self._socket])
+                    if not self._tryResume():
+                        self._closeFileStreams()
+                        self.connectionStatusChanged.emit(ConnectionEvent(ConnectionEventTypes.NETWORK_DISCONNECTED, {"message": str(e)}))
             else:
                 time.sleep(0.02)
         if self._isConnected:
             self.disconnect()
+        self._closeFileStreams()
 
-    def connect(self):
+    def connect(self, resume=False):
+        # A resumed session keeps its file streams, pending batches and the messages that were not sent yet.
+        unsentMessages = self._multiplexer.takePendingMessages() if resume and self._multiplexer else []
         self._socket = self._createNewSocket()
+        # Frames stay small until the server proved it knows the key.
+        self._frameReader, self._frameWriter = FrameReader(maxFrameSize=HANDSHAKE_MAX_FRAME_SIZE), FrameWriter()
+        self._codec = MessageCodec()
+        self._multiplexer = FrameMultiplexer(self._codec.encode, len(MessageChannels))
+        self._maxBatchSize = 0
+        self._keepaliveOptions = None
+        self.roundTripTime = RoundTripTimeEstimator()
+        self.fileDataStreaming = False
+        if not resume:
+            self._pendingBatches = {}
+            self._closeFileStreams()
+        self._resumeToken = self._sessionToken if resume else None
+        self._isSessionSetUp = False
         self._setupConnection()
         self._setupSession()
+        for message in unsentMessages:
+            if message.channel != MessageChannels.CONTROL:
+                self._multiplexer.enqueue(message.channel, message)
+
+    def _tryResume(self):
+        if not self._sessionToken or self._resumeGracePeriod <= 0:
+            return False
+        deadline = time.monotonic() + self._resumeGracePeriod
+        delay = self._RECONNECT_DELAY
+        while self._shouldRun and time.monotonic() + delay < deadline:
+            time.sleep(delay)
+            try:
+                self._logger.info("Reconnecting to resume the session...")
+                self.connect(resume=True)
+                if self._isConnected:
+                    return True
+            except OSError as e:
+                self._logger.info(f"Reconnecting failed: {e}")
+            delay = min(delay * 2, self._MAX_RECONNECT_DELAY)
+        return False
+
+    def streamUpload(self, task):
+        # The data is only sent once the server has acknowledged the stream, so the UPLOAD_FILE message is already there.
+        self._uploadStreams[task.uuid] = FileUploadStream(task, self._dataChunkSize, self._dataWindow)
 
     def setNetworkInformation(self, address, port, aesKey):
         self._hostInfo = (address, port)
@@ -81,25 +201,122 @@ class NetworkClient(QObject):
 
     def _setupSession(self):
         self._logger.debug("Starting handshake...")
-        handShakeDone = False
-
-        while not handShakeDone:
-            data = self._socket.recv(1024)
-            if data:
-                self._unpacker.feed(data)
-                for sessionMessage in self._unpacker:
-                    handShakeDone = True
-                    self._processSessionMessage(sessionMessage)
+
+        while not self._isSessionSetUp:
+            if self._frameReader.readFrom(self._socket) > 0:
+                self._processFrames()
+                if self._socket.fileno() < 0:
+                    # Handshake was rejected and the connection got closed.
+                    break
             else:
                 self.disconnect()
+                break
+
+    def _processFrames(self):
+        self._lastReceived = time.monotonic()
+        for flags, payload in self._frameReader.frames():
+            if not self._isSessionSetUp:
+                self._processSessionMessage(msgpack.unpackb(payload))
+                if not self._isSessionSetUp:
+                    break
+            else:
+                message = self._codec.decode(payload)
+                if message.header.messageType == MessageTypes.PING:
+                    self._sendImmediately(NetworkMessage.Builder(MessageTypes.PONG).withData(message.data).build())
+                elif message.header.messageType == MessageTypes.PONG:
+                    self.roundTripTime.addSample(time.monotonic() - message.data["timestamp"])
+                    self._logger.debug(f"Round trip time: {self.roundTripTime.lastSample * 1000:.1f} ms (smoothed: {self.roundTripTime.value * 1000:.1f} ms)")
+                elif message.header.messageType == MessageTypes.FILE_DATA:
+                    self._processFileData(message)
+                elif message.header.messageType == MessageTypes.FILE_DATA_ACK:
+                    self._processFileDataAcknowledgement(message)
+                elif message.header.messageType == MessageTypes.SESSION_RESUMED:
+                    self._processSessionResumed(message)
+                elif message.header.messageType == MessageTypes.RESPONSE and message.header.uuid in self._pendingBatches:
+                    self._processBatchResults(message)
+                else:
+                    self.messageArrived.emit(message)
+
+    def _processFileData(self, message):
+        # Downloaded data goes to the same hidden file the SFTP download would create.
+        uuid, offset = message.header.uuid, message.data["offset"]
+        handle = self._downloadStreams.get(uuid, None)
+        if handle is None and offset == 0:
+            handle = self._downloadStreams[uuid] = open(self._getDownloadPath(uuid), "wb")
+        if handle is None or offset != handle.tell():
+            # Data sent before a resume that is already written, or that is sent again once the server got our offset.
+            self._logger.debug(f"Skipping data of {uuid} at offset {offset}")
+            return
+        handle.write(message.data["data"])
+        acknowledgement = {"offset": handle.tell()}
+        if message.data["last"]:
+            handle.close()
+            del self._downloadStreams[uuid]
+            if message.data.get("aborted", False):
+                os.remove(self._getDownloadPath(uuid))
+                self.downloadStreamAborted.emit(uuid)
+                return
+            acknowledgement["complete"] = True
+        self._sendFileDataAcknowledgement(uuid, acknowledgement)
+
+    def _sendFileDataAcknowledgement(self, uuid, data):
+        acknowledgement = NetworkMessage.Builder(MessageTypes.FILE_DATA_ACK).withUUID(uuid).withData(data).build()
+        self._multiplexer.enqueue(acknowledgement.channel, acknowledgement)
+
+    def _processFileDataAcknowledgement(self, message):
+        uploadStream = self._uploadStreams.get(message.header.uuid, None)
+        if uploadStream and message.data.get("closed", False):
+            uploadStream.close()
+            del self._uploadStreams[message.header.uuid]
+        elif uploadStream:
+            try:
+                uploadStream.acknowledge(message.data["offset"], message.data.get("resumeFrom", None))
+            except OSError as e:
+                self._logger.error(f"Can't stream {uploadStream.task.subject.fullPath}: {e}")
+                uploadStream.close()
+                del self._uploadStreams[message.header.uuid]
+
+    def _processSessionResumed(self, message):
+        if message.data["resumed"]:
+            self._sessionToken = message.data["sessionToken"]
+            # The server continues the downloads from what is written, and tells where to continue the uploads from.
+            for uuid, handle in self._downloadStreams.items():
+                self._sendFileDataAcknowledgement(uuid, {"offset": handle.tell(), "resume": True})
+            for uploadStream in self._uploadStreams.values():
+                uploadStream.pause()
+            self._logger.info(f"Session resumed, {message.data['replayed']} missed messages replayed, {message.data['dropped']} dropped.")
+            self.connectionStatusChanged.emit(ConnectionEvent(ConnectionEventTypes.NETWORK_RESUMED, message.data))
+        else:
+            self._logger.error("The server could not resume the session.")
+            self._closeFileStreams()
+            self._pendingBatches = {}
+            self.connectionStatusChanged.emit(ConnectionEvent(ConnectionEventTypes.NETWORK_DISCONNECTED, {"message": "The session could not be resumed."}))
+
+    def _getDownloadPath(self, uuid):
+        return f"{QSettings().value('syncDir/path')}/.{uuid}"
+
+    def _processBatchResults(self, message):
+        # Rejected requests are never answered, so whoever waits for them is told instead.
+        batchedMessages = self._pendingBatches.pop(message.header.uuid, {})
+        for result in message.data["results"]:
+            if not result["accepted"]:
+                self._logger.error(f"Server rejected request {result['uuid']}: {result['error']}")
+                if result["uuid"] in batchedMessages:
+                    self.requestRejected.emit(batchedMessages[result["uuid"]], result["error"])
 
     def _processSessionMessage(self, sessionMessage):
-        self._encoder = AES.new(self._key, mode=AES.MODE_CFB, iv=sessionMessage['iv'])
-        self._decoder = AES.new(self._key, mode=AES.MODE_CFB, iv=sessionMessage['iv'])
-        decoded = self._decoder.decrypt(sessionMessage['encodeTest'])
+        encoder = AES.new(self._key, mode=AES.MODE_CFB, iv=sessionMessage['iv'])
+        decoder = AES.new(self._key, mode=AES.MODE_CFB, iv=sessionMessage['iv'])
+        decoded = decoder.decrypt(sessionMessage['encodeTest'])
 
         if decoded == sessionMessage['iv']:
-            self.connectionStatusChanged.emit(ConnectionEvent(ConnectionEventTypes.NETWORK_HANDSHAKE_SUCCESSFUL, None))
+            self._frameWriter.setEncoder(encoder)
+            self._frameReader.setDecoder(decoder)
+            self._frameReader.setMaxFrameSize(MAX_FRAME_SIZE)
+            self._negotiateSessionOptions(sessionMessage)
+            self._isSessionSetUp = True
+            if not self._resumeToken:
+                self.connectionStatusChanged.emit(ConnectionEvent(ConnectionEventTypes.NETWORK_HANDSHAKE_SUCCESSFUL, None))
             self._logger.debug("Successfully set up session!")
             self._isConnected = True
         else:
@@ -108,45 +325,184 @@ class NetworkClient(QObject):
             self.connectionStatusChanged.emit(ConnectionEvent(ConnectionEventTypes.NETWORK_CONNECTION_ERROR, {"message": "Wrong AES key!"}))
             self.disconnect()
 
+    def _negotiateSessionOptions(self, sessionMessage):
+        # Servers that predate these options do not advertise them, and keep using the legacy defaults.
+        options = {}
+        compression = self._selectCompression(sessionMessage.get("compression", []))
+        if compression:
+            options["compression"] = compression
+        if MessageEncodings.COMPACT in sessionMessage.get("encodings", []):
+            options["encoding"] = MessageEncodings.COMPACT
+        if "keepaliveInterval" in sessionMessage:
+            options["keepalive"] = True
+            self._keepaliveOptions = self._createKeepaliveOptions()
+        if "fragmentSize" in sessionMessage:
+            options["multiplexing"] = True
+        if "dataWindow" in sessionMessage and QSettings().value("network/streamFileData", True, type=bool):
+            self.fileDataStreaming = True
+            self._dataChunkSize, self._dataWindow = sessionMessage["dataChunkSize"], sessionMessage["dataWindow"]
+            self._logger.debug("File data is streamed over the session")
+        if "sessionToken" in sessionMessage:
+            options["resumable"] = True
+            if self._resumeToken:
+                options["resume"] = self._resumeToken
+            self._sessionToken = sessionMessage["sessionToken"]
+            self._resumeGracePeriod = sessionMessage["resumeGracePeriod"]
+
+        if options:
+            self._sendImmediately(NetworkMessage.Builder(MessageTypes.SESSION_OPTIONS).withData(options).build())
+        if compression:
+            self._frameWriter.setCompressor(FrameCompressor(compression, sessionMessage.get("compressionThreshold", 0)))
+            self._logger.debug(f"Using {compression} compression")
+        if "encoding" in options:
+            self._codec.encoding = MessageEncodings.COMPACT
+            self._logger.debug("Using compact message encoding")
+        if "multiplexing" in options:
+            self._multiplexer.setFragmentSize(sessionMessage["fragmentSize"])
+            self._logger.debug(f"Splitting messages into fragments of {sessionMessage['fragmentSize']} bytes")
+        self._maxBatchSize = sessionMessage.get("maxBatchSize", 0)
+
+    def _createKeepaliveOptions(self):
+        settings = QSettings()
+        defaults = KeepaliveOptions()
+
+        return KeepaliveOptions(
+            interval=settings.value("network/keepaliveInterval", defaults.interval, type=float),
+            timeout=settings.value("network/keepaliveTimeout", defaults.timeout, type=float)
+        )
+
+    def _checkKeepalive(self):
+        if not self._keepaliveOptions or not self._isConnected:
+            return
+        now = time.monotonic()
+        idleTime = now - self._lastReceived
+        if idleTime > self._keepaliveOptions.timeout:
+            raise ConnectionError(f"No data from the server for {idleTime:.1f} seconds")
+        elif idleTime >= self._keepaliveOptions.interval and now - self._lastPingSent >= self._keepaliveOptions.interval:
+            self._lastPingSent = now
+            self._sendImmediately(NetworkMessage.Builder(MessageTypes.PING).withData({"timestamp": now}).build())
+
+    def _sendImmediately(self, message):
+        self._frameWriter.writeFrame(self._codec.encode(message))
+        while self._frameWriter.sendTo(self._socket) > 0:
+            pass
+
+    def _selectCompression(self, offered):
+        if not QSettings().value("network/compression", True, type=bool):
+            return None
+        return next((algorithm for algorithm in SUPPORTED_COMPRESSIONS if algorithm in offered), None)
+
     def _createNewSocket(self):
         sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._createSocketOptions().apply(sock)
 
         return sock
 
+    def _createSocketOptions(self):
+        settings = QSettings()
+        sendBufferSize = settings.value("network/sendBufferSize", None)
+        receiveBufferSize = settings.value("network/receiveBufferSize", None)
+
+        return SocketOptions(
+            sendBufferSize=int(sendBufferSize) if sendBufferSize else None,
+            receiveBufferSize=int(receiveBufferSize) if receiveBufferSize else None,
+            noDelay=settings.value("network/tcpNoDelay", True, type=bool)
+        )
+
     def _connect(self):
         self._logger.debug("Connecting to server")
         self._socket.connect(self._hostInfo)
         self._logger.debug("Connected")
-        self.connectionStatusChanged.emit(ConnectionEvent(ConnectionEventTypes.NETWORK_CONNECTED, None))
+        if not self._resumeToken:
+            self.connectionStatusChanged.emit(ConnectionEvent(ConnectionEventTypes.NETWORK_CONNECTED, None))
 
     def _handleIncomingMessage(self, readable):
         for s in readable:
-            data = s.recv(self._CHUNK_SIZE)
-            if data:
-                decrypted = self._decoder.decrypt(data)
-                self._unpacker.feed(decrypted)
-                for message in self._unpacker:
-                    msg_obj = NetworkMessage(message)
-                    self.messageArrived.emit(msg_obj)
+            if self._frameReader.readFrom(s) > 0:
+                self._processFrames()
             else:
-                self._logger.info("Lost connection to the server!")
-                self.disconnect()
-                disconnectionEvent = ConnectionEvent(ConnectionEventTypes.NETWORK_DISCONNECTED, None)
-                self.connectionStatusChanged.emit(disconnectionEvent)
+                raise ConnectionError("Lost connection to the server!")
 
     def _handleOutgoingMessage(self, writable):
         for s in writable:
-            try:
-                msg_obj = self._outgoing_queue.get_nowait()
-                serialized = self._packer.pack(msg_obj.raw)
-                encrypted = self._encoder.encrypt(serialized)
-                if self._shouldRun:
-                    s.sendall(encrypted)
-                    self._logger.debug(f"Message sent. ({msg_obj.header.messageType.name})")
+            messageCount = self._collectOutgoingMessages()
+            self._collectFileData()
+            if not self._multiplexer.hasPendingData():
+                time.sleep(0.02)
+                continue
+            # Only a slice of the pending data is sent per round, so newly queued high priority messages can get ahead of it.
+            self._multiplexer.fill(self._frameWriter, self._OUTPUT_HIGH_WATER_MARK)
+            if self._shouldRun:
+                while self._frameWriter.sendTo(s) > 0:
+                    pass
+                if messageCount:
+                    self._logger.debug(f"{messageCount} message(s) queued for sending.")
+
+    def _collectOutgoingMessages(self):
+        messageCount = 0
+        messages = self._takeOutgoingMessages()
+        while messages:
+            for message in self._groupIntoBatches(messages):
+                self._multiplexer.enqueue(message.channel, message)
+            for message in messages:
                 self._outgoing_queue.task_done()
+            messageCount += len(messages)
+            messages = self._takeOutgoingMessages()
+        return messageCount
+
+    def _collectFileData(self):
+        # A new chunk is only read once the previous ones left the multiplexer, so reading the file keeps pace with the socket.
+        if self._multiplexer.hasPendingData(MessageChannels.BULK):
+            return
+        for uuid, uploadStream in list(self._uploadStreams.items()):
+            if uploadStream.task.stale:
+                self._logger.info(f"Upload of {uploadStream.task.subject.fullPath} got cancelled, stopping its stream.")
+                uploadStream.close()
+                del self._uploadStreams[uuid]
+            elif uploadStream.canSend():
+                message = uploadStream.nextMessage()
+                self._multiplexer.enqueue(message.channel, message)
+                if uploadStream.finished and not uploadStream.finishReported:
+                    uploadStream.finishReported = True
+                    self.uploadStreamFinished.emit(uploadStream.task)
+                break
+
+    def _closeFileStreams(self):
+        for uploadStream in self._uploadStreams.values():
+            uploadStream.close()
+        for uuid, handle in self._downloadStreams.items():
+            handle.close()
+            self.downloadStreamAborted.emit(uuid)
+        self._uploadStreams, self._downloadStreams = {}, {}
+
+    def _isBatchable(self, message):
+        # Streamed uploads go out on their own, so their FILE_DATA can't overtake them in a higher priority batch.
+        return message.header.messageType in self._BATCHABLE_MESSAGE_TYPES and not (message.data or {}).get("streamed", False)
+
+    def _takeOutgoingMessages(self):
+        # Consecutive batchable messages are taken together, a non-batchable one ends the run.
+        messages = []
+        while len(messages) < max(self._maxBatchSize, 1):
+            try:
+                message = self._outgoing_queue.get_nowait()
             except Empty:
-                time.sleep(0.02)
+                break
+            messages.append(message)
+            if not self._isBatchable(message):
+                break
+        return messages
+
+    def _groupIntoBatches(self, messages):
+        batchable = [message for message in messages if self._isBatchable(message)]
+        if len(batchable) < 2:
+            return messages
+        items = [{"messageType": message.header.messageType, "uuid": message.header.uuid, "data": message.data} for message in batchable]
+        channel = min(message.channel for message in batchable)
+        batch = NetworkMessage.Builder(MessageTypes.BATCH).withRandomUUID().withData({"items": items}).withChannel(channel).build()
+        self._pendingBatches[batch.header.uuid] = {message.header.uuid: message for message in batchable}
+
+        return [batch, *messages[len(batchable):]]
 
     def disconnect(self):
         self._logger.debug("Disconnecting")
@@ -0,0 +1,327 @@
+import socket
+import struct
+import zlib
+
+from collections import deque
+from dataclasses import dataclass
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+# Every frame is a plaintext header (payload length, flags) followed by the payload.
+FRAME_HEADER = struct.Struct("!IB")
+MAX_FRAME_SIZE = 1 << 22
+# Until the peer has shown it knows the key, its frames are kept small so it can't make us allocate large buffers.
+HANDSHAKE_MAX_FRAME_SIZE = 1 << 14
+# Fragments of a message are reassembled up to this size.
+MAX_MESSAGE_SIZE = 1 << 26
+# Messages bigger than this are split into fragments once both ends agreed on multiplexing.
+DEFAULT_FRAGMENT_SIZE = 1 << 14
+
+
+class FrameFlags():
+    NONE = 0x00
+    PLAINTEXT = 0x01
+    COMPRESSED_ZLIB = 0x02
+    COMPRESSED_ZSTD = 0x04
+    # Set on every fragment of a message but the last one.
+    MORE_FRAGMENTS = 0x08
+    # Fragments of messages on different channels may be interleaved, each channel is reassembled separately.
+    CHANNEL_MASK = 0x30
+    CHANNEL_SHIFT = 4
+
+
+class FrameFormatError(Exception):
+    pass
+
+
+class Compressions():
+    ZSTD = "zstd"
+    ZLIB = "zlib"
+
+
+# In order of preference.
+SUPPORTED_COMPRESSIONS = [Compressions.ZSTD, Compressions.ZLIB] if zstandard else [Compressions.ZLIB]
+
+
+@dataclass
+class SocketOptions:
+    sendBufferSize: int = None
+    receiveBufferSize: int = None
+    noDelay: bool = True
+
+    def apply(self, sock):
+        if self.sendBufferSize:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, self.sendBufferSize)
+        if self.receiveBufferSize:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.receiveBufferSize)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1 if self.noDelay else 0)
+
+
+@dataclass
+class KeepaliveOptions:
+    interval: float = 5.0
+    timeout: float = 15.0
+
+
+class RoundTripTimeEstimator():
+    # Smoothed like TCP's SRTT, new samples have a weight of 1/8.
+    __SMOOTHING_FACTOR = 0.125
+
+    def __init__(self):
+        self.value = None
+        self.lastSample = None
+
+    def addSample(self, sample):
+        self.lastSample = sample
+        if self.value is None:
+            self.value = sample
+        else:
+            self.value += self.__SMOOTHING_FACTOR * (sample - self.value)
+
+
+@dataclass
+class ResumeOptions:
+    # Seconds a disconnected session waits for its client to come back, and how many messages it keeps meanwhile.
+    gracePeriod: float = 120.0
+    replayBufferSize: int = 1024
+
+
+@dataclass
+class CompressionOptions:
+    enabled: bool = True
+    threshold: int = 512
+
+    @property
+    def algorithms(self):
+        return list(SUPPORTED_COMPRESSIONS) if self.enabled else []
+
+
+class FrameCompressor():
+
+    def __init__(self, algorithm, threshold):
+        if algorithm not in SUPPORTED_COMPRESSIONS:
+            raise ValueError(f"Unsupported compression: {algorithm}")
+        self.algorithm = algorithm
+        self.threshold = threshold
+        if algorithm == Compressions.ZSTD:
+            self.__compress = zstandard.ZstdCompressor(level=3).compress
+            self.__flag = FrameFlags.COMPRESSED_ZSTD
+        else:
+            self.__compress = lambda payload: zlib.compress(payload, 6)
+            self.__flag = FrameFlags.COMPRESSED_ZLIB
+
+    def compress(self, payload, flags):
+        if len(payload) < self.threshold:
+            return payload, flags
+        compressed = self.__compress(payload)
+        if len(compressed) >= len(payload):
+            return payload, flags
+        return compressed, flags | self.__flag
+
+
+def decompressPayload(payload, flags, maxSize=MAX_FRAME_SIZE):
+    # Both decompressors stop after maxSize bytes, so a small frame can't expand without limit.
+    if flags & FrameFlags.COMPRESSED_ZSTD:
+        if zstandard is None:
+            raise FrameFormatError("Received a zstd compressed frame, but zstandard is not installed!")
+        try:
+            with zstandard.ZstdDecompressor().stream_reader(payload) as reader:
+                decompressed = reader.read(maxSize + 1)
+        except zstandard.ZstdError as e:
+            raise FrameFormatError(f"Invalid zstd compressed frame: {e}")
+    elif flags & FrameFlags.COMPRESSED_ZLIB:
+        decompressor = zlib.decompressobj()
+        try:
+            decompressed = decompressor.decompress(payload, maxSize)
+        except zlib.error as e:
+            raise FrameFormatError(f"Invalid zlib compressed frame: {e}")
+        if decompressor.unconsumed_tail:
+            raise FrameFormatError(f"Decompressed frame exceeds the maximum frame size of {maxSize} bytes!")
+    else:
+        return payload
+    if len(decompressed) > maxSize:
+        raise FrameFormatError(f"Decompressed frame exceeds the maximum frame size of {maxSize} bytes!")
+
+    return decompressed
+
+
+class FrameReader():
+
+    def __init__(self, decoder=None, initialBufferSize=65536, maxFrameSize=MAX_FRAME_SIZE):
+        self.__decoder = decoder
+        self.__maxFrameSize = maxFrameSize
+        self.__buffer = bytearray(initialBufferSize)
+        self.__view = memoryview(self.__buffer)
+        self.__start = 0
+        self.__end = 0
+        self.__fragments = {}
+
+    def setDecoder(self, decoder):
+        self.__decoder = decoder
+
+    def setMaxFrameSize(self, maxFrameSize):
+        self.__maxFrameSize = maxFrameSize
+
+    def readFrom(self, sock):
+        if self.__end == len(self.__buffer):
+            self.__makeRoom(self.__end - self.__start + 1)
+        received = sock.recv_into(self.__view[self.__end:])
+        self.__end += received
+
+        return received
+
+    def frames(self):
+        # Uncompressed payloads are memoryviews into the receive buffer, decrypted in place. They are only valid until the generator is advanced.
+        while self.__end - self.__start >= FRAME_HEADER.size:
+            length, flags = FRAME_HEADER.unpack_from(self.__buffer, self.__start)
+            if length > self.__maxFrameSize:
+                raise FrameFormatError(f"Frame of {length} bytes exceeds the maximum frame size of {self.__maxFrameSize} bytes!")
+            frameEnd = self.__start + FRAME_HEADER.size + length
+            if frameEnd > self.__end:
+                self.__makeRoom(FRAME_HEADER.size + length)
+                break
+
+            payload = self.__view[self.__start + FRAME_HEADER.size:frameEnd]
+            if not flags & FrameFlags.PLAINTEXT:
+                if self.__decoder is None:
+                    raise FrameFormatError("Received an encrypted frame before the session was set up!")
+                self.__decoder.decrypt(payload, output=payload)
+            self.__start = frameEnd
+            payload = decompressPayload(payload, flags, self.__maxFrameSize)
+
+            channel = (flags & FrameFlags.CHANNEL_MASK) >> FrameFlags.CHANNEL_SHIFT
+            if flags & FrameFlags.MORE_FRAGMENTS:
+                fragments = self.__fragments.setdefault(channel, bytearray())
+                fragments.extend(payload)
+                if len(fragments) > MAX_MESSAGE_SIZE:
+                    raise FrameFormatError(f"Fragmented message exceeds the maximum message size of {MAX_MESSAGE_SIZE} bytes!")
+                continue
+            elif channel in self.__fragments:
+                fragments = self.__fragments.pop(channel)
+                fragments.extend(payload)
+                payload = fragments
+            yield flags, payload
+        if self.__start == self.__end:
+            self.__start, self.__end = 0, 0
+
+    def __makeRoom(self, frameSize):
+        pending = self.__end - self.__start
+        if frameSize > len(self.__buffer):
+            newBuffer = bytearray(max(frameSize, len(self.__buffer) * 2))
+            newBuffer[:pending] = self.__view[self.__start:self.__end]
+            self.__buffer = newBuffer
+            self.__view = memoryview(newBuffer)
+        elif self.__start + frameSize > len(self.__buffer):
+            self.__view[:pending] = self.__view[self.__start:self.__end]
+        else:
+            return
+        self.__start, self.__end = 0, pending
+
+
+class FrameWriter():
+
+    def __init__(self, encoder=None):
+        self.__encoder = encoder
+        self.__compressor = None
+        self.__buffer = bytearray()
+
+    def setEncoder(self, encoder):
+        self.__encoder = encoder
+
+    def setCompressor(self, compressor):
+        self.__compressor = compressor
+
+    def writeFrame(self, payload, flags=FrameFlags.NONE):
+        if self.__compressor and not flags & FrameFlags.PLAINTEXT:
+            payload, flags = self.__compressor.compress(payload, flags)
+        payloadStart = len(self.__buffer) + FRAME_HEADER.size
+        self.__buffer.extend(FRAME_HEADER.pack(len(payload), flags))
+        self.__buffer.extend(payload)
+        if not flags & FrameFlags.PLAINTEXT:
+            with memoryview(self.__buffer) as view:
+                encryptedPart = view[payloadStart:]
+                self.__encoder.encrypt(encryptedPart, output=encryptedPart)
+                encryptedPart.release()
+
+    def hasPendingData(self):
+        return len(self.__buffer) > 0
+
+    def pendingSize(self):
+        return len(self.__buffer)
+
+    def sendTo(self, sock):
+        sent = sock.send(self.__buffer)
+        del self.__buffer[:sent]
+
+        return len(self.__buffer)
+
+    def clear(self):
+        self.__buffer = bytearray()
+
+
+class FrameMultiplexer():
+    # Lower channel numbers have higher priority. Messages are only encoded when their first fragment is due.
+
+    def __init__(self, encode, channelCount, fragmentSize=None):
+        self.__encode = encode
+        self.__fragmentSize = fragmentSize
+        self.__pendingMessages = [deque() for channel in range(channelCount)]
+        self.__currentPayloads = [None] * channelCount
+
+    def setFragmentSize(self, fragmentSize):
+        self.__fragmentSize = fragmentSize
+
+    def enqueue(self, channel, message):
+        self.__pendingMessages[channel].append(message)
+
+    def hasPendingData(self, channel=None):
+        if channel is not None:
+            return self.__currentPayloads[channel] is not None or len(self.__pendingMessages[channel]) > 0
+        return self.__nextChannel() is not None
+
+    def takePendingMessages(self):
+        # A partially sent message is returned as a whole, the receiving end drops its fragments with the connection.
+        messages = []
+        for channel, pendingMessages in enumerate(self.__pendingMessages):
+            if self.__currentPayloads[channel] is not None:
+                messages.append(self.__currentPayloads[channel][0])
+                self.__currentPayloads[channel] = None
+            messages.extend(pendingMessages)
+            pendingMessages.clear()
+        return messages
+
+    def fill(self, writer, maxPendingBytes):
+        while writer.pendingSize() < maxPendingBytes:
+            channel = self.__nextChannel()
+            if channel is None:
+                break
+            self.__writeNextFragment(writer, channel)
+
+    def __nextChannel(self):
+        for channel, pendingMessages in enumerate(self.__pendingMessages):
+            if self.__currentPayloads[channel] is not None or pendingMessages:
+                return channel
+        return None
+
+    def __writeNextFragment(self, writer, channel):
+        if self.__currentPayloads[channel] is None:
+            message = self.__pendingMessages[channel].popleft()
+            payload = self.__encode(message)
+            if not self.__fragmentSize:
+                writer.writeFrame(payload)
+                return
+            self.__currentPayloads[channel] = (message, memoryview(payload), 0)
+
+        message, payload, offset = self.__currentPayloads[channel]
+        fragmentEnd = offset + self.__fragmentSize
+        flags = channel << FrameFlags.CHANNEL_SHIFT
+        if fragmentEnd < len(payload):
+            flags |= FrameFlags.MORE_FRAGMENTS
+            self.__currentPayloads[channel] = (message, payload, fragmentEnd)
+        else:
+            self.__currentPayloads[channel] = None
+        writer.writeFrame(payload[offset:fragmentEnd], flags)
@@ -5,7 +5,7 @@ from uuid import uuid4
 
 import model.task
 
-from model.message import NetworkMessage, MessageTypes, NetworkMessageFormatError
+from model.message import NetworkMessage, MessageTypes, NetworkMessageFormatError, MessageCodec, MessageEncodings, COMPACT_MESSAGE_VERSION
 from model.config import AccountData, AccountTypes
 from model.file import FileData, FileStatuses
 from model.permission import WorkspacePermissionValidator, InvalidWorkspacePermissionException
@@ -124,6 +124,51 @@ class NetworkMessageRainyTests(unittest.TestCase):
             self.assertEqual(str(e), f"Invalid header format, key 'uuid' must be of type str with a length of 32. Received length: {len(invalidLengthUUID)}")
 
 
+class MessageCodecTests(unittest.TestCase):
+
+    def setUp(self):
+        self.codec = MessageCodec()
+
+    def test_compact_encoding_round_trip(self):
+        self.codec.encoding = MessageEncodings.COMPACT
+        testFiles = [{"filename": f"file_{index}", "modified": index, "size": 10, "path": "", "fullPath": f"file_{index}"} for index in range(3)]
+        testMessage = NetworkMessage.Builder(MessageTypes.RESPONSE).withRandomUUID().withData({"files": testFiles, "last": True}).build()
+
+        decoded = self.codec.decode(self.codec.encode(testMessage))
+
+        self.assertEqual(decoded.header.messageType, MessageTypes.RESPONSE)
+        self.assertEqual(decoded.header.uuid, testMessage.header.uuid)
+        self.assertEqual(decoded.data, {"files": testFiles, "last": True})
+
+    def test_compact_encoding_sends_keys_of_uniform_records_only_once(self):
+        testFiles = [{"filename": f"file_{index}", "fullPath": f"file_{index}"} for index in range(100)]
+        testMessage = NetworkMessage.Builder(MessageTypes.RESPONSE).withRandomUUID().withData(testFiles).build()
+
+        legacy = self.codec.encode(testMessage)
+        self.codec.encoding = MessageEncodings.COMPACT
+        compact = self.codec.encode(testMessage)
+
+        self.assertEqual(compact.count(b"fullPath"), 1)
+        self.assertLess(len(compact), len(legacy))
+
+    def test_legacy_messages_are_decoded_regardless_of_encoding(self):
+        testMessage = NetworkMessage.Builder(MessageTypes.GET_WORKSPACE).withRandomUUID().build()
+        legacy = self.codec.encode(testMessage)
+        self.codec.encoding = MessageEncodings.COMPACT
+
+        decoded = self.codec.decode(legacy)
+
+        self.assertEqual(decoded.header.messageType, MessageTypes.GET_WORKSPACE)
+        self.assertEqual(decoded.header.uuid, testMessage.header.uuid)
+
+    def test_compact_message_with_unsupported_version_is_rejected(self):
+        with self.assertRaises(NetworkMessageFormatError):
+            NetworkMessage.fromCompact([COMPACT_MESSAGE_VERSION + 1, MessageTypes.RESPONSE, None, None])
+
+    def test_compact_message_with_invalid_uuid_is_rejected(self):
+        with self.assertRaises(NetworkMessageFormatError):
+            NetworkMessage.fromCompact([COMPACT_MESSAGE_VERSION, MessageTypes.RESPONSE, b"short", None])
+
 class AccountDataTests(unittest.TestCase):
 
     def test_serialize_returns_dict_with_passed_values(self):
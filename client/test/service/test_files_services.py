@@ -128,7 +128,7 @@ class FileSynchronizerTests(unittest.TestCase):
             FileData(filename="existsBothRemoteNewer", modified=6, size=5, path="", fullPath="existsBothRemoteNewer")
         ]
         scandirMock.return_value = iter(fakeLocalFiles)
-        expectedFileResult = [fakeLocalFiles[0], fakeLocalFiles[2], fakeRemoteFiles[2], fakeRemoteFiles[0]]
+        expectedFileResult = [fakeRemoteFiles[0], fakeLocalFiles[2], fakeRemoteFiles[2], fakeLocalFiles[0]]
 
         self.syncer.syncFileList(fakeRemoteFiles)
 
@@ -149,10 +149,71 @@ class FileSynchronizerTests(unittest.TestCase):
                 # compare taskData
                 self.assertEqual(expectedFileResult[i].size, self.fakeEventReceiver.tasks[i].subject.size)
 
-        self.assertEqual(self.fakeEventReceiver.events[0].status, FileStatuses.UPLOADING_FROM_LOCAL)
+        self.assertEqual(self.fakeEventReceiver.events[0].status, FileStatuses.DOWNLOADING_FROM_CLOUD)
         self.assertEqual(self.fakeEventReceiver.events[1].status, FileStatuses.UPLOADING_FROM_LOCAL)
         self.assertEqual(self.fakeEventReceiver.events[2].status, FileStatuses.DOWNLOADING_FROM_CLOUD)
-        self.assertEqual(self.fakeEventReceiver.events[3].status, FileStatuses.DOWNLOADING_FROM_CLOUD)
+        self.assertEqual(self.fakeEventReceiver.events[3].status, FileStatuses.UPLOADING_FROM_LOCAL)
+
+    @mock.patch('os.unlink')
+    @mock.patch('os.scandir')
+    def test_sync_files_merges_remote_pages_as_they_arrive(self, scandirMock, osUnlinkMock):
+        fakeLocalFiles = [
+            MockFileSystemEntry(self.__generateFullPath("existsLocalOnly"), False, 5, 5),
+            MockFileSystemEntry(self.__generateFullPath("existsBothSynced"), False, 5, 5)
+        ]
+        scandirMock.return_value = iter(fakeLocalFiles)
+
+        self.syncer.beginFileListSync()
+        self.syncer.mergeRemoteFilesPage([FileData(filename="existsBothSynced", modified=5, size=5, path="", fullPath="existsBothSynced")])
+        self.assertEqual([(event.sourcePath, event.status) for event in self.fakeEventReceiver.events], [("existsBothSynced", FileStatuses.SYNCED)])
+
+        self.syncer.mergeRemoteFilesPage([FileData(filename="existsRemoteOnly", modified=5, size=5, path="", fullPath="existsRemoteOnly")])
+        self.syncer.finishFileListSync()
+
+        self.assertEqual([(event.sourcePath, event.status) for event in self.fakeEventReceiver.events], [
+            ("existsBothSynced", FileStatuses.SYNCED),
+            ("existsRemoteOnly", FileStatuses.DOWNLOADING_FROM_CLOUD),
+            ("existsLocalOnly", FileStatuses.UPLOADING_FROM_LOCAL)
+        ])
+        self.assertEqual([task.subject.fullPath for task in self.fakeEventReceiver.tasks], ["existsRemoteOnly", "existsLocalOnly"])
+
+    @mock.patch('os.makedirs')
+    @mock.patch('os.path.exists', return_value=False)
+    @mock.patch('shutil.move')
+    @mock.patch('os.remove')
+    @mock.patch('os.stat')
+    @mock.patch('os.unlink')
+    @mock.patch('os.scandir')
+    def test_remote_changes_download_newer_remote_files_and_trash_remotely_deleted_files(self, scandirMock, osUnlinkMock, osStatMock, osRemoveMock, shutilMoveMock, osPathExistsMock, osMakedirsMock):
+        fakeLocalFiles = [
+            MockFileSystemEntry(self.__generateFullPath("modifiedRemotely"), False, 5, 5),
+            MockFileSystemEntry(self.__generateFullPath("modifiedLocally"), False, 7, 5),
+            MockFileSystemEntry(self.__generateFullPath("deletedRemotely"), False, 5, 5)
+        ]
+        scandirMock.return_value = iter(fakeLocalFiles)
+        self.syncer.beginFileListSync()
+        self.syncer.finishFileListSync()
+        self.fakeEventReceiver.events.clear()
+        self.fakeEventReceiver.tasks.clear()
+        osStatMock.side_effect = lambda path: next(entry for entry in fakeLocalFiles if entry.path == path)
+
+        self.syncer.applyRemoteChanges(
+            [FileData(filename="addedRemotely", modified=5, size=5, path="", fullPath="addedRemotely")],
+            [FileData(filename="deletedRemotely", modified=5, size=5, path="", fullPath="deletedRemotely")],
+            [
+                FileData(filename="modifiedRemotely", modified=6, size=5, path="", fullPath="modifiedRemotely"),
+                FileData(filename="modifiedLocally", modified=6, size=5, path="", fullPath="modifiedLocally")
+            ]
+        )
+
+        self.assertEqual([(event.sourcePath, event.status) for event in self.fakeEventReceiver.events], [
+            ("addedRemotely", FileStatuses.DOWNLOADING_FROM_CLOUD),
+            ("modifiedRemotely", FileStatuses.DOWNLOADING_FROM_CLOUD)
+        ])
+        self.assertEqual([task.taskType for task in self.fakeEventReceiver.tasks], [FileStatuses.DOWNLOADING_FROM_CLOUD] * 2)
+        osRemoveMock.assert_not_called()
+        shutilMoveMock.assert_called_once_with(self.__generateFullPath("deletedRemotely"), "/.testSyncDir.trash/deletedRemotely")
+        osMakedirsMock.assert_called_once_with("/.testSyncDir.trash", exist_ok=True)
 
     @mock.patch("time.sleep")
     @mock.patch("shutil.move")
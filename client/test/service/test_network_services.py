@@ -0,0 +1,63 @@
+import unittest
+import logging
+
+from unittest.mock import MagicMock
+
+from services.hub import ServiceHub
+from model.message import NetworkMessage, MessageTypes
+
+logging.disable(logging.CRITICAL)
+
+
+class RejectedBatchItemTests(unittest.TestCase):
+
+    def setUp(self):
+        self.hub = ServiceHub.getInstance()
+        self.hub.initNetworkService()
+        self.networkService = self.hub._ServiceHub__networkService
+        self.networkService._maxBatchSize = 8
+        self.errors = []
+        self.hub.errorChannel.connect(self.errors.append)
+
+    def tearDown(self):
+        self.hub.errorChannel.disconnect(self.errors.append)
+
+    def __sendAsBatch(self, messages, callBack=None):
+        for message in messages:
+            self.hub.sendNetworkMessage(message, callBack if message.header.messageType == MessageTypes.MOVE_FILE else None)
+        batch, = self.networkService._groupIntoBatches(self.networkService._takeOutgoingMessages())
+        return batch
+
+    def __answer(self, batch, results):
+        response = NetworkMessage.Builder(MessageTypes.RESPONSE).withUUID(batch.header.uuid).withData({"results": results}).build()
+        self.networkService._processBatchResults(response)
+
+    def test_rejected_move_resolves_its_callback_as_failed(self):
+        moveCallBack = MagicMock()
+        moveMessage = NetworkMessage.Builder(MessageTypes.MOVE_FILE).withRandomUUID().withData({"source": "dir/file.txt", "target": {"fullPath": "other/file.txt"}}).build()
+        deleteMessage = NetworkMessage.Builder(MessageTypes.DELETE_FILE).withRandomUUID().withData({"fullPath": "dir/old.txt"}).build()
+        batch = self.__sendAsBatch([moveMessage, deleteMessage], moveCallBack)
+
+        self.__answer(batch, [
+            {"uuid": moveMessage.header.uuid, "accepted": False, "error": "Invalid message"},
+            {"uuid": deleteMessage.header.uuid, "accepted": True}
+        ])
+
+        moveCallBack.assert_called_once_with({"moveSuccessful": False, "from": "dir/file.txt", "to": "other/file.txt"})
+        self.assertEqual(len(self.errors), 1)
+
+    def test_accepted_requests_are_left_to_their_response(self):
+        moveCallBack = MagicMock()
+        moveMessage = NetworkMessage.Builder(MessageTypes.MOVE_FILE).withRandomUUID().withData({"source": "dir/file.txt", "target": {"fullPath": "other/file.txt"}}).build()
+        deleteMessage = NetworkMessage.Builder(MessageTypes.DELETE_FILE).withRandomUUID().withData({"fullPath": "dir/old.txt"}).build()
+        batch = self.__sendAsBatch([moveMessage, deleteMessage], moveCallBack)
+
+        self.__answer(batch, [{"uuid": moveMessage.header.uuid, "accepted": True}, {"uuid": deleteMessage.header.uuid, "accepted": True}])
+
+        moveCallBack.assert_not_called()
+        self.assertEqual(self.errors, [])
+        self.assertEqual(self.networkService._pendingBatches, {})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -48,13 +48,16 @@ class MainPanel(QWidget):
     __fileWidgets = {}
     __serviceHub = None
     __stateSuccessionMap = None
+    __FILE_LIST_PAGE_SIZE = 500
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.setAttribute(Qt.WA_StyledBackground)
         self.__serviceHub = ServiceHub.getInstance()
         self.__serviceHub.filesChannel.connect(self.__onFileStatusEvent)
+        self.__serviceHub.fileStatusBatchChannel.connect(self.__onFileStatusEventBatch)
         self.__stateSuccessionMap = self.__createStateSuccessionMap()
+        self.__expectedFileListPage = 0
 
         self.__fileTrackerIconAtlas = FileTrackerIconAtlas()
         self.__logger = moduleLogger.getChild("MainPanel")
@@ -181,14 +184,33 @@ class MainPanel(QWidget):
 
     def syncFileList(self):
         self.__logger.debug("Syncing file list")
-        message = NetworkMessage.Builder(MessageTypes.SYNC_FILES).withRandomUUID().build()
-
-        self.__serviceHub.sendNetworkMessage(message, self.__onFilelistRetrieved)
-
-    def __onFilelistRetrieved(self, rawFileList):
-        serializedFileList = [FileData(**raw) for raw in rawFileList]
-        self.__serviceHub.syncRemoteAndLocalFiles(serializedFileList)
-        self.ready.emit()
+        self.__expectedFileListPage = 0
+        message = NetworkMessage.Builder(MessageTypes.SYNC_FILES).withRandomUUID().withData({"pageSize": self.__FILE_LIST_PAGE_SIZE}).build()
+
+        self.__serviceHub.sendNetworkMessage(message, self.__onFilelistPageRetrieved)
+
+    def __onFilelistPageRetrieved(self, page):
+        if page["continuationToken"] != self.__expectedFileListPage:
+            self.__logger.error(f"Received file list page {page['continuationToken']}, expected {self.__expectedFileListPage}. Ignoring.")
+            return
+        if self.__expectedFileListPage == 0:
+            self.__serviceHub.beginRemoteAndLocalFileSync()
+        self.__expectedFileListPage += 1
+
+        self.__serviceHub.syncRemoteFilesPage([FileData(**raw) for raw in page["files"]])
+        if page["last"]:
+            self.__serviceHub.finishRemoteAndLocalFileSync()
+            self.ready.emit()
+
+    @pyqtSlot(list)
+    def __onFileStatusEventBatch(self, events):
+        self.__logger.debug(f"Received {len(events)} events")
+        self.setUpdatesEnabled(False)
+        try:
+            for event in events:
+                self.__onFileStatusEvent(event)
+        finally:
+            self.setUpdatesEnabled(True)
 
     @pyqtSlot(FileStatusEvent)
     def __onFileStatusEvent(self, event):
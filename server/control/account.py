@@ -2,29 +2,41 @@ import re
 import logging
 import json
 import time
+import weakref
+from copy import deepcopy
+from dataclasses import replace
 from uuid import uuid4
+from threading import Lock, local
 from os import unlink
 from io import BufferedReader, BufferedWriter
 from datetime import datetime, timedelta, timezone
 
 import dropbox
 import requests
-import googleapiclient
+import httplib2
+import googleapiclient.errors
+import google_auth_httplib2
 from googleapiclient.discovery import build
 from google.oauth2 import service_account
-from googleapiclient.http import MediaIoBaseUpload, MediaIoBaseDownload
 from Crypto.Cipher import AES
+from googleapiclient.http import HttpRequest, MediaIoBaseUpload, MediaIoBaseDownload
 
 import control.cli
 from model.account import AccountTypes, AccountData
 from model.file import FileData, FilePart
 from model.task import Task
-from control.util import chunkSizeGenerator, httpRangeHeaderIntervalGenerator
+from control.abstract import Singleton
+from control.util import chunkSizeGenerator
+from control.crypto import CryptoService
+from control.bandwidth import BandwidthLimiter, TransferDirections
+from control.httppool import PooledSession
+from control.ratecontrol import RateControllers, RetryPolicy, ProviderThrottledError, TransientCloudError, parseRetryAfter
 
 moduleLogger = logging.getLogger(__name__)
 
 
 class CloudAPIWrapper:
+    _RETRY_POLICY = RetryPolicy()
 
     def __init__(self, accountData):
         self.accountData = accountData
@@ -46,22 +58,57 @@ class CloudAPIWrapper:
     def moveFile(self, partInfo, targetFullPath):
         raise NotImplementedError("Derived class must implement method 'move'!")
 
+    def getConnectionStats(self):
+        # Connections opened and requests sent by the wrapper, None if the client does not tell.
+        return None
+
+    def close(self):
+        pass
+
     def _getLogger(self):
         raise NotImplementedError("Derived class must implement method '_getLogger'!")
 
+    def _throttle(self, direction, size, task):
+        BandwidthLimiter().throttle(self.accountData.id, direction, size, task)
+
+    def _call(self, function, task=None):
+        # Every provider call goes through the rate controller of the account, which retries throttled calls. Calls
+        # failing with transient errors are retried with backoff on top.
+        rateController = RateControllers().get(self.accountData.id)
+        return self._RETRY_POLICY.call(lambda: rateController.call(function, self._getRetryAfter, task), self._isTransientError, task)
+
+    def _getRetryAfter(self, exception):
+        # Seconds to wait before retrying if the exception is a throttling by the provider, None otherwise.
+        if isinstance(exception, ProviderThrottledError):
+            return exception.retryAfter
+        return None
+
+    def _isTransientError(self, exception):
+        if isinstance(exception, requests.HTTPError):
+            return exception.response is not None and exception.response.status_code >= 500
+        return isinstance(exception, (TransientCloudError, ConnectionError, TimeoutError, requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError))
+
 
 class DropboxAccountWrapper(CloudAPIWrapper):
 
     def __init__(self, *args):
         super().__init__(*args)
-        self.__dbx = dropbox.Dropbox(self.accountData.data['apiToken'])
+        # The SDK and the downloads share the connections of the account. Failed calls are retried by the wrapper instead
+        # of the SDK.
+        # The session is closed once the wrapper is not used anymore, a replaced wrapper may still be in use by tasks
+        # running with it.
+        self.__session = PooledSession()
+        self.__closeSession = weakref.finalize(self, self.__session.close)
+        self.__dbx = dropbox.Dropbox(self.accountData.data['apiToken'], max_retries_on_error=0, max_retries_on_rate_limit=0, session=self.__session)
         self.__DOWNLOAD_URL = "https://content.dropboxapi.com/2/files/download"
         self.__UPLOAD_CHUNK_SIZE = 1048576
         self.__DOWNLOAD_CHUNK_SIZE = 1048576
+        self.__STREAM_READ_SIZE = 65536
+        self.__TIMEOUT = 100
 
     def getFileList(self):
         files = []
-        result = self.__dbx.files_list_folder("", recursive=True)
+        result = self._call(lambda: self.__dbx.files_list_folder("", recursive=True))
         files = [self.__toFilePart(entry) for entry in result.entries if type(entry) == (dropbox.files.FileMetadata) and entry.name[-4:] == ".enc" and entry.size > 0]
 
         return files
@@ -69,14 +116,14 @@ class DropboxAccountWrapper(CloudAPIWrapper):
     def upload(self, fileHandle, toUploadSize, partName, task):
         self._logger.debug(f"Uploading filePart: {partName}")
 
-        cipher = AES.new(self.accountData.cryptoKey.encode(), AES.MODE_CFB)
+        encryptor = CryptoService().encryptor(self.accountData.cryptoKey.encode())
 
         if not task.stale:
-            upload_session_start_result = self.__dbx.files_upload_session_start(
-                cipher.iv
-            )
+            upload_session_start_result = self._call(lambda: self.__dbx.files_upload_session_start(
+                encryptor.iv
+            ), task)
 
-            offset = len(cipher.iv)
+            offset = len(encryptor.iv)
             cursor = dropbox.files.UploadSessionCursor(
                 session_id=upload_session_start_result.session_id,
                 offset=offset,
@@ -90,47 +137,138 @@ class DropboxAccountWrapper(CloudAPIWrapper):
             commit = dropbox.files.CommitInfo(path=f"{remotePath}", mode=dropbox.files.WriteMode.overwrite, client_modified=clientModified)
             uploadResult = None
 
-            for chunkSize, remaining in chunkSizeGenerator(toUploadSize, self.__UPLOAD_CHUNK_SIZE):
-                if not task.stale:
-                    data = cipher.encrypt(fileHandle.read(chunkSize))
-                    if remaining == 0:
-                        result = self.__dbx.files_upload_session_finish(data, cursor, commit)
-                        uploadResult = self.__toFilePart(result)
-                    else:
-                        self.__dbx.files_upload_session_append(
-                            data,
-                            cursor.session_id,
-                            cursor.offset,
-                        )
-                    cursor.offset += chunkSize
+            chunks = encryptor.encryptChunks(fileHandle, chunkSizeGenerator(toUploadSize, self.__UPLOAD_CHUNK_SIZE), task)
+            for data, remaining in chunks:
+                self._throttle(TransferDirections.UPLOAD, len(data), task)
+                if task.stale:
+                    self._logger.info("Dropbox upload interrupted.")
+                    chunks.close()
+                    break
+                result = self.__sendChunk(data, cursor, commit if remaining == 0 else None, task)
+                if remaining == 0:
+                    uploadResult = self.__toFilePart(result)
+                cursor.offset += len(data)
             return uploadResult
 
+    def __sendChunk(self, data, cursor, commit, task):
+        # A failed attempt is retried from the offset Dropbox reports for the session, so the part of the chunk that
+        # already arrived is not sent again.
+        chunkOffset = cursor.offset
+        sent = 0
+
+        def send():
+            nonlocal sent
+            try:
+                if commit:
+                    return self.__dbx.files_upload_session_finish(data[sent:], dropbox.files.UploadSessionCursor(session_id=cursor.session_id, offset=chunkOffset + sent), commit)
+                self.__dbx.files_upload_session_append(data[sent:], cursor.session_id, chunkOffset + sent)
+            except dropbox.exceptions.ApiError as e:
+                correctOffset = self.__getCorrectOffset(e)
+                if correctOffset is None or not chunkOffset <= correctOffset <= chunkOffset + len(data):
+                    raise
+                sent = correctOffset - chunkOffset
+                if commit or sent < len(data):
+                    raise TransientCloudError(f"Upload session continues at offset {correctOffset}") from e
+
+        return self._call(send, task)
+
+    def __getCorrectOffset(self, apiError):
+        error = apiError.error
+        if getattr(error, "is_lookup_failed", lambda: False)():
+            error = error.get_lookup_failed()
+        if getattr(error, "is_incorrect_offset", lambda: False)():
+            return error.get_incorrect_offset().correct_offset
+        return None
+
     def download(self, fileHandle, partInfo, task):
         token = self.accountData.data["apiToken"]
 
-        headers = {"Authorization": f"Bearer {token}", "Dropbox-API-Arg": json.dumps({"path": f"/{partInfo.fullPath}"}), "Range": "bytes=0-15"}
-        res = requests.get(self.__DOWNLOAD_URL, headers=headers)
-        cipher = AES.new(self.accountData.cryptoKey.encode(), AES.MODE_CFB, iv=res.content)
-
-        for interval in httpRangeHeaderIntervalGenerator(partInfo.size, self.__DOWNLOAD_CHUNK_SIZE):
-            if task.stale:
-                self._logger.info("Dropbox download interrupted.")
-                break
-            else:
-                headers["Range"] = f"bytes={interval[0]}-{interval[1]}"
+        headers = {"Authorization": f"Bearer {token}", "Dropbox-API-Arg": json.dumps({"path": f"/{partInfo.fullPath}"})}
+        chunks = self.__streamChunks(headers, partInfo.size, task)
+        iv = next(chunks, None)
+        if iv is None:
+            return
+        decryptor = CryptoService().decryptor(self.accountData.cryptoKey.encode(), iv)
+
+        for decrypted in decryptor.decryptChunks(chunks):
+            fileHandle.write(decrypted)
+        self._logger.debug(f"Connection stats: {self.getConnectionStats()}")
+
+    def __streamChunks(self, headers, size, task):
+        # The part is read in one streamed request. The IV is yielded first, then the ciphertext in chunks of a buffer
+        # reused for the whole part, every chunk is passed on for decryption before the buffer is filled again. An
+        # interrupted stream is resumed with a range request from the first byte not received yet.
+        iv = bytearray()
+        buffer = memoryview(bytearray(self.__DOWNLOAD_CHUNK_SIZE))
+        filled = 0
+        received = 0
+        attempt = 1
+        while received < size:
+            receivedBefore = received
+            # Opening the stream is retried by the call itself, a retry here resumes a stream that broke off.
+            response = self._call(lambda: self.__open(headers, received), task)
+            try:
+                with response:
+                    for data in response.iter_content(self.__STREAM_READ_SIZE):
+                        if task.stale:
+                            self._logger.info("Dropbox download interrupted.")
+                            return
+                        self._throttle(TransferDirections.DOWNLOAD, len(data), task)
+                        received += len(data)
+                        data = memoryview(data)
+                        if len(iv) < AES.block_size:
+                            ivEnd = AES.block_size - len(iv)
+                            iv += data[:ivEnd]
+                            data = data[ivEnd:]
+                            if len(iv) == AES.block_size:
+                                yield bytes(iv)
+                        while data:
+                            count = min(len(data), len(buffer) - filled)
+                            buffer[filled:filled + count] = data[:count]
+                            filled += count
+                            data = data[count:]
+                            if filled == len(buffer):
+                                yield buffer
+                                filled = 0
+                if received < size:
+                    raise TransientCloudError(f"Dropbox download ended at byte {received} of {size}")
+            except Exception as e:
+                # Attempts are counted from the last time the stream made progress.
+                attempt = 1 if received > receivedBefore else attempt + 1
+                if not self._RETRY_POLICY.retry(attempt, e, self._isTransientError, task):
+                    raise
+                self._logger.info(f"Resuming Dropbox download from byte {received}")
+        if filled:
+            yield buffer[:filled]
+
+    def __open(self, headers, offset):
+        rangeHeaders = {"Range": f"bytes={offset}-"} if offset else {}
+        res = self.__session.get(self.__DOWNLOAD_URL, headers={**headers, **rangeHeaders}, stream=True, timeout=self.__TIMEOUT)
+        if res.status_code in [429, 503]:
+            res.close()
+            raise ProviderThrottledError(f"Dropbox download throttled ({res.status_code})", parseRetryAfter(res.headers.get("Retry-After")))
+        try:
+            res.raise_for_status()
+        except requests.HTTPError:
+            res.close()
+            raise
 
-                res = requests.get(self.__DOWNLOAD_URL, headers=headers)
-                decrypted = cipher.decrypt(res.content)
-                fileHandle.write(decrypted)
+        return res
 
     def deleteFile(self, partInfo):
-        self.__dbx.files_delete(f"/{partInfo.fullPath}")
+        self._call(lambda: self.__dbx.files_delete(f"/{partInfo.fullPath}"))
+
+    def getConnectionStats(self):
+        return self.__session.getConnectionStats()
+
+    def close(self):
+        self.__closeSession()
 
     def moveFile(self, partInfo, targetFullPath):
         sourcePath = f"/{partInfo.fullPath}"
         destinationPath = f"/{targetFullPath}"
 
-        self._logger.debug(self.__dbx.files_move(sourcePath, destinationPath))
+        self._logger.debug(self._call(lambda: self.__dbx.files_move(sourcePath, destinationPath)))
 
     def __toFilePart(self, entry):
         return FilePart(
@@ -145,6 +283,14 @@ class DropboxAccountWrapper(CloudAPIWrapper):
     def _getLogger(self):
         return moduleLogger.getChild("DropboxAccountWrapper")
 
+    def _getRetryAfter(self, exception):
+        if isinstance(exception, dropbox.exceptions.RateLimitError):
+            return float(exception.backoff or 0.0)
+        return super()._getRetryAfter(exception)
+
+    def _isTransientError(self, exception):
+        return isinstance(exception, dropbox.exceptions.InternalServerError) or super()._isTransientError(exception)
+
 
 class TaskInterruptedException(Exception):
     pass
@@ -152,13 +298,17 @@ class TaskInterruptedException(Exception):
 
 class InterruptibleGoogleDriveUploadFileHandle(BufferedReader):
 
-    def __init__(self, handle, task):
+    def __init__(self, handle, task, throttle=None):
         super().__init__(handle)
         self.__task = task
+        self.__throttle = throttle
 
     def read(self, chunk):
         if not self.__task.stale:
-            return super().read(chunk)
+            data = super().read(chunk)
+            if self.__throttle:
+                self.__throttle(len(data))
+            return data
         else:
             raise TaskInterruptedException("")
 
@@ -168,24 +318,35 @@ class InterruptibleGoogleDriveUploadFileHandle(BufferedReader):
 
 class InterruptibleGoogleDriveDownloadFileHandle(BufferedWriter):
 
-    def __init__(self, handle, aesKey, task):
-        self.__cipher = None
+    def __init__(self, handle, aesKey, task, throttle=None):
+        self.__decryptor = None
+        self.__pending = None
         self.__aesKey = aesKey
         self.__task = task
+        self.__throttle = throttle
         super().__init__(handle)
 
     def write(self, data):
+        if self.__throttle:
+            self.__throttle(len(data))
         if not self.__task.stale:
-            if not self.__cipher:
-                self.__cipher = AES.new(self.__aesKey.encode(), AES.MODE_CFB, iv=data[0:16])
-                super().write(self.__cipher.decrypt(data[16:]))
-                super().flush()
-            else:
-                super().write(self.__cipher.decrypt(data))
+            if not self.__decryptor:
+                self.__decryptor = CryptoService().decryptor(self.__aesKey.encode(), data[0:16])
+                data = data[16:]
+            # The chunk is decrypted while the next one is downloaded, the previous one is written meanwhile.
+            pending, self.__pending = self.__pending, self.__decryptor.submit(data)
+            if pending:
+                super().write(pending.result())
                 super().flush()
         else:
             raise TaskInterruptedException("")
 
+    def finish(self):
+        if self.__pending and not self.__task.stale:
+            super().write(self.__pending.result())
+            super().flush()
+        self.__pending = None
+
     def close(self):
         pass
 
@@ -200,16 +361,30 @@ class GoogleDriveAccountWrapper(CloudAPIWrapper):
 
         parsedCreds = json.loads(json.dumps(self.accountData.data))
 
-        credentials = service_account.Credentials.from_service_account_info(parsedCreds, scopes=["https://www.googleapis.com/auth/drive"])
-        self.__service = build('drive', 'v3', credentials=credentials)
+        self.__credentials = service_account.Credentials.from_service_account_info(parsedCreds, scopes=["https://www.googleapis.com/auth/drive"])
+        self.__threadLocal = local()
+        # The discovery document shipped with the library is used instead of fetching it on every build. The wrapper is
+        # shared by the workers, but httplib2 connections are not thread-safe, so every thread sends its requests on
+        # its own connection, sharing the credentials and their token.
+        self.__service = build('drive', 'v3', credentials=self.__credentials, requestBuilder=self.__buildRequest, cache_discovery=False, static_discovery=True)
+
+    def __buildRequest(self, http, *args, **kwargs):
+        return HttpRequest(self.__getHttp(), *args, **kwargs)
+
+    def __getHttp(self):
+        http = getattr(self.__threadLocal, "http", None)
+        if http is None:
+            http = self.__threadLocal.http = google_auth_httplib2.AuthorizedHttp(self.__credentials, http=httplib2.Http())
+
+        return http
 
     def getFileList(self):
         files = []
         hasMore = True
-        results = self.__service.files().list(
+        results = self._call(self.__service.files().list(
             q="'root' in parents and name contains '.enc'",
             fields="nextPageToken, files(id, name, modifiedTime, size)"
-        ).execute()
+        ).execute)
 
         while hasMore:
             currentBatch = [self.__toFilePart(entry) for entry in results.get("files", [])]
@@ -217,24 +392,25 @@ class GoogleDriveAccountWrapper(CloudAPIWrapper):
             nextPageToken = results.get("nextPageToken", None)
             hasMore = nextPageToken is not None
             if hasMore:
-                results = self.__service.files().list(
+                results = self._call(self.__service.files().list(
                     q="'root' in parents and name contains '.enc'",
                     fields="nextPageToken, files(id, name, modifiedTime, size)",
                     pageToken=nextPageToken
-                ).execute()
+                ).execute)
 
         return files
 
     def download(self, fileHandle, partInfo, task):
         self._logger.debug(f"Downloading: {partInfo}")
         try:
-            handle = InterruptibleGoogleDriveDownloadFileHandle(fileHandle, self.accountData.cryptoKey, task)
+            handle = InterruptibleGoogleDriveDownloadFileHandle(fileHandle, self.accountData.cryptoKey, task, lambda size: self._throttle(TransferDirections.DOWNLOAD, size, task))
             request = self.__service.files().get_media(fileId=partInfo.extraInfo["id"])
             downloader = MediaIoBaseDownload(handle, request, chunksize=self.__DOWNLOAD_CHUNK_SIZE)
 
             done = False
             while not done:
-                status, done = downloader.next_chunk()
+                status, done = self._call(downloader.next_chunk, task)
+            handle.finish()
         except TaskInterruptedException:
             self._logger.info("Google drive download interrupted.")
 
@@ -246,27 +422,28 @@ class GoogleDriveAccountWrapper(CloudAPIWrapper):
         metadata = {"name": f"{uploadName}", "parents": ["root"], "mimeType": "application/octet-stream", "modifiedTime": timeModified.strftime("%Y-%m-%dT%H:%M:%SZ")}
 
         tmpFile = f"{control.cli.CONSOLE_ARGUMENTS.workspace}/server/{uuid4().hex}"
-        cipher = AES.new(self.accountData.cryptoKey.encode(), AES.MODE_CFB)
+        encryptor = CryptoService().encryptor(self.accountData.cryptoKey.encode())
         if not task.stale:
             with open(tmpFile, "wb") as outputFile:
-                outputFile.write(cipher.iv)
-                for chunk, remainder in chunkSizeGenerator(toUploadSize, self.__UPLOAD_CHUNK_SIZE):
+                outputFile.write(encryptor.iv)
+                for encrypted, remainder in encryptor.encryptChunks(fileHandle, chunkSizeGenerator(toUploadSize, self.__UPLOAD_CHUNK_SIZE), task):
                     if task.stale:
                         self._logger.info("Dropbox upload interrupted")
                         break
                     else:
-                        data = fileHandle.read(chunk)
-                        encrypted = cipher.encrypt(data)
                         outputFile.write(encrypted)
         if task.stale:
             self._logger.info("Google drive upload interrupted, aborting and cleaning up..")
             unlink(tmpFile)
         else:
             with open(tmpFile, "rb") as rawHandle:
-                interruptibleHandle = InterruptibleGoogleDriveUploadFileHandle(rawHandle, task)
+                interruptibleHandle = InterruptibleGoogleDriveUploadFileHandle(rawHandle, task, lambda size: self._throttle(TransferDirections.UPLOAD, size, task))
                 try:
                     media = MediaIoBaseUpload(interruptibleHandle, mimetype="application/octet-stream", resumable=True, chunksize=self.__UPLOAD_CHUNK_SIZE)
-                    res = self.__service.files().create(body=metadata, media_body=media, fields="id, name, modifiedTime, size").execute()
+                    request = self.__service.files().create(body=metadata, media_body=media, fields="id, name, modifiedTime, size")
+                    res = None
+                    while res is None:
+                        status, res = self._call(request.next_chunk, task)
                     self._logger.debug(f"Finishing google drive upload {res}")
                     unlink(tmpFile)
                     return self.__toFilePart(res)
@@ -277,14 +454,28 @@ class GoogleDriveAccountWrapper(CloudAPIWrapper):
     def moveFile(self, partInfo, targetFullPath):
         timeModified = datetime.utcfromtimestamp(partInfo.modified)
         metadata = {"name": f"{targetFullPath}", "modifiedTime": timeModified.strftime("%Y-%m-%dT%H:%M:%SZ")}
-        self.__service.files().update(fileId=partInfo.extraInfo["id"], body=metadata).execute()
+        self._call(self.__service.files().update(fileId=partInfo.extraInfo["id"], body=metadata).execute)
 
     def deleteFile(self, partInfo):
-        self.__service.files().delete(fileId=partInfo.extraInfo["id"]).execute()
+        self._call(self.__service.files().delete(fileId=partInfo.extraInfo["id"]).execute)
 
     def _getLogger(self):
         return moduleLogger.getChild("GoogleDriveAccountWrapper")
 
+    def _getRetryAfter(self, exception):
+        if isinstance(exception, googleapiclient.errors.HttpError):
+            isRateLimited = exception.resp.status == 403 and b"ateLimitExceeded" in (exception.content or b"")
+            if exception.resp.status in [429, 503] or isRateLimited:
+                return parseRetryAfter(exception.resp.get("retry-after"))
+        return super()._getRetryAfter(exception)
+
+    def _isTransientError(self, exception):
+        # A failed upload chunk leaves the request in an error state, the next attempt asks the resumable session URI
+        # which bytes arrived and continues from there.
+        if isinstance(exception, googleapiclient.errors.HttpError):
+            return exception.resp.status >= 500
+        return isinstance(exception, httplib2.HttpLib2Error) or super()._isTransientError(exception)
+
     def __toFilePart(self, entry):
         filename = entry["name"].split("/")[-1]
         path = entry["name"].replace(filename, "").rstrip("/")
@@ -321,4 +512,41 @@ class CloudAPIFactory:
 
     @staticmethod
     def fromAccountData(accountData):
+        return CloudAPIWrapperRegistry().get(accountData)
+
+    @staticmethod
+    def create(accountData):
         return CloudAPIFactory.__typeToClassMap[accountData.accountType](accountData)
+
+
+class CloudAPIWrapperRegistry(metaclass=Singleton):
+    # Keeps one wrapper per account id, so every task reuses its clients, credentials and access tokens instead of
+    # building them again. The account list handler drops the wrappers of the accounts it changes or deletes, the next
+    # lookup builds a new one. Dropped wrappers are not closed here: tasks still running with them keep them, and their
+    # connections are released once the last of them is done.
+
+    def __init__(self):
+        self.__wrappers = {}
+        self.__lock = Lock()
+        self.__logger = moduleLogger.getChild("CloudAPIWrapperRegistry")
+
+    def get(self, accountData):
+        with self.__lock:
+            wrapper = self.__wrappers.get(accountData.id)
+            if wrapper is None:
+                wrapper = CloudAPIFactory.create(replace(accountData, data=deepcopy(accountData.data)))
+                # Accounts not stored yet have no id to be found by later.
+                if accountData.id is not None:
+                    self.__wrappers[accountData.id] = wrapper
+                    self.__logger.debug(f"Created wrapper for account {accountData.identifier}(ID: {accountData.id})")
+
+            return wrapper
+
+    def invalidate(self, accountID):
+        with self.__lock:
+            if self.__wrappers.pop(accountID, None):
+                self.__logger.debug(f"Dropped wrapper of account {accountID}")
+
+    def clear(self):
+        with self.__lock:
+            self.__wrappers = {}
@@ -0,0 +1,103 @@
+import logging
+import time
+
+from enum import Enum
+from threading import Condition, Lock
+
+from .abstract import Singleton
+
+
+moduleLogger = logging.getLogger(__name__)
+
+
+class TransferDirections(Enum):
+    UPLOAD = "upload"
+    DOWNLOAD = "download"
+
+
+class TokenBucket():
+    # Lets rate bytes per second through on average, in bursts of up to burst seconds worth of bytes. A transfer larger
+    # than the bucket is let through once the bucket is full, leaving it in debt the following transfers wait for.
+    # A rate of None means unlimited.
+    __MAX_WAIT = 1.0
+
+    def __init__(self, rate=None, burst=1.0):
+        self.__rate = rate
+        self.__burst = burst
+        self.__tokens = self.__getCapacity()
+        self.__updated = time.monotonic()
+        self.__condition = Condition()
+
+    @property
+    def rate(self):
+        return self.__rate
+
+    def setRate(self, rate):
+        with self.__condition:
+            self.__refill()
+            self.__rate = rate
+            self.__tokens = min(self.__tokens, self.__getCapacity())
+            self.__condition.notify_all()
+
+    def consume(self, size, task=None):
+        with self.__condition:
+            while True:
+                self.__refill()
+                if self.__rate is None or (task and task.stale):
+                    return
+                needed = min(size, self.__getCapacity())
+                if self.__tokens >= needed:
+                    self.__tokens -= size
+                    return
+                # Woken up early when the rate changes, the wait is recalculated then.
+                self.__condition.wait(min((needed - self.__tokens) / self.__rate, self.__MAX_WAIT))
+
+    def __getCapacity(self):
+        return self.__rate * self.__burst if self.__rate else 0
+
+    def __refill(self):
+        now = time.monotonic()
+        if self.__rate:
+            self.__tokens = min(self.__getCapacity(), self.__tokens + (now - self.__updated) * self.__rate)
+        self.__updated = now
+
+
+class BandwidthLimiter(metaclass=Singleton):
+    # Caps the cloud transfers per direction, globally and per account. Data has to pass both the bucket of its
+    # account and the global one. Limits are in bytes per second and can be changed while transfers are running.
+
+    def __init__(self):
+        self.__globalBuckets = {direction: TokenBucket() for direction in TransferDirections}
+        self.__accountBuckets = {}
+        self.__lock = Lock()
+        self.__logger = moduleLogger.getChild("BandwidthLimiter")
+
+    def setGlobalLimit(self, direction, rate):
+        self.__globalBuckets[direction].setRate(rate)
+        self.__logger.info(f"Global {direction.value} limit set to {rate} B/s")
+
+    def setAccountLimit(self, accountID, direction, rate):
+        self.__getAccountBuckets(accountID)[direction].setRate(rate)
+        self.__logger.info(f"Account {accountID} {direction.value} limit set to {rate} B/s")
+
+    def getLimits(self):
+        with self.__lock:
+            accountBuckets = dict(self.__accountBuckets)
+        limits = {direction.value: bucket.rate for direction, bucket in self.__globalBuckets.items()}
+        limits["accounts"] = [
+            {"id": accountID, **{direction.value: bucket.rate for direction, bucket in buckets.items()}}
+            for accountID, buckets in accountBuckets.items()
+        ]
+
+        return limits
+
+    def throttle(self, accountID, direction, size, task=None):
+        self.__getAccountBuckets(accountID)[direction].consume(size, task)
+        self.__globalBuckets[direction].consume(size, task)
+
+    def __getAccountBuckets(self, accountID):
+        with self.__lock:
+            if accountID not in self.__accountBuckets:
+                self.__accountBuckets[accountID] = {direction: TokenBucket() for direction in TransferDirections}
+
+            return self.__accountBuckets[accountID]
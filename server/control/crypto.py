@@ -0,0 +1,158 @@
+import logging
+import multiprocessing
+
+from concurrent.futures import Future, ProcessPoolExecutor
+from multiprocessing import shared_memory
+from queue import Queue
+
+from Crypto.Cipher import AES
+from Crypto.Random import get_random_bytes
+
+from .abstract import Singleton
+
+
+moduleLogger = logging.getLogger(__name__)
+
+CRYPTO_CHUNK_SIZE = 1048576
+
+_attachedBlocks = {}
+
+
+def _cryptChunk(blockName, size, key, iv, decrypt):
+    # Runs in the worker processes. The chunk is encrypted or decrypted in place in its shared memory block.
+    block = _attachedBlocks.get(blockName)
+    if block is None:
+        block = _attachedBlocks[blockName] = shared_memory.SharedMemory(name=blockName)
+    view = block.buf[:size]
+    try:
+        cipher = AES.new(key, AES.MODE_CFB, iv=iv)
+        if decrypt:
+            cipher.decrypt(view, output=view)
+        else:
+            cipher.encrypt(view, output=view)
+    finally:
+        view.release()
+
+
+class CryptoService(metaclass=Singleton):
+    # Runs AES in a pool of processes, so the crypto of the transfers uses every core and overlaps with their network
+    # I/O. Chunks are passed in shared memory blocks instead of being pickled. Until the service is started, chunks are
+    # processed in the calling thread.
+
+    def __init__(self):
+        self.__executor = None
+        self.__chunkSize = CRYPTO_CHUNK_SIZE
+        self.__blocks = []
+        self.__freeBlocks = Queue()
+        self.__logger = moduleLogger.getChild("CryptoService")
+
+    def start(self, workerCount, chunkSize=CRYPTO_CHUNK_SIZE):
+        if workerCount < 1 or self.__executor:
+            return
+        self.__chunkSize = chunkSize
+        self.__executor = ProcessPoolExecutor(max_workers=workerCount, mp_context=multiprocessing.get_context("spawn"))
+        for _ in range(workerCount * 2):
+            block = shared_memory.SharedMemory(create=True, size=chunkSize)
+            self.__blocks.append(block)
+            self.__freeBlocks.put(block)
+        self.__logger.info(f"Started with {workerCount} processes")
+
+    def stop(self):
+        if self.__executor:
+            self.__executor.shutdown(cancel_futures=True)
+            self.__executor = None
+        for block in self.__blocks:
+            block.close()
+            block.unlink()
+        self.__blocks = []
+        self.__freeBlocks = Queue()
+
+    def encryptor(self, key, iv=None):
+        return ChunkEncryptor(self, key, iv or get_random_bytes(AES.block_size))
+
+    def decryptor(self, key, iv):
+        return ChunkDecryptor(self, key, iv)
+
+    def submit(self, key, iv, data, decrypt=False):
+        future = Future()
+        if self.__executor is None or len(data) > self.__chunkSize:
+            cipher = AES.new(key, AES.MODE_CFB, iv=iv)
+            future.set_result(cipher.decrypt(data) if decrypt else cipher.encrypt(data))
+            return future
+
+        block = self.__freeBlocks.get()
+        block.buf[:len(data)] = data
+        try:
+            poolFuture = self.__executor.submit(_cryptChunk, block.name, len(data), key, iv, decrypt)
+        except Exception:
+            self.__freeBlocks.put(block)
+            raise
+        poolFuture.add_done_callback(lambda done: self.__collect(done, block, len(data), future))
+
+        return future
+
+    def __collect(self, poolFuture, block, size, future):
+        try:
+            poolFuture.result()
+            future.set_result(bytes(block.buf[:size]))
+        except Exception as e:
+            future.set_exception(e)
+        finally:
+            self.__freeBlocks.put(block)
+
+
+class ChunkEncryptor():
+    # CFB feeds the ciphertext of every chunk into the next one, so a chunk is only submitted once the previous one is
+    # done. Reading one chunk ahead lets the next chunk be encrypted while the previous one is being sent.
+
+    def __init__(self, service, key, iv):
+        self.iv = iv
+        self.__service = service
+        self.__key = key
+        self.__feedback = iv
+        self.__previous = None
+
+    def submit(self, data):
+        if self.__previous:
+            self.__feedback = (self.__feedback + self.__previous.result())[-AES.block_size:]
+        self.__previous = self.__service.submit(self.__key, self.__feedback, data)
+
+        return self.__previous
+
+    def encryptChunks(self, fileHandle, chunkSizes, task=None):
+        # Nothing more is read or encrypted once the task goes stale.
+        pending = None
+        for chunkSize, remaining in chunkSizes:
+            if task and task.stale:
+                return
+            encrypted = self.submit(fileHandle.read(chunkSize))
+            if pending:
+                yield pending[0].result(), pending[1]
+            pending = (encrypted, remaining)
+        if pending:
+            yield pending[0].result(), pending[1]
+
+
+class ChunkDecryptor():
+    # The ciphertext is known upfront, so the chunks of a stream are decrypted at the same time and returned in order.
+
+    def __init__(self, service, key, iv):
+        self.__service = service
+        self.__key = key
+        self.__feedback = iv
+
+    def submit(self, data):
+        decrypted = self.__service.submit(self.__key, self.__feedback, data, decrypt=True)
+        self.__feedback = (self.__feedback + bytes(data[-AES.block_size:]))[-AES.block_size:]
+
+        return decrypted
+
+    def decryptChunks(self, chunks):
+        pending = None
+        for chunk in chunks:
+            decrypted = self.submit(chunk)
+            if pending:
+                yield pending.result()
+            pending = decrypted
+        if pending:
+            yield pending.result()
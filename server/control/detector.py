@@ -0,0 +1,56 @@
+import logging
+
+from threading import Event
+
+from .message import MessageDispatcher
+from control.account import CloudAPIFactory
+
+from model.message import NetworkMessage, MessageTypes
+from model.file import CloudFilesCache
+from model.task import TaskArchive
+
+
+moduleLogger = logging.getLogger(__name__)
+
+
+class RemoteChangeDetector():
+
+    def __init__(self, databaseAccess, pollInterval):
+        self.__databaseAccess = databaseAccess
+        self.__pollInterval = pollInterval
+        self.__stopEvent = Event()
+        self.__filesCache = CloudFilesCache()
+        self.__taskArchive = TaskArchive()
+        self.__messageDispatcher = MessageDispatcher()
+        self.__logger = moduleLogger.getChild("RemoteChangeDetector")
+
+    def start(self):
+        self.__logger.info(f"Polling cloud accounts for changes every {self.__pollInterval} seconds")
+        while not self.__stopEvent.wait(self.__pollInterval):
+            try:
+                self.poll()
+            except Exception as e:
+                self.__logger.error(f"Failed to poll cloud accounts for changes: {e}")
+        self.__databaseAccess.close()
+
+    def stop(self):
+        self.__logger.debug("Stopping")
+        self.__stopEvent.set()
+
+    def poll(self):
+        expectedVersion = self.__filesCache.version
+        fileParts = []
+        for accountData in self.__databaseAccess.getAllAccounts():
+            fileParts.extend(CloudAPIFactory.fromAccountData(accountData).getFileList())
+
+        # Files being uploaded may already be listed, their tasks put them in the cache once done.
+        changes = self.__filesCache.refresh(fileParts, expectedVersion, self.__taskArchive.getRunningKeys())
+        if changes is None:
+            self.__logger.debug("Files cache changed while polling, retrying on the next poll.")
+        elif expectedVersion == 0:
+            # The cache was never filled before, there is nothing to compare against.
+            self.__logger.debug("Files cache initialized from cloud accounts.")
+        elif not changes.isEmpty():
+            self.__logger.info(f"Remote changes detected: {len(changes.added)} added, {len(changes.removed)} removed, {len(changes.modified)} modified.")
+            message = NetworkMessage.Builder(MessageTypes.REMOTE_FILES_CHANGED).withRandomUUID().withData(changes.serialize()).build()
+            self.__messageDispatcher.dispatchToConnectedSessions(message)
@@ -0,0 +1,50 @@
+import socket
+
+import requests
+
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection
+
+
+POOL_CONNECTIONS = 4
+POOL_MAXSIZE = 16
+
+
+class PooledHTTPAdapter(HTTPAdapter):
+    # Keeps up to poolMaxSize idle connections per host, with TCP keep-alive on so idle connections are not dropped by
+    # middleboxes. Retries are left to the caller.
+    __SOCKET_OPTIONS = HTTPConnection.default_socket_options + [(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)]
+
+    def __init__(self, poolConnections=POOL_CONNECTIONS, poolMaxSize=POOL_MAXSIZE):
+        super().__init__(pool_connections=poolConnections, pool_maxsize=poolMaxSize, max_retries=0)
+
+    def init_poolmanager(self, *args, **kwargs):
+        kwargs.setdefault("socket_options", self.__SOCKET_OPTIONS)
+        super().init_poolmanager(*args, **kwargs)
+
+    def getStats(self):
+        # urllib3 counts the connections opened and the requests sent by the pool of every host.
+        connections = 0
+        sentRequests = 0
+        pools = self.poolmanager.pools
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is not None:
+                connections += pool.num_connections
+                sentRequests += pool.num_requests
+
+        return {"connections": connections, "requests": sentRequests, "reused": max(0, sentRequests - connections)}
+
+
+class PooledSession(requests.Session):
+    # A session whose connections are reused by every request sent through it, so the TLS handshakes of an account are
+    # amortized over its calls instead of being paid for every request.
+
+    def __init__(self, poolConnections=POOL_CONNECTIONS, poolMaxSize=POOL_MAXSIZE):
+        super().__init__()
+        self.__adapter = PooledHTTPAdapter(poolConnections, poolMaxSize)
+        self.mount("https://", self.__adapter)
+        self.mount("http://", self.__adapter)
+
+    def getConnectionStats(self):
+        return self.__adapter.getStats()
@@ -1,69 +1,281 @@
 import logging
 import re
 import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import replace
 from math import ceil
+from itertools import islice
 from queue import Queue
+from threading import Lock
 
 import control.cli
 from .abstract import Singleton
-from control.account import CloudAPIFactory
+from control.account import CloudAPIFactory, CloudAPIWrapperRegistry
 from control.util import chunkSizeGenerator
+from control.bandwidth import BandwidthLimiter, TransferDirections
+from control.stream import IncomingDataStream, OutgoingDataStream, SpooledDataStream, AssembledFile, DataStreamInterruptedError, DATA_CHUNK_SIZE
 
-from model.message import NetworkMessage, NetworkMessageHeader, MessageTypes
-from model.file import FileData, FileStatuses, CloudFilesCache
+from model.message import NetworkMessage, NetworkMessageHeader, NetworkMessageFormatError, MessageTypes, MessageChannels
+from model.file import FileData, FileStatuses, FileListChanges, CloudFilesCache
 from model.account import AccountData
-from model.task import TaskArchive, Task
+from model.task import TaskArchive, Task, PendingTaskQueue
 
 
 moduleLogger = logging.getLogger(__name__)
 
 
+class StatusUpdateCoalescer():
+
+    def __init__(self, window, maxBatchSize):
+        self.__window = window
+        self.__maxBatchSize = maxBatchSize
+        self.__batches = {}
+        self.__lock = Lock()
+
+    def add(self, sessionID, message):
+        with self.__lock:
+            deadline, messages = self.__batches.setdefault(sessionID, (time.monotonic() + self.__window, []))
+            messages.append(message)
+            if len(messages) < self.__maxBatchSize:
+                return None
+            del self.__batches[sessionID]
+        return self.__buildMessage(messages)
+
+    def take(self, sessionID):
+        with self.__lock:
+            deadline, messages = self.__batches.pop(sessionID, (None, None))
+        return self.__buildMessage(messages) if messages else None
+
+    def takeDue(self):
+        now = time.monotonic()
+        with self.__lock:
+            dueSessions = [sessionID for sessionID, (deadline, messages) in self.__batches.items() if deadline <= now]
+            dueBatches = [(sessionID, self.__batches.pop(sessionID)[1]) for sessionID in dueSessions]
+        return [(sessionID, self.__buildMessage(messages)) for sessionID, messages in dueBatches]
+
+    def timeUntilNextFlush(self):
+        with self.__lock:
+            if not self.__batches:
+                return None
+            nextDeadline = min(deadline for deadline, messages in self.__batches.values())
+        return max(0.0, nextDeadline - time.monotonic())
+
+    def __buildMessage(self, messages):
+        if len(messages) == 1:
+            return messages[0]
+        updates = [{"uuid": message.header.uuid, "data": message.data} for message in messages]
+
+        return NetworkMessage.Builder(MessageTypes.FILE_STATUS_UPDATE_BATCH).withRandomUUID().withData({"updates": updates}).build()
+
+
 class MessageDispatcher(metaclass=Singleton):
 
     __INSTANT_TASK_TYPES = [
         MessageTypes.GET_ACCOUNT_LIST, MessageTypes.SET_ACCOUNT_LIST,
         MessageTypes.SYNC_FILES, MessageTypes.GET_WORKSPACE,
         MessageTypes.MOVE_FILE, MessageTypes.DELETE_FILE,
+        MessageTypes.SET_BANDWIDTH_LIMITS,
     ]
     __SLOW_TASK_TYPES = [MessageTypes.UPLOAD_FILE, MessageTypes.DOWNLOAD_FILE]
+    __BATCHABLE_TASK_TYPES = [
+        MessageTypes.UPLOAD_FILE, MessageTypes.DOWNLOAD_FILE,
+        MessageTypes.MOVE_FILE, MessageTypes.DELETE_FILE,
+        MessageTypes.FILE_TASK_CANCELLED
+    ]
+    MAX_BATCH_SIZE = 1000
+    __STATUS_UPDATE_WINDOW = 0.05
+    __STATUS_UPDATE_BATCH_SIZE = 256
 
     def __init__(self):
         self.incoming_instant_task_queue = Queue()
-        self.incoming_task_queue = Queue()
+        self.incoming_task_queue = PendingTaskQueue(lambda task: task.data["fullPath"])
         self.outgoing_message_queue = Queue()
 
         self._logger = moduleLogger.getChild("MessageDispatcher")
         self.__longFileTaskArchive = TaskArchive()
+        self.__outgoingMessageListener = None
+        self.__sessions = {}
+        self.__sessionsLock = Lock()
+        self.__dataStreams = {}
+        self.__dataStreamsLock = Lock()
+        self.__statusUpdates = StatusUpdateCoalescer(self.__STATUS_UPDATE_WINDOW, self.__STATUS_UPDATE_BATCH_SIZE)
+
+    def setOutgoingMessageListener(self, listener):
+        self.__outgoingMessageListener = listener
+
+    def registerSession(self, session):
+        with self.__sessionsLock:
+            self.__sessions[session.id] = session
+
+    def unregisterSession(self, sessionID):
+        with self.__sessionsLock:
+            self.__sessions.pop(sessionID, None)
+        self.__statusUpdates.take(sessionID)
+        with self.__dataStreamsLock:
+            sessionStreams = [uuid for uuid, stream in self.__dataStreams.items() if stream.sessionID == sessionID]
+        for uuid in sessionStreams:
+            self.closeDataStream(uuid)
+
+    def dispatchIncomingMessage(self, message, sessionID=None):
+        if message.header.messageType == MessageTypes.BATCH:
+            self.__dispatchBatch(message, sessionID)
+        elif message.header.messageType in [MessageTypes.FILE_DATA, MessageTypes.FILE_DATA_ACK]:
+            self.__dispatchStreamMessage(message, sessionID)
+        elif not self.__dispatchRequest(message.header.messageType, message.header.uuid, message.data, sessionID):
+            self._logger.warning(f"Unknown message: {message}")
+
+    def __dispatchBatch(self, message, sessionID):
+        items = message.data.get("items", []) if type(message.data) == dict else []
+        results = []
+        for index, item in enumerate(items):
+            uuid = item.get("uuid", None) if type(item) == dict else None
+            try:
+                if index >= self.MAX_BATCH_SIZE:
+                    raise NetworkMessageFormatError(f"Batch exceeds the maximum size of {self.MAX_BATCH_SIZE} items!")
+                header = NetworkMessageHeader({"messageType": item["messageType"], "uuid": uuid})
+                if header.messageType not in self.__BATCHABLE_TASK_TYPES:
+                    raise NetworkMessageFormatError(f"Message type {header.messageType.name} can not be batched!")
+                self.__dispatchRequest(header.messageType, header.uuid, item.get("data", None), sessionID)
+                results.append({"uuid": uuid, "accepted": True})
+            except (NetworkMessageFormatError, KeyError, TypeError, ValueError) as e:
+                self._logger.warning(f"Rejected batch item {uuid}: {e}")
+                results.append({"uuid": uuid, "accepted": False, "error": str(e)})
+
+        response = NetworkMessage.Builder(MessageTypes.RESPONSE).withUUID(message.header.uuid).withData({"results": results}).build()
+        self.dispatchResponse(response, sessionID)
+
+    def __dispatchStreamMessage(self, message, sessionID):
+        with self.__dataStreamsLock:
+            stream = self.__dataStreams.get(message.header.uuid, None)
+        if stream is None or stream.sessionID != sessionID:
+            self._logger.debug(f"No open stream for {message.header.messageType.name} {message.header.uuid}, dropping it.")
+        elif message.header.messageType == MessageTypes.FILE_DATA and type(stream) == IncomingDataStream:
+            stream.feed(message.data["offset"], message.data["data"], message.data["last"])
+        elif message.header.messageType == MessageTypes.FILE_DATA_ACK and type(stream) == OutgoingDataStream:
+            stream.acknowledge(message.data["offset"], message.data.get("resume", False), message.data.get("complete", False))
+        else:
+            self._logger.warning(f"Unexpected {message.header.messageType.name} for stream {message.header.uuid}")
+
+    def openIncomingDataStream(self, task):
+        stream = IncomingDataStream(task, lambda message: self.dispatchResponse(message, task.sessionID))
+        with self.__dataStreamsLock:
+            self.__dataStreams[task.uuid] = stream
+        stream.start()
 
-    def dispatchIncomingMessage(self, message):
-        messageType = message.header.messageType
-        task = Task(taskType=messageType, stale=False, uuid=message.header.uuid, data=message.data)
+        return stream
+
+    def openOutgoingDataStream(self, task):
+        stream = OutgoingDataStream(task, lambda message: self.dispatchResponse(message, task.sessionID))
+        with self.__dataStreamsLock:
+            self.__dataStreams[task.uuid] = stream
+
+        return stream
+
+    def resumeDataStreams(self, sessionID):
+        with self.__dataStreamsLock:
+            sessionStreams = [stream for stream in self.__dataStreams.values() if stream.sessionID == sessionID and type(stream) == IncomingDataStream]
+        for stream in sessionStreams:
+            stream.resume()
+
+    def closeDataStream(self, uuid):
+        with self.__dataStreamsLock:
+            stream = self.__dataStreams.pop(uuid, None)
+        if stream:
+            stream.close()
+
+    def __dispatchRequest(self, messageType, uuid, data, sessionID):
+        task = Task(taskType=messageType, stale=False, uuid=uuid, data=data, sessionID=sessionID)
 
         if messageType in self.__INSTANT_TASK_TYPES:
             if messageType == MessageTypes.DELETE_FILE:
-                path = message.data["fullPath"]
+                path = data["fullPath"]
+                self.incoming_task_queue.discard(path)
                 self.__longFileTaskArchive.cancelTask(path)
                 self.__longFileTaskArchive.removeTask(path)
             elif messageType == MessageTypes.MOVE_FILE:
-                self.__longFileTaskArchive.cancelTask(message.data["source"])
-                self.__longFileTaskArchive.cancelTask(message.data["target"]["fullPath"])
+                self.incoming_task_queue.discard(data["source"])
+                self.incoming_task_queue.discard(data["target"]["fullPath"])
+                self.__longFileTaskArchive.cancelTask(data["source"])
+                self.__longFileTaskArchive.cancelTask(data["target"]["fullPath"])
 
-                self.__longFileTaskArchive.removeTask(message.data["source"])
-                self.__longFileTaskArchive.removeTask(message.data["target"]["fullPath"])
+                self.__longFileTaskArchive.removeTask(data["source"])
+                self.__longFileTaskArchive.removeTask(data["target"]["fullPath"])
             self.incoming_instant_task_queue.put(task)
         elif messageType in self.__SLOW_TASK_TYPES:
             key = task.data["fullPath"]
             self.__longFileTaskArchive.addTask(key, task)
             self.incoming_task_queue.put(task)
         elif messageType == MessageTypes.FILE_TASK_CANCELLED:
-            self._logger.debug(f"Cancelling task for file: {message.data['fullPath']}")
-            self.__longFileTaskArchive.cancelTask(message.data["fullPath"])
-            self.__longFileTaskArchive.removeTask(message.data["fullPath"])
+            self._logger.debug(f"Cancelling task for file: {data['fullPath']}")
+            self.incoming_task_queue.discard(data["fullPath"])
+            self.__longFileTaskArchive.cancelTask(data["fullPath"])
+            self.__longFileTaskArchive.removeTask(data["fullPath"])
         else:
-            self._logger.warning(f"Unknown message: {message}")
-
-    def dispatchResponse(self, message):
-        self.outgoing_message_queue.put(message)
+            return False
+        return True
+
+    def dispatchResponse(self, message, sessionID=None):
+        if message.header.messageType == MessageTypes.FILE_STATUS_UPDATE:
+            batch = self.__statusUpdates.add(sessionID, message)
+            if batch:
+                self.__routeMessage(batch, sessionID)
+        else:
+            # Pending status updates are routed first, so they are not held back behind later bulk messages.
+            batch = self.__statusUpdates.take(sessionID)
+            if batch:
+                self.__routeMessage(batch, sessionID)
+            self.__routeMessage(message, sessionID)
+        if self.__outgoingMessageListener:
+            self.__outgoingMessageListener()
+
+    def dispatchPagedResponse(self, pages, sessionID):
+        # Dispatches the messages of pages one by one. The next one is only produced once the session has written the
+        # previous one, from the server loop, so a handler sending many messages neither waits for its client nor gets
+        # them all queued up at once. Sessions that can't tell get the rest right away, closed ones get nothing more.
+        for message in pages:
+            with self.__sessionsLock:
+                session = self.__sessions.get(sessionID)
+            if session is None:
+                self._logger.info(f"Session {sessionID} is gone, dropping the rest of the paged response {message.header.uuid}")
+                return
+            whenWritten = getattr(session, "whenWritten", None)
+            if whenWritten:
+                if not whenWritten(message, lambda: self.dispatchPagedResponse(pages, sessionID)):
+                    return
+                self.dispatchResponse(message, sessionID)
+                return
+            self.dispatchResponse(message, sessionID)
+
+    def dispatchToConnectedSessions(self, message, exceptSessionID=None):
+        # Unlike broadcasts, these are not kept for clients that connect later.
+        with self.__sessionsLock:
+            sessions = [session for sessionID, session in self.__sessions.items() if sessionID != exceptSessionID]
+        for session in sessions:
+            session.outgoingQueue.put(message)
+        if sessions and self.__outgoingMessageListener:
+            self.__outgoingMessageListener()
+
+    def flushStatusUpdates(self):
+        dueBatches = self.__statusUpdates.takeDue()
+        for sessionID, batch in dueBatches:
+            self.__routeMessage(batch, sessionID)
+
+        return len(dueBatches) > 0
+
+    def timeUntilStatusUpdateFlush(self):
+        return self.__statusUpdates.timeUntilNextFlush()
+
+    def __routeMessage(self, message, sessionID):
+        if sessionID is None:
+            self.outgoing_message_queue.put(message)
+        else:
+            with self.__sessionsLock:
+                session = self.__sessions.get(sessionID)
+            if session:
+                session.outgoingQueue.put(message)
+            else:
+                self._logger.info(f"Session {sessionID} is gone, dropping message: {message.header.messageType.name}")
 
 
 class AbstractTaskHandler():
@@ -82,6 +294,12 @@ class AbstractTaskHandler():
     def setTask(self, task):
         self._task = task
 
+    def _notifyOtherSessions(self, changes):
+        # Changes made on the request of a client reach the other clients right away, not on the next poll.
+        if not changes.isEmpty():
+            message = NetworkMessage.Builder(MessageTypes.REMOTE_FILES_CHANGED).withRandomUUID().withData(changes.serialize()).build()
+            self._messageDispatcher.dispatchToConnectedSessions(message, self._task.sessionID)
+
 
 class GetAccountsListHandler(AbstractTaskHandler):
 
@@ -92,7 +310,7 @@ class GetAccountsListHandler(AbstractTaskHandler):
         data = {"accounts": [acc.serialize() for acc in self._databaseAccess.getAllAccounts()]}
 
         response = NetworkMessage.Builder(MessageTypes.RESPONSE).withUUID(self._task.uuid).withData(data).build()
-        self._messageDispatcher.dispatchResponse(response)
+        self._messageDispatcher.dispatchResponse(response, self._task.sessionID)
         self._task = None
 
 
@@ -103,30 +321,80 @@ class SetAccountListHandler(AbstractTaskHandler):
 
     def handle(self):
         self._logger.debug("Updating account list")
-        currentAccounts = {acc.id: acc.identifier for acc in self._databaseAccess.getAllAccounts()}
+        currentAccounts = {acc.id: acc for acc in self._databaseAccess.getAllAccounts()}
         newAccounts = [AccountData(id=raw.get('id', None), identifier=raw['identifier'], accountType=raw['accountType'], cryptoKey=raw['cryptoKey'], data=raw['data']) for raw in self._task.data['accounts']]
         newAccountIDs = [acc.id for acc in newAccounts]
 
-        for accID, accName in currentAccounts.items():
+        for accID, account in currentAccounts.items():
             if accID not in newAccountIDs:
-                self._logger.debug(f"Deleting account: {accName}(ID: {accID})")
+                self._logger.debug(f"Deleting account: {account.identifier}(ID: {accID})")
                 self._databaseAccess.deleteAccount(accID)
 
         for account in newAccounts:
             self._databaseAccess.createOrUpdateAccount(account)
 
         self._databaseAccess.commit()
+
+        # Wrappers built from the old data of the deleted and changed accounts are not used again.
+        wrapperRegistry = CloudAPIWrapperRegistry()
+        newAccountsByID = {acc.id: acc for acc in newAccounts}
+        accountsChanged = any(acc.id not in currentAccounts for acc in newAccounts)
+        for accID, account in currentAccounts.items():
+            if newAccountsByID.get(accID) != account:
+                wrapperRegistry.invalidate(accID)
+                accountsChanged = True
+        if accountsChanged:
+            # Files that come or go with the accounts are not reported to the clients as remote changes.
+            self._filesCache.accountsChanged()
         self._logger.debug("Accounts updated")
 
         response = NetworkMessage.Builder(MessageTypes.RESPONSE).withUUID(self._task.uuid).build()
-        self._messageDispatcher.dispatchResponse(response)
+        self._messageDispatcher.dispatchResponse(response, self._task.sessionID)
+
+
+class SetBandwidthLimitsHandler(AbstractTaskHandler):
+    # Only the limits present in the request are changed, 0 or None lifts a limit. The response holds every limit in
+    # effect, so an empty request can be used to query them.
+
+    def _getLogger(self):
+        return moduleLogger.getChild("SetBandwidthLimitsHandler")
+
+    def handle(self):
+        data = self._task.data or {}
+        responseData = {}
+        try:
+            changes = [(None, direction, self.__toRate(data[direction.value])) for direction in TransferDirections if direction.value in data]
+            for account in data.get("accounts", []):
+                changes.extend((account["id"], direction, self.__toRate(account[direction.value])) for direction in TransferDirections if direction.value in account)
+        except (KeyError, TypeError, ValueError, AttributeError) as e:
+            self._logger.warning(f"Invalid bandwidth limits: {e}")
+            responseData["error"] = f"Invalid bandwidth limits: {e}"
+            changes = []
+
+        limiter = BandwidthLimiter()
+        for accountID, direction, rate in changes:
+            if accountID is None:
+                limiter.setGlobalLimit(direction, rate)
+            else:
+                limiter.setAccountLimit(accountID, direction, rate)
+
+        responseData.update(limiter.getLimits())
+        response = NetworkMessage.Builder(MessageTypes.RESPONSE).withUUID(self._task.uuid).withData(responseData).build()
+        self._messageDispatcher.dispatchResponse(response, self._task.sessionID)
+        self._task = None
+
+    def __toRate(self, value):
+        if value is None or value == 0:
+            return None
+        if type(value) != int or value < 0:
+            raise ValueError(f"limit must be a positive integer of bytes per second, received {value!r}")
+        return value
 
 
 class GetFileListHandler(AbstractTaskHandler):
 
     def __init__(self, *args):
         super().__init__(*args)
-        self.__cloudAccounts = [CloudAPIFactory.fromAccountData(accData) for accData in self._databaseAccess.getAllAccounts()]
         self.__totalCountPattern = "__[0-9]+"
         self._filesCache = CloudFilesCache()
 
@@ -137,17 +405,21 @@ class GetFileListHandler(AbstractTaskHandler):
         self._logger.debug("Retrieving file list")
 
         self._filesCache.clearData()
-        for account in self.__cloudAccounts:
-            self.__processAccountFiles(account.getFileList())
+        for accountData in self._databaseAccess.getAllAccounts():
+            self.__processAccountFiles(CloudAPIFactory.fromAccountData(accountData).getFileList())
 
-        fullFiles = self._filesCache.getFullFiles()
         incompleteFiles = self._filesCache.getIncompleteFiles()
-        self._logger.debug(f"Found the following full files: {fullFiles}")
         if incompleteFiles:
             incompleteFilesMessage = "\n".join([f"{cachedFile.data.fullPath} (missing part count: {cachedFile.totalPartCount - cachedFile.availablePartCount})" for cachedFile in incompleteFiles])
             self._logger.warning(f"The following files have missing parts:\n{incompleteFilesMessage}")
 
-        self.__sendResponse(fullFiles)
+        pageSize = (self._task.data or {}).get("pageSize", None)
+        if pageSize:
+            self.__sendPages(pageSize)
+        else:
+            fullFiles = self._filesCache.getFullFiles()
+            self._logger.debug(f"Found the following full files: {fullFiles}")
+            self.__sendResponse(fullFiles)
         self._task = None
 
     def __processAccountFiles(self, fileParts):
@@ -155,8 +427,29 @@ class GetFileListHandler(AbstractTaskHandler):
             self._filesCache.insertFilePart(filePart)
 
     def __sendResponse(self, fullFiles):
-        response = NetworkMessage.Builder(MessageTypes.RESPONSE).withUUID(self._task.uuid).withData(fullFiles).build()
-        self._messageDispatcher.dispatchResponse(response)
+        response = NetworkMessage.Builder(MessageTypes.RESPONSE).withUUID(self._task.uuid).withData(fullFiles).withChannel(MessageChannels.BULK).build()
+        self._messageDispatcher.dispatchResponse(response, self._task.sessionID)
+
+    def __sendPages(self, pageSize):
+        self._messageDispatcher.dispatchPagedResponse(self.__pages(self._task.uuid, pageSize), self._task.sessionID)
+
+    def __pages(self, uuid, pageSize):
+        # Every page but the last one is a PARTIAL_RESPONSE, the last one is the RESPONSE that ends the request.
+        # All of them go on the bulk channel, so the last page can't overtake the others.
+        fullFiles = self._filesCache.iterateFullFiles()
+        continuationToken = 0
+        page = list(islice(fullFiles, pageSize))
+        while True:
+            nextFile = next(fullFiles, None)
+            isLast = nextFile is None
+            messageType = MessageTypes.RESPONSE if isLast else MessageTypes.PARTIAL_RESPONSE
+            data = {"files": page, "continuationToken": continuationToken, "last": isLast}
+            yield NetworkMessage.Builder(messageType).withUUID(uuid).withData(data).withChannel(MessageChannels.BULK).build()
+            if isLast:
+                break
+            page = [nextFile] + list(islice(fullFiles, pageSize - 1))
+            continuationToken += 1
+        self._logger.debug(f"File list sent in {continuationToken + 1} pages")
 
 
 class GetWorkspaceHandler(AbstractTaskHandler):
@@ -168,7 +461,7 @@ class GetWorkspaceHandler(AbstractTaskHandler):
         data = {"workspace": control.cli.CONSOLE_ARGUMENTS.workspace}
 
         response = NetworkMessage.Builder(MessageTypes.RESPONSE).withUUID(self._task.uuid).withData(data).build()
-        self._messageDispatcher.dispatchResponse(response)
+        self._messageDispatcher.dispatchResponse(response, self._task.sessionID)
         self._task = None
 
 
@@ -181,23 +474,59 @@ class UploadFileHandler(AbstractTaskHandler):
         accounts = self._databaseAccess.getAllAccounts()
 
         perAccountSize = ceil(self._task.data["size"] / len(accounts))
-        localFilePath = f"{control.cli.CONSOLE_ARGUMENTS.workspace}/server/{self._task.uuid}"
         cachedFile = self._filesCache.getFile(self._task.data["fullPath"])
 
-        with open(localFilePath, "rb") as localFileHandle:
-            if len(accounts) == 1 or perAccountSize <= 1.0:
-                self._logger.info(f"Uploading to single account only: {self._task.data['fullPath']}")
+        if self._task.data.get("streamed", False):
+            # The file data arrives in FILE_DATA messages over the session instead of a staging file.
+            dataStream = self._messageDispatcher.openIncomingDataStream(self._task)
+            try:
+                if self.__isSplit(accounts, perAccountSize):
+                    # The parts are read at their own offsets, the stream is copied into a file the parts can read as it grows.
+                    spool = SpooledDataStream(dataStream, self.__getLocalFilePath())
+                    spool.start()
+                    try:
+                        self.__uploadToAllAccounts(accounts, perAccountSize, spool.openPart, cachedFile)
+                    finally:
+                        spool.close()
+                else:
+                    self.__uploadToFirstAccountOnly(accounts[0], dataStream, cachedFile)
+            except DataStreamInterruptedError as e:
+                self._logger.info(f"Upload stream interrupted: {e}")
+                self._task.stale = True
+            finally:
+                self._messageDispatcher.closeDataStream(self._task.uuid)
+        elif self.__isSplit(accounts, perAccountSize):
+            localFilePath = self.__getLocalFilePath()
+            self.__uploadToAllAccounts(accounts, perAccountSize, lambda offset: self.__openPart(localFilePath, offset), cachedFile)
+            self.__cleanUp(localFilePath)
+        else:
+            localFilePath = self.__getLocalFilePath()
+            with open(localFilePath, "rb") as localFileHandle:
                 self.__uploadToFirstAccountOnly(accounts[0], localFileHandle, cachedFile)
-            else:
-                self.__uploadToAllAccounts(accounts, perAccountSize, localFileHandle, cachedFile)
+            self.__cleanUp(localFilePath)
 
-        self.__cleanUp(localFilePath)
         if not self._task.stale:
             self.__sendResponse()
+            self.__notifyOtherSessions(cachedFile)
         else:
             self._logger.info(f"Task '{self._task}' cancelled, not sending response.")
         self._task = None
 
+    def __getLocalFilePath(self):
+        return f"{control.cli.CONSOLE_ARGUMENTS.workspace}/server/{self._task.uuid}"
+
+    def __isSplit(self, accounts, perAccountSize):
+        if len(accounts) == 1 or perAccountSize <= 1.0:
+            self._logger.info(f"Uploading to single account only: {self._task.data['fullPath']}")
+            return False
+        return True
+
+    def __openPart(self, localFilePath, offset):
+        handle = open(localFilePath, "rb")
+        handle.seek(offset)
+
+        return handle
+
     def __cleanUp(self, localFilePath):
         os.unlink(localFilePath)
 
@@ -205,7 +534,14 @@ class UploadFileHandler(AbstractTaskHandler):
         if not self._task.stale:
             data = {"fullPath": self._task.data["fullPath"], "filename": self._task.data["filename"], "modified": self._task.data["utcModified"], "size": self._task.data["size"], "path": self._task.data["path"], "status": FileStatuses.SYNCED}
             response = NetworkMessage.Builder(MessageTypes.FILE_STATUS_UPDATE).withData(data).withRandomUUID().build()
-            self._messageDispatcher.dispatchResponse(response)
+            self._messageDispatcher.dispatchResponse(response, self._task.sessionID)
+
+    def __notifyOtherSessions(self, replacedFile):
+        uploadedFile = FileData(self._task.data["filename"], self._task.data["utcModified"], self._task.data["size"], self._task.data["path"], self._task.data["fullPath"])
+        if replacedFile:
+            self._notifyOtherSessions(FileListChanges(modified=[uploadedFile]))
+        else:
+            self._notifyOtherSessions(FileListChanges(added=[uploadedFile]))
 
     def __cleanFromRemote(self, cachedFile):
         storedParts = {partInfo.storingAccountID: partInfo for partName, partInfo in cachedFile.parts.items()}
@@ -225,21 +561,47 @@ class UploadFileHandler(AbstractTaskHandler):
             if result:
                 self.__updateFilesCache(result)
 
-    def __uploadToAllAccounts(self, accounts, perAccountSize, fileHandle, cachedFile):
-        if not self._task.stale:
-            if cachedFile:
-                self.__cleanFromRemote(cachedFile)
-                self._filesCache.removeFile(cachedFile.data.fullPath)
+    def __uploadToAllAccounts(self, accounts, perAccountSize, openPart, cachedFile):
+        # Every part is uploaded at the same time from its own handle, so the bandwidth of the accounts adds up.
+        if self._task.stale:
+            return
+        if cachedFile:
+            self.__cleanFromRemote(cachedFile)
+            self._filesCache.removeFile(cachedFile.data.fullPath)
 
         totalCount = len(accounts)
+        parts, offset = [], 0
         for account, partIndex, toUploadChunkInfo in zip(accounts, range(totalCount), chunkSizeGenerator(self._task.data["size"], perAccountSize)):
-            if not self._task.stale:
-                cloudAccount = CloudAPIFactory.fromAccountData(account)
-                cloudFileName = f"{self._task.data['filename']}__{partIndex + 1}__{totalCount}.enc"
-                result = cloudAccount.upload(fileHandle, toUploadChunkInfo[0], cloudFileName, self._task)
+            cloudFileName = f"{self._task.data['filename']}__{partIndex + 1}__{totalCount}.enc"
+            parts.append((CloudAPIFactory.fromAccountData(account), openPart(offset), toUploadChunkInfo[0], cloudFileName))
+            offset += toUploadChunkInfo[0]
+
+        try:
+            with ThreadPoolExecutor(max_workers=len(parts), thread_name_prefix="PartUpload") as executor:
+                results = list(executor.map(lambda part: self.__uploadPart(*part), parts))
+        finally:
+            for cloudAccount, partHandle, partSize, cloudFileName in parts:
+                partHandle.close()
+
+        if self._task.stale or not all(results):
+            self._logger.info(f"Upload of {self._task.data['fullPath']} did not complete, removing its uploaded parts.")
+            self._task.stale = True
+            for (cloudAccount, partHandle, partSize, cloudFileName), result in zip(parts, results):
                 if result:
-                    self._logger.debug(f"Updating cache with result: {result}")
-                    self.__updateFilesCache(result)
+                    cloudAccount.deleteFile(result)
+        else:
+            for result in results:
+                self._logger.debug(f"Updating cache with result: {result}")
+                self.__updateFilesCache(result)
+
+    def __uploadPart(self, cloudAccount, partHandle, partSize, cloudFileName):
+        try:
+            return cloudAccount.upload(partHandle, partSize, cloudFileName, self._task)
+        except Exception as e:
+            # The other parts are stopped as well, the file is only complete with all of them.
+            self._logger.error(f"Uploading part {cloudFileName} failed: {e}")
+            self._task.stale = True
+            return None
 
     def __updateFilesCache(self, resultingFilePart):
         self._logger.debug(f"Updating file cache with a new file: {resultingFilePart.fullPath}")
@@ -256,8 +618,6 @@ class DownloadFileHandler(AbstractTaskHandler):
         return moduleLogger.getChild("DownloadFileHandler")
 
     def handle(self):
-        localFilePath = f"{control.cli.CONSOLE_ARGUMENTS.workspace}/server/{self._task.uuid}"
-        targetFilePath = f"{control.cli.CONSOLE_ARGUMENTS.workspace}/client/{self._task.uuid}"
         cachedFileInfo = self._filesCache.getFile(self._task.data["fullPath"])
         parts = [part for key, part in cachedFileInfo.parts.items()]
         parts.sort(key=lambda part: part.filename)
@@ -266,15 +626,84 @@ class DownloadFileHandler(AbstractTaskHandler):
         self._logger.debug(f"Downloading file '{cachedFileInfo.data.fullPath}' from accounts: {[acc.identifier for key, acc in storingAccounts.items()]}")
         self._logger.debug(f"Sorted parts: {parts}")
 
-        with open(localFilePath, "wb") as outputFileHandle:
-            for part in parts:
-                cloudAccount = CloudAPIFactory.fromAccountData(storingAccounts[part.storingAccountID])
-                self._logger.debug(f"Downloading part {part.filename} from {cloudAccount.accountData.identifier}")
-                cloudAccount.download(outputFileHandle, part, self._task)
-        self._logger.debug("Download finished, moving file to client workspace...")
-        self.__finalizeDownload(localFilePath, targetFilePath)
+        if self._task.data.get("streamed", False):
+            # The parts are sent straight to the client in FILE_DATA messages instead of a staging file.
+            dataStream = self._messageDispatcher.openOutgoingDataStream(self._task)
+            try:
+                if len(parts) == 1:
+                    self.__downloadPart(storingAccounts[parts[0].storingAccountID], parts[0], dataStream)
+                else:
+                    localFilePath = self.__getLocalFilePath()
+                    try:
+                        self.__downloadParts(parts, storingAccounts, localFilePath, lambda assembledFile: self.__sendAssembledFile(assembledFile, dataStream))
+                    finally:
+                        os.remove(localFilePath)
+            except DataStreamInterruptedError as e:
+                self._logger.info(f"Download stream interrupted: {e}")
+                self._task.stale = True
+            dataStream.finish(aborted=self._task.stale)
+            if not self._task.stale:
+                try:
+                    dataStream.waitUntilComplete()
+                except DataStreamInterruptedError as e:
+                    self._logger.info(f"Download stream interrupted before the client confirmed it: {e}")
+                    self._task.stale = True
+            self._messageDispatcher.closeDataStream(self._task.uuid)
+            if not self._task.stale:
+                self.__sendResponse()
+        else:
+            localFilePath = self.__getLocalFilePath()
+            targetFilePath = f"{control.cli.CONSOLE_ARGUMENTS.workspace}/client/{self._task.uuid}"
+            self.__downloadParts(parts, storingAccounts, localFilePath)
+            self._logger.debug("Download finished, moving file to client workspace...")
+            self.__finalizeDownload(localFilePath, targetFilePath)
         self._task = None
 
+    def __getLocalFilePath(self):
+        return f"{control.cli.CONSOLE_ARGUMENTS.workspace}/server/{self._task.uuid}"
+
+    def __downloadParts(self, parts, storingAccounts, localFilePath, consume=None):
+        # Every part is fetched from its own account at the same time and written at its offset in the preallocated
+        # file. A failing part marks the task stale, which stops the other parts as well.
+        assembledFile = AssembledFile(localFilePath, [part.size - 16 for part in parts])
+        try:
+            with ThreadPoolExecutor(max_workers=len(parts), thread_name_prefix=f"Download-{self._task.uuid[:8]}") as executor:
+                for index, part in enumerate(parts):
+                    executor.submit(self.__downloadAssembledPart, storingAccounts[part.storingAccountID], part, assembledFile.openPart(index))
+                if consume:
+                    try:
+                        consume(assembledFile)
+                    except DataStreamInterruptedError:
+                        self._task.stale = True
+                        raise
+            if not assembledFile.isComplete():
+                self._task.stale = True
+        finally:
+            assembledFile.close()
+
+    def __downloadPart(self, accountData, part, outputFileHandle):
+        try:
+            cloudAccount = CloudAPIFactory.fromAccountData(accountData)
+            self._logger.debug(f"Downloading part {part.filename} from {cloudAccount.accountData.identifier}")
+            cloudAccount.download(outputFileHandle, part, self._task)
+        except DataStreamInterruptedError:
+            raise
+        except Exception as e:
+            self._logger.error(f"Failed to download part {part.filename}: {e}")
+            self._task.stale = True
+
+    def __downloadAssembledPart(self, accountData, part, partWriter):
+        with partWriter:
+            self.__downloadPart(accountData, part, partWriter)
+
+    def __sendAssembledFile(self, assembledFile, dataStream):
+        position = 0
+        data = assembledFile.read(position, DATA_CHUNK_SIZE)
+        while data and not self._task.stale:
+            dataStream.write(data)
+            position += len(data)
+            data = assembledFile.read(position, DATA_CHUNK_SIZE)
+
     def __finalizeDownload(self, localPath, targetPath):
         if not self._task.stale:
             os.rename(localPath, targetPath)
@@ -283,11 +712,11 @@ class DownloadFileHandler(AbstractTaskHandler):
             os.remove(localPath)
 
     def __sendResponse(self):
-        data = self._task.data
+        data = {key: value for key, value in self._task.data.items() if key != "streamed"}
         data["status"] = FileStatuses.DOWNLOADING_TO_LOCAL
 
         response = NetworkMessage.Builder(MessageTypes.FILE_STATUS_UPDATE).withData(data).withUUID(self._task.uuid).build()
-        self._messageDispatcher.dispatchResponse(response)
+        self._messageDispatcher.dispatchResponse(response, self._task.sessionID)
 
 
 class DeleteFileHandler(AbstractTaskHandler):
@@ -302,6 +731,7 @@ class DeleteFileHandler(AbstractTaskHandler):
                 cloudAccount = CloudAPIFactory.fromAccountData(dbAccounts[part.storingAccountID])
                 cloudAccount.deleteFile(part)
             self._filesCache.removeFile(toDeletePath)
+            self._notifyOtherSessions(FileListChanges(removed=[cachedFileInfo.data]))
 
     def _getLogger(self):
         return moduleLogger.getChild("DeleteFileHandler")
@@ -323,19 +753,24 @@ class MoveFileHandler(AbstractTaskHandler):
 
         targetFileData = self._task.data["target"]
         cachedSourceFile = self._filesCache.getFile(self._task.data["source"])
+        changes = FileListChanges(removed=[cachedTargetFile.data] if cachedTargetFile else [])
         responseData = None
 
         # if sourcePath is synced, simple move and respond with moved, else delete sourcePath and respond with reupload.
         if self.__isSourceSynced(cachedSourceFile, targetFileData):
+            changes.removed.append(replace(cachedSourceFile.data))
             self.__moveFile(cachedSourceFile, targetFileData)
+            changes.added.append(cachedSourceFile.data)
             responseData = {"moveSuccessful": True, "from": self._task.data["source"], "to": targetFileData["fullPath"]}
         else:
             if cachedSourceFile:
                 self.__cleanFromRemote(cachedSourceFile)
                 self._filesCache.removeFile(cachedSourceFile.data.fullPath)
+                changes.removed.append(cachedSourceFile.data)
             responseData = {"moveSuccessful": False, "from": self._task.data["source"], "to": targetFileData["fullPath"]}
         response = NetworkMessage.Builder(MessageTypes.RESPONSE).withUUID(self._task.uuid).withData(responseData).build()
-        self._messageDispatcher.dispatchResponse(response)
+        self._messageDispatcher.dispatchResponse(response, self._task.sessionID)
+        self._notifyOtherSessions(changes)
         self._task = None
 
     def _getLogger(self):
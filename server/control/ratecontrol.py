@@ -0,0 +1,166 @@
+import logging
+import random
+import time
+
+from email.utils import parsedate_to_datetime
+from datetime import datetime, timezone
+from threading import Condition, Lock
+
+from .abstract import Singleton
+from .bandwidth import TokenBucket
+
+
+moduleLogger = logging.getLogger(__name__)
+
+
+class ProviderThrottledError(Exception):
+
+    def __init__(self, message, retryAfter=0.0):
+        super().__init__(message)
+        self.retryAfter = retryAfter
+
+
+class TransientCloudError(Exception):
+    pass
+
+
+def parseRetryAfter(value):
+    # Retry-After is either a number of seconds or an HTTP date. Missing or invalid values give 0.0.
+    if value is None:
+        return 0.0
+    try:
+        return max(0.0, float(value))
+    except (TypeError, ValueError):
+        pass
+    try:
+        return max(0.0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return 0.0
+
+
+class AdaptiveRateController():
+    # Limits the number of concurrent calls and the call rate of one account, adjusted additive-increase/multiplicative-
+    # decrease: every window of healthy responses the limits grow a step, a throttled response halves them and pauses
+    # every call until its Retry-After has passed. This keeps the account right at the provider's limit.
+    MAX_ATTEMPTS = 5
+    DEFAULT_BACKOFF = 1.0
+    MAX_BACKOFF = 60.0
+
+    def __init__(self, concurrency=4, maxConcurrency=16, rate=10.0, maxRate=50.0, minRate=0.5, rateStep=1.0):
+        self.__concurrency = concurrency
+        self.__maxConcurrency = maxConcurrency
+        self.__maxRate = maxRate
+        self.__minRate = minRate
+        self.__rateStep = rateStep
+        self.__rateBucket = TokenBucket(rate)
+        self.__running = 0
+        self.__healthyResponses = 0
+        self.__pausedUntil = 0.0
+        self.__backoff = self.DEFAULT_BACKOFF
+        self.__condition = Condition()
+        self.__logger = moduleLogger.getChild("AdaptiveRateController")
+
+    @property
+    def concurrency(self):
+        return self.__concurrency
+
+    @property
+    def rate(self):
+        return self.__rateBucket.rate
+
+    def call(self, function, getRetryAfter, task=None):
+        # getRetryAfter tells the seconds to wait from an exception of the call, or None if it is not a throttling.
+        for attempt in range(1, self.MAX_ATTEMPTS + 1):
+            self.__acquire(task)
+            try:
+                result = function()
+            except Exception as e:
+                self.__release()
+                retryAfter = getRetryAfter(e)
+                if retryAfter is None or attempt == self.MAX_ATTEMPTS:
+                    raise
+                self.__throttled(retryAfter)
+                continue
+            self.__release(healthy=True)
+
+            return result
+
+    def __acquire(self, task):
+        with self.__condition:
+            while not (task and task.stale):
+                wait = self.__pausedUntil - time.monotonic()
+                if wait <= 0 and self.__running < self.__concurrency:
+                    break
+                self.__condition.wait(min(wait, 1.0) if wait > 0 else 1.0)
+            self.__running += 1
+        self.__rateBucket.consume(1, task)
+
+    def __release(self, healthy=False):
+        with self.__condition:
+            self.__running -= 1
+            if healthy:
+                self.__backoff = self.DEFAULT_BACKOFF
+                self.__healthyResponses += 1
+                if self.__healthyResponses >= self.__concurrency:
+                    self.__healthyResponses = 0
+                    self.__concurrency = min(self.__maxConcurrency, self.__concurrency + 1)
+                    self.__rateBucket.setRate(min(self.__maxRate, self.__rateBucket.rate + self.__rateStep))
+            self.__condition.notify_all()
+
+    def __throttled(self, retryAfter):
+        with self.__condition:
+            now = time.monotonic()
+            # Calls throttled together decrease the limits only once.
+            if self.__pausedUntil <= now:
+                self.__concurrency = max(1, self.__concurrency // 2)
+                self.__rateBucket.setRate(max(self.__minRate, self.__rateBucket.rate / 2))
+                self.__logger.info(f"Throttled, concurrency: {self.__concurrency}, rate: {self.__rateBucket.rate}/s, pausing for {retryAfter or self.__backoff}s")
+            self.__pausedUntil = max(self.__pausedUntil, now + (retryAfter or self.__backoff))
+            if not retryAfter:
+                self.__backoff = min(self.MAX_BACKOFF, self.__backoff * 2)
+            self.__healthyResponses = 0
+            self.__condition.notify_all()
+
+
+class RetryPolicy():
+    # Retries calls failing with a transient error after a random wait of up to baseDelay * 2^(attempt - 1) seconds,
+    # so the transfers failing together do not retry in lockstep. The calls themselves resume where the failed attempt
+    # left off, a retry only repeats the failed request.
+
+    def __init__(self, maxAttempts=6, baseDelay=0.5, maxDelay=30.0):
+        self.maxAttempts = maxAttempts
+        self.baseDelay = baseDelay
+        self.maxDelay = maxDelay
+        self.__logger = moduleLogger.getChild("RetryPolicy")
+
+    def call(self, function, isTransient, task=None):
+        for attempt in range(1, self.maxAttempts + 1):
+            try:
+                return function()
+            except Exception as e:
+                if not self.retry(attempt, e, isTransient, task):
+                    raise
+
+    def retry(self, attempt, exception, isTransient, task=None):
+        # Waits before the next attempt after a failed one, returns False if there should be no next attempt.
+        if attempt >= self.maxAttempts or not isTransient(exception) or (task and task.stale):
+            return False
+        delay = random.uniform(0, min(self.maxDelay, self.baseDelay * 2 ** (attempt - 1)))
+        self.__logger.info(f"Attempt {attempt} failed with {type(exception).__name__}: {exception}, retrying in {delay:.2f}s")
+        time.sleep(delay)
+
+        return True
+
+
+class RateControllers(metaclass=Singleton):
+
+    def __init__(self):
+        self.__controllers = {}
+        self.__lock = Lock()
+
+    def get(self, accountID):
+        with self.__lock:
+            if accountID not in self.__controllers:
+                self.__controllers[accountID] = AdaptiveRateController()
+
+            return self.__controllers[accountID]
@@ -1,155 +1,287 @@
 import socket
-import select
+import selectors
 import logging
 import time
 
-from queue import Empty
+from threading import Thread
 
-from msgpack import Packer, Unpacker
-from Crypto.Cipher import AES
+from queue import Empty
 
 from .message import MessageDispatcher
+from .detector import RemoteChangeDetector
+from .database import DatabaseAccess
+from .session import ClientSession, DetachedSession
+from .transport import SocketOptions, CompressionOptions, KeepaliveOptions, ResumeOptions, FrameFormatError
 from .worker import WorkerPool
-from model.message import NetworkMessage, MessageTypes
+from .crypto import CryptoService
+from model.message import NetworkMessage, MessageTypes, NetworkMessageFormatError
 from model.task import TaskArchive
 
 
+class LoopWaker():
+    # Self-pipe: worker threads write a byte into it to interrupt the blocking select of the server loop.
+
+    def __init__(self):
+        self.__reader, self.__writer = socket.socketpair()
+        self.__reader.setblocking(False)
+        self.__writer.setblocking(False)
+
+    def fileno(self):
+        return self.__reader.fileno()
+
+    def wake(self):
+        try:
+            self.__writer.send(b"\x00")
+        except (BlockingIOError, InterruptedError):
+            # The pipe is full, so the loop has a pending wakeup already.
+            pass
+
+    def consume(self):
+        try:
+            while self.__reader.recv(1024):
+                pass
+        except (BlockingIOError, InterruptedError):
+            pass
+
+    def close(self):
+        self.__reader.close()
+        self.__writer.close()
+
+
 class Server(object):
 
-    def __init__(self, port, key):
-        self._CHUNK_SIZE = 2048
+    def __init__(self, port, key, socketOptions=None, compressionOptions=None, remoteChangePollInterval=0, keepaliveOptions=None, resumeOptions=None, longTaskWorkerCount=1, cryptoWorkerCount=0, taskScheduler=None):
         self._shouldRun = True
 
         self._port = port
         self._key = key.encode()
+        self._socketOptions = socketOptions or SocketOptions()
+        self._compressionOptions = compressionOptions or CompressionOptions()
+        self._keepaliveOptions = keepaliveOptions or KeepaliveOptions()
+        self._nextKeepaliveCheck = 0.0
+        self._resumeOptions = resumeOptions or ResumeOptions()
         self._server = self._createServerSocket()
 
-        self._inputs = [self._server]
-        self._outputs = []
-
-        self._client = None
-        self._clientAddress = None
-
-        self._packer = Packer()
-        self._unpacker = Unpacker()
-
-        self._encoder = None
-        self._decoder = None
+        self._selector = selectors.DefaultSelector()
+        self._waker = LoopWaker()
+        self._sessions = {}
+        # Sessions of disconnected clients waiting to be resumed, keyed by their token.
+        self._detachedSessions = {}
 
         self._logger = logging.getLogger(__name__).getChild("Server")
 
         self._messageDispatcher = MessageDispatcher()
-        self._workerPool = WorkerPool()
+        self._messageDispatcher.setOutgoingMessageListener(self._waker.wake)
+        self._workerPool = WorkerPool(longTaskWorkerCount, taskScheduler)
+        self._cryptoWorkerCount = cryptoWorkerCount
         self._taskArchive = TaskArchive()
 
+        self._remoteChangeDetector = RemoteChangeDetector(DatabaseAccess(), remoteChangePollInterval) if remoteChangePollInterval > 0 else None
+        self._remoteChangeDetectorThread = Thread(target=self._remoteChangeDetector.start) if self._remoteChangeDetector else None
+
     def start(self):
+        CryptoService().start(self._cryptoWorkerCount)
         self._workerPool.start()
+        if self._remoteChangeDetectorThread:
+            self._remoteChangeDetectorThread.start()
+        self._selector.register(self._server, selectors.EVENT_READ)
+        self._selector.register(self._waker, selectors.EVENT_READ)
         self._logger.info("Ready")
         while self._shouldRun:
-            readable, writable, inError = select.select(self._inputs, self._outputs, self._inputs)
-
-            self._handleReadable(readable)
-            self._handleWritable(writable)
-            self._handleError(inError)
+            for key, events in self._selector.select(self._getSelectTimeout()):
+                if key.fileobj is self._server:
+                    self._acceptClient()
+                elif key.fileobj is self._waker:
+                    self._waker.consume()
+                    self._collectOutgoingMessages()
+                else:
+                    self._handleSessionEvents(key.data, events)
+            if self._messageDispatcher.flushStatusUpdates():
+                self._collectOutgoingMessages()
+            self._checkKeepalive()
+            self._expireDetachedSessions()
 
     def stop(self):
         self._logger.debug("Shutting down.")
         self._shouldRun = False
+        self._waker.wake()
         self._server.close()
-        if self._client:
-            self._client.close()
+        for session in list(self._sessions.values()):
+            session.close()
         self._workerPool.stop()
+        CryptoService().stop()
+        if self._remoteChangeDetectorThread and self._remoteChangeDetectorThread.is_alive():
+            self._remoteChangeDetector.stop()
+            self._remoteChangeDetectorThread.join()
+        self._selector.close()
+        self._waker.close()
+
+    def _getSelectTimeout(self):
+        timeouts = [self._messageDispatcher.timeUntilStatusUpdateFlush()]
+        if self._sessions:
+            timeouts.append(max(0.0, self._nextKeepaliveCheck - time.monotonic()))
+        if self._detachedSessions:
+            timeouts.append(max(0.0, min(detached.deadline for detached in self._detachedSessions.values()) - time.monotonic()))
+        timeouts = [timeout for timeout in timeouts if timeout is not None]
+
+        return min(timeouts) if timeouts else None
+
+    def _checkKeepalive(self):
+        now = time.monotonic()
+        if now < self._nextKeepaliveCheck:
+            return
+        # Checking a few times per interval keeps the detection delay a fraction of the timeout.
+        self._nextKeepaliveCheck = now + min(self._keepaliveOptions.interval, self._keepaliveOptions.timeout) / 4
+        for session in list(self._sessions.values()):
+            if not session.keepaliveEnabled:
+                continue
+            idleTime = now - session.lastReceived
+            if idleTime > self._keepaliveOptions.timeout:
+                self._handleDisconnect(session, f"(no data for {idleTime:.1f} seconds)")
+            elif idleTime >= self._keepaliveOptions.interval and now - session.lastPingSent >= self._keepaliveOptions.interval:
+                session.sendPing()
+                self._updateSessionInterest(session)
 
     def _createServerSocket(self):
         serverSocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         serverSocket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         serverSocket.bind(("localhost", self._port))
-        serverSocket.listen(1)
+        serverSocket.listen(socket.SOMAXCONN)
 
         return serverSocket
 
-    def _handleReadable(self, readable):
+    def _handleSessionEvents(self, session, events):
+        if self._sessions.get(session.id) is not session:
+            # Disconnected earlier in the same loop iteration.
+            return
         try:
-            for readableSocket in readable:
-                if readableSocket is self._server:
-                    self._logger.info("Client connecting")
-                    if not self._client:
-                        self._logger.info("Accepting client")
-                        self._acceptClient()
-                    else:
-                        self._logger.info("Client already connected, rejecting new client..")
-                        self._rejectClient()
-                else:
-                    self._readClientData(readableSocket)
-        except ConnectionResetError as e:
-            self._handleDisconnect(self._client, e)
-
-    def _readClientData(self, client):
-        data = client.recv(self._CHUNK_SIZE)
-        if data:
-            if client not in self._outputs:
-                self._outputs.append(client)
-            decrypted = self._decoder.decrypt(data)
-            self._unpacker.feed(decrypted)
-            self._processIncomingMessages()
+            if events & selectors.EVENT_READ:
+                self._readClientData(session)
+            if events & selectors.EVENT_WRITE and session.id in self._sessions:
+                session.sendPendingOutput()
+                session.collectOutgoingMessages()
+                self._updateSessionInterest(session)
+        except OSError as e:
+            self._handleDisconnect(session, e)
+        except (FrameFormatError, NetworkMessageFormatError, ValueError) as e:
+            self._logger.error(f"Malformed data from client {session.address}: {e}")
+            self._handleDisconnect(session, e)
+
+    def _readClientData(self, session):
+        try:
+            received = session.receive()
+        except (BlockingIOError, InterruptedError):
+            return
+        if received:
+            try:
+                for message in session.incomingMessages():
+                    self._messageDispatcher.dispatchIncomingMessage(message, session.id)
+            except (KeyError, TypeError, AttributeError) as e:
+                # Messages missing fields or having fields of the wrong type only end the session that sent them.
+                raise NetworkMessageFormatError(f"Malformed message: {type(e).__name__}: {e}") from e
+            # Keepalive replies are written by the session itself while reading.
+            self._updateSessionInterest(session)
         else:
-            self._handleDisconnect(client)
-
-    def _handleDisconnect(self, client, error=""):
-        self._logger.info(f"Client disconnected {error}. Cleaning up connections and resetting tasks.")
-        if client in self._outputs:
-            self._outputs.remove(client)
-        if client in self._inputs:
-            self._inputs.remove(client)
-        if client:
-            client.close()
-        self._client = None
-        self._clientAddress = None
-        self._taskArchive.clearAllTasks()
-
-    def _processIncomingMessages(self):
-        for message in self._unpacker:
-            msg_obj = NetworkMessage(message)
-            self._messageDispatcher.dispatchIncomingMessage(msg_obj)
+            self._handleDisconnect(session)
 
-    def _acceptClient(self):
-        self._client, self._clientAddress = self._server.accept()
-        self._inputs.append(self._client)
-        self._logger.debug("Client connected")
-        self._sendSessionKey()
-
-    def _sendSessionKey(self):
-        self._encoder = AES.new(self._key, AES.MODE_CFB)
-        self._decoder = AES.new(self._key, AES.MODE_CFB, iv=self._encoder.iv)
-        self._logger.debug(f"Setting up session with key: {self._encoder.iv}")
-        encoded = self._encoder.encrypt(self._encoder.iv)
-        packed = self._packer.pack({"iv": self._encoder.iv, "encodeTest": encoded})
-        self._client.sendall(packed)
-        self._logger.debug("Session data sent!")
-
-    def _rejectClient(self):
-        client, _ = self._server.accept()
-        client.close()
-
-    def _handleWritable(self, writable):
+    def _handleDisconnect(self, session, error=""):
         try:
-            for s in writable:
-                try:
-                    msg_obj = self._messageDispatcher.outgoing_message_queue.get_nowait() # TODO Majd refaktor kicsit.
-                    serialized = self._packer.pack(msg_obj.raw)
-                    encrypted = self._encoder.encrypt(serialized)
-                    s.sendall(encrypted)
-                    self._messageDispatcher.outgoing_message_queue.task_done() # TODO Majd refaktor kicsit.
-                except Empty:
-                    time.sleep(1)
-        except OSError as e:
-            self._handleDisconnect(self._client, e)
-
-    def _handleError(self, inError):
-        for s in inError:
-            self._logger.error(f"Some error in handleError {s}")
-            if s in self._inputs:
-                self._inputs.remove(s)
-            if s in self._outputs:
-                self._outputs.remove(s)
-            s.close()
+            self._selector.unregister(session.connection)
+        except (KeyError, ValueError):
+            pass
+        del self._sessions[session.id]
+        if session.resumable and self._resumeOptions.gracePeriod > 0 and self._shouldRun:
+            self._logger.info(f"Client {session.address} disconnected {error}. Keeping its tasks for {self._resumeOptions.gracePeriod} seconds.")
+            self._detachSession(session)
+            session.close()
+        else:
+            self._logger.info(f"Client {session.address} disconnected {error}. Cleaning up its connection and resetting its tasks.")
+            session.close()
+            self._endSession(session.id)
+
+    def _endSession(self, sessionID):
+        self._messageDispatcher.unregisterSession(sessionID)
+        self._taskArchive.clearSessionTasks(sessionID)
+
+    def _detachSession(self, session):
+        detached = DetachedSession(session.id, session.token, time.monotonic() + self._resumeOptions.gracePeriod, self._resumeOptions.replayBufferSize)
+        for message in session.takeUnsentMessages():
+            detached.outgoingQueue.put(message)
+        self._messageDispatcher.registerSession(detached)
+        self._detachedSessions[session.token] = detached
+
+    def _expireDetachedSessions(self):
+        now = time.monotonic()
+        for token, detached in list(self._detachedSessions.items()):
+            if detached.deadline <= now:
+                self._logger.info(f"Session {detached.id} was not resumed in time, resetting its tasks.")
+                del self._detachedSessions[token]
+                self._endSession(detached.id)
+
+    def _resumeSession(self, session, token):
+        # The client may notice the broken connection before the server does.
+        superseded = next((other for other in self._sessions.values() if other.token == token and other is not session), None)
+        if superseded:
+            self._handleDisconnect(superseded, "(superseded by a new connection)")
+
+        detached = self._detachedSessions.pop(token, None)
+        if detached is None:
+            self._logger.info(f"Client {session.address} tried to resume an unknown or expired session.")
+            session.enqueueMessage(NetworkMessage.Builder(MessageTypes.SESSION_RESUMED).withData({"resumed": False}).build())
+            return
+
+        self._messageDispatcher.unregisterSession(session.id)
+        del self._sessions[session.id]
+        session.resume(detached)
+        self._sessions[session.id] = session
+        self._messageDispatcher.registerSession(session)
+
+        # Enqueued directly, so the missed messages are sent ahead of anything routed to the session from now on.
+        missedMessages = detached.outgoingQueue.drain()
+        session.enqueueMessage(NetworkMessage.Builder(MessageTypes.SESSION_RESUMED).withData({
+            "resumed": True,
+            "sessionToken": session.token,
+            "replayed": len(missedMessages),
+            "dropped": detached.outgoingQueue.droppedCount
+        }).build())
+        for message in missedMessages:
+            session.enqueueMessage(message)
+        self._messageDispatcher.resumeDataStreams(session.id)
+        self._logger.info(f"Client {session.address} resumed session {session.id}, replaying {len(missedMessages)} messages ({detached.outgoingQueue.droppedCount} dropped).")
+
+    def _acceptClient(self):
+        connection, address = self._server.accept()
+        connection.setblocking(False)
+        self._socketOptions.apply(connection)
+        session = ClientSession(connection, address, self._key, self._compressionOptions, self._keepaliveOptions, self._resumeOptions, self._resumeSession)
+        self._sessions[session.id] = session
+        self._messageDispatcher.registerSession(session)
+        self._selector.register(connection, selectors.EVENT_READ, data=session)
+        self._logger.info(f"Client connected from {address}, session: {session.id}")
+
+        session.startHandshake()
+        self._collectOutgoingMessages()
+
+    def _collectOutgoingMessages(self):
+        if not self._sessions:
+            # Broadcasts stay queued until a client is connected to receive them.
+            return
+        while True:
+            try:
+                message = self._messageDispatcher.outgoing_message_queue.get_nowait()
+            except Empty:
+                break
+            for session in self._sessions.values():
+                session.enqueueMessage(message)
+            for detached in self._detachedSessions.values():
+                detached.outgoingQueue.put(message)
+            self._messageDispatcher.outgoing_message_queue.task_done()
+
+        for session in self._sessions.values():
+            session.collectOutgoingMessages()
+            self._updateSessionInterest(session)
+
+    def _updateSessionInterest(self, session):
+        events = selectors.EVENT_READ | selectors.EVENT_WRITE if session.hasPendingOutput() else selectors.EVENT_READ
+        if self._selector.get_key(session.connection).events != events:
+            self._selector.modify(session.connection, events, data=session)
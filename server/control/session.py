@@ -0,0 +1,226 @@
+import logging
+import secrets
+import time
+
+from collections import deque
+from threading import Lock
+from uuid import uuid4
+from queue import Queue, Empty
+
+import msgpack
+from Crypto.Cipher import AES
+
+from .message import MessageDispatcher
+from .stream import DATA_CHUNK_SIZE, DATA_WINDOW
+from .transport import FrameReader, FrameWriter, FrameMultiplexer, FrameFlags, FrameCompressor, CompressionOptions, KeepaliveOptions, ResumeOptions, RoundTripTimeEstimator, DEFAULT_FRAGMENT_SIZE, MAX_FRAME_SIZE, HANDSHAKE_MAX_FRAME_SIZE
+from model.message import NetworkMessage, MessageTypes, MessageCodec, MessageEncodings, MessageChannels
+
+
+moduleLogger = logging.getLogger(__name__)
+
+
+class ReplayBuffer():
+    # Stands in for the outgoing queue of a detached session, only the newest messages are kept.
+    # Control messages and file data are not replayed, data streams resend their unacknowledged data themselves.
+
+    def __init__(self, capacity):
+        self.droppedCount = 0
+        self.__messages = deque(maxlen=capacity)
+        self.__lock = Lock()
+
+    def put(self, message):
+        if message.channel == MessageChannels.CONTROL or message.header.messageType == MessageTypes.FILE_DATA:
+            return
+        with self.__lock:
+            if len(self.__messages) == self.__messages.maxlen:
+                self.droppedCount += 1
+            self.__messages.append(message)
+
+    def drain(self):
+        with self.__lock:
+            messages = list(self.__messages)
+            self.__messages.clear()
+        return messages
+
+
+class DetachedSession():
+    # What is left of a resumable session after its client disconnected. Registered with the dispatcher in place of
+    # the session, so the tasks of the client keep running until it resumes or the deadline passes.
+
+    def __init__(self, sessionID, token, deadline, replayBufferSize):
+        self.id = sessionID
+        self.token = token
+        self.deadline = deadline
+        self.outgoingQueue = ReplayBuffer(replayBufferSize)
+
+
+class ClientSession():
+    # Queued messages are only framed while less than this many bytes wait to be sent. Kept low, so fragments of
+    # bulk messages can't build up in front of a later high priority message.
+    __OUTPUT_HIGH_WATER_MARK = 1 << 16
+
+    def __init__(self, connection, address, key, compressionOptions=None, keepaliveOptions=None, resumeOptions=None, resumeHandler=None):
+        self.id = uuid4().hex
+        self.token = secrets.token_hex(16)
+        self.resumable = False
+        self.connection = connection
+        self.address = address
+        self.outgoingQueue = Queue()
+        self.keepaliveEnabled = False
+        self.lastReceived = time.monotonic()
+        self.lastPingSent = 0.0
+        self.roundTripTime = RoundTripTimeEstimator()
+
+        self.__key = key
+        self.__compressionOptions = compressionOptions or CompressionOptions()
+        self.__keepaliveOptions = keepaliveOptions or KeepaliveOptions()
+        self.__resumeOptions = resumeOptions or ResumeOptions()
+        self.__resumeHandler = resumeHandler
+        self.__packer = msgpack.Packer()
+        self.__codec = MessageCodec()
+        # Frames stay small until the client sent a message encrypted with the key.
+        self.__frameReader = FrameReader(maxFrameSize=HANDSHAKE_MAX_FRAME_SIZE)
+        self.__frameWriter = FrameWriter()
+        self.__multiplexer = FrameMultiplexer(self.__codec.encode, len(MessageChannels), onWritten=self.__messageWritten)
+        self.__writtenCallbacks = {}
+        self.__writtenCallbacksLock = Lock()
+        self.__closed = False
+
+        self.__logger = moduleLogger.getChild("ClientSession")
+
+    def startHandshake(self):
+        encoder = AES.new(self.__key, AES.MODE_CFB)
+        decoder = AES.new(self.__key, AES.MODE_CFB, iv=encoder.iv)
+        self.__logger.debug(f"Setting up session {self.id} with key: {encoder.iv}")
+        encoded = encoder.encrypt(encoder.iv)
+        packed = self.__packer.pack({
+            "iv": encoder.iv,
+            "encodeTest": encoded,
+            "compression": self.__compressionOptions.algorithms,
+            "compressionThreshold": self.__compressionOptions.threshold,
+            "encodings": [MessageEncodings.COMPACT],
+            "maxBatchSize": MessageDispatcher.MAX_BATCH_SIZE,
+            "keepaliveInterval": self.__keepaliveOptions.interval,
+            "keepaliveTimeout": self.__keepaliveOptions.timeout,
+            "fragmentSize": DEFAULT_FRAGMENT_SIZE,
+            "dataChunkSize": DATA_CHUNK_SIZE,
+            "dataWindow": DATA_WINDOW,
+            "sessionToken": self.token,
+            "resumeGracePeriod": self.__resumeOptions.gracePeriod
+        })
+        self.__frameWriter.writeFrame(packed, FrameFlags.PLAINTEXT)
+
+        self.__frameWriter.setEncoder(encoder)
+        self.__frameReader.setDecoder(decoder)
+
+    def receive(self):
+        received = self.__frameReader.readFrom(self.connection) > 0
+        if received:
+            self.lastReceived = time.monotonic()
+        return received
+
+    def sendPing(self):
+        self.lastPingSent = time.monotonic()
+        self.enqueueMessage(NetworkMessage.Builder(MessageTypes.PING).withData({"timestamp": self.lastPingSent}).build())
+
+    def incomingMessages(self):
+        for flags, payload in self.__frameReader.frames():
+            message = self.__codec.decode(payload)
+            self.__frameReader.setMaxFrameSize(MAX_FRAME_SIZE)
+            if message.header.messageType == MessageTypes.SESSION_OPTIONS:
+                self.__applySessionOptions(message.data)
+            elif message.header.messageType == MessageTypes.PING:
+                self.enqueueMessage(NetworkMessage.Builder(MessageTypes.PONG).withData(message.data).build())
+            elif message.header.messageType == MessageTypes.PONG:
+                self.roundTripTime.addSample(time.monotonic() - message.data["timestamp"])
+                self.__logger.debug(f"Session {self.id} round trip time: {self.roundTripTime.lastSample * 1000:.1f} ms (smoothed: {self.roundTripTime.value * 1000:.1f} ms)")
+            else:
+                yield message
+
+    def __applySessionOptions(self, options):
+        options = options or {}
+        if options.get("keepalive", False):
+            self.keepaliveEnabled = True
+        if options.get("resumable", False):
+            self.resumable = True
+        if options.get("multiplexing", False):
+            self.__multiplexer.setFragmentSize(DEFAULT_FRAGMENT_SIZE)
+            self.__logger.debug(f"Session {self.id} splits messages into fragments of {DEFAULT_FRAGMENT_SIZE} bytes")
+        if options.get("encoding", None) == MessageEncodings.COMPACT:
+            self.__codec.encoding = MessageEncodings.COMPACT
+            self.__logger.debug(f"Session {self.id} uses compact message encoding")
+        compression = options.get("compression", None)
+        if compression in self.__compressionOptions.algorithms:
+            self.__frameWriter.setCompressor(FrameCompressor(compression, self.__compressionOptions.threshold))
+            self.__logger.debug(f"Session {self.id} uses {compression} compression")
+        elif compression:
+            self.__logger.warning(f"Session {self.id} requested unsupported compression: {compression}")
+        # Applied last, so the resumed messages are already sent with the negotiated options.
+        resumeToken = options.get("resume", None)
+        if resumeToken and self.__resumeHandler:
+            self.__resumeHandler(self, resumeToken)
+
+    def resume(self, detachedSession):
+        self.id = detachedSession.id
+        self.token = detachedSession.token
+        self.resumable = True
+
+    def takeUnsentMessages(self):
+        # Messages that did not make it to the socket, without control messages which are only valid on this connection.
+        messages = self.__multiplexer.takePendingMessages()
+        while True:
+            try:
+                messages.append(self.outgoingQueue.get_nowait())
+            except Empty:
+                break
+            self.outgoingQueue.task_done()
+        return [message for message in messages if message.channel != MessageChannels.CONTROL]
+
+    def enqueueMessage(self, message):
+        self.__multiplexer.enqueue(message.channel, message)
+        self.__multiplexer.fill(self.__frameWriter, self.__OUTPUT_HIGH_WATER_MARK)
+
+    def collectOutgoingMessages(self):
+        # The whole queue is taken, so a message waiting behind bulk traffic is framed as soon as its channel is due.
+        while True:
+            try:
+                message = self.outgoingQueue.get_nowait()
+            except Empty:
+                break
+            self.__multiplexer.enqueue(message.channel, message)
+            self.outgoingQueue.task_done()
+        self.__multiplexer.fill(self.__frameWriter, self.__OUTPUT_HIGH_WATER_MARK)
+
+    def whenWritten(self, message, callback):
+        # The callback is called on the server loop once the message is framed for the socket, or once the session
+        # closes. Must be called before the message is queued, returns False if the session is closed already.
+        with self.__writtenCallbacksLock:
+            if self.__closed:
+                return False
+            self.__writtenCallbacks[id(message)] = callback
+        return True
+
+    def __messageWritten(self, message):
+        with self.__writtenCallbacksLock:
+            callback = self.__writtenCallbacks.pop(id(message), None)
+        if callback:
+            callback()
+
+    def hasPendingOutput(self):
+        return self.__frameWriter.hasPendingData() or self.__multiplexer.hasPendingData() or not self.outgoingQueue.empty()
+
+    def sendPendingOutput(self):
+        try:
+            self.__frameWriter.sendTo(self.connection)
+        except (BlockingIOError, InterruptedError):
+            pass
+
+    def close(self):
+        self.connection.close()
+        self.__frameWriter.clear()
+        with self.__writtenCallbacksLock:
+            self.__closed = True
+            callbacks = list(self.__writtenCallbacks.values())
+            self.__writtenCallbacks = {}
+        for callback in callbacks:
+            callback()
@@ -0,0 +1,345 @@
+import io
+import os
+import logging
+
+from collections import deque
+from threading import Condition, Thread
+
+from model.message import NetworkMessage, MessageTypes
+
+
+moduleLogger = logging.getLogger(__name__)
+
+
+# File data is sent in FILE_DATA messages of at most this size.
+DATA_CHUNK_SIZE = 1 << 16
+# At most this many bytes of a stream may be sent ahead of the last FILE_DATA_ACK of the receiver.
+DATA_WINDOW = 1 << 22
+
+
+class DataStreamInterruptedError(Exception):
+    pass
+
+
+class IncomingDataStream():
+    # Filled by the server loop from FILE_DATA messages and read like a file by an upload handler.
+    # Nothing is sent by the client until the stream is opened and acknowledges offset 0.
+    __POLL_INTERVAL = 0.5
+
+    def __init__(self, task, send):
+        self.uuid = task.uuid
+        self.sessionID = task.sessionID
+        self.__task = task
+        self.__send = send
+        self.__buffer = bytearray()
+        self.__received = 0
+        self.__consumed = 0
+        self.__finished = False
+        self.__closed = False
+        self.__condition = Condition()
+        self.__logger = moduleLogger.getChild("IncomingDataStream")
+
+    def start(self):
+        self.__acknowledge(0)
+
+    def feed(self, offset, data, last):
+        with self.__condition:
+            if self.__closed:
+                return
+            if offset != self.__received:
+                self.__logger.warning(f"Stream {self.uuid} expected data at offset {self.__received}, received {offset}. Closing stream.")
+                self.__closed = True
+            else:
+                self.__buffer.extend(data)
+                self.__received += len(data)
+                self.__finished = last
+            self.__condition.notify_all()
+
+    def read(self, size=-1):
+        with self.__condition:
+            while not self.__finished and (size < 0 or len(self.__buffer) < size):
+                self.__checkInterrupted()
+                self.__condition.wait(self.__POLL_INTERVAL)
+            self.__checkInterrupted()
+            size = len(self.__buffer) if size < 0 else size
+            data = bytes(self.__buffer[:size])
+            del self.__buffer[:size]
+            self.__consumed += len(data)
+            consumed = self.__consumed
+        if data:
+            self.__acknowledge(consumed)
+
+        return data
+
+    def resume(self):
+        # Data sent over a lost connection may not have arrived, the client continues from the received offset.
+        with self.__condition:
+            consumed, received = self.__consumed, self.__received
+        self.__acknowledge(consumed, resumeFrom=received)
+
+    def close(self):
+        with self.__condition:
+            self.__closed = True
+            self.__buffer = bytearray()
+            self.__condition.notify_all()
+            consumed = self.__consumed
+        self.__acknowledge(consumed, closed=True)
+
+    def __checkInterrupted(self):
+        if self.__task.stale:
+            raise DataStreamInterruptedError(f"Task {self.uuid} got cancelled.")
+        elif self.__closed:
+            raise DataStreamInterruptedError(f"Stream {self.uuid} got closed.")
+
+    def __acknowledge(self, offset, **extra):
+        self.__send(NetworkMessage.Builder(MessageTypes.FILE_DATA_ACK).withUUID(self.uuid).withData({"offset": offset, **extra}).build())
+
+
+class OutgoingDataStream(io.RawIOBase):
+    # Written like a file by a download handler, the data goes out to the client in FILE_DATA messages.
+    # Messages are kept until acknowledged so they can be sent again after the session is resumed.
+    __POLL_INTERVAL = 0.5
+
+    def __init__(self, task, send, chunkSize=DATA_CHUNK_SIZE, window=DATA_WINDOW):
+        super().__init__()
+        self.uuid = task.uuid
+        self.sessionID = task.sessionID
+        self.__task = task
+        self.__send = send
+        self.__chunkSize = chunkSize
+        self.__window = window
+        self.__sent = 0
+        self.__acknowledged = 0
+        self.__unacknowledged = deque()
+        self.__complete = False
+        self.__interrupted = False
+        self.__condition = Condition()
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        view = memoryview(data)
+        for chunkStart in range(0, len(view), self.__chunkSize):
+            chunk = bytes(view[chunkStart:chunkStart + self.__chunkSize])
+            self.__waitForWindow(len(chunk))
+            self.__sendData(chunk, False)
+
+        return len(view)
+
+    def acknowledge(self, offset, resume=False, complete=False):
+        with self.__condition:
+            self.__acknowledged = max(self.__acknowledged, offset)
+            self.__complete = self.__complete or complete
+            while self.__unacknowledged and self.__isAcknowledged(self.__unacknowledged[0].data):
+                self.__unacknowledged.popleft()
+            if resume:
+                for message in self.__unacknowledged:
+                    if message.data["offset"] >= offset:
+                        self.__send(message)
+            self.__condition.notify_all()
+
+    def close(self):
+        with self.__condition:
+            self.__interrupted = True
+            self.__condition.notify_all()
+        super().close()
+
+    def finish(self, aborted=False):
+        self.__sendData(b"", True, aborted)
+
+    def waitUntilComplete(self):
+        # Returns once the client confirmed that it has written every byte, the data is resent if the session is resumed meanwhile.
+        with self.__condition:
+            while not self.__complete:
+                self.__checkInterrupted()
+                self.__condition.wait(self.__POLL_INTERVAL)
+
+    def __isAcknowledged(self, data):
+        if data["last"]:
+            return self.__complete
+        return data["offset"] + len(data["data"]) <= self.__acknowledged
+
+    def __waitForWindow(self, size):
+        with self.__condition:
+            while self.__sent + size - self.__acknowledged > self.__window:
+                self.__checkInterrupted()
+                self.__condition.wait(self.__POLL_INTERVAL)
+            self.__checkInterrupted()
+
+    def __checkInterrupted(self):
+        if self.__task.stale:
+            raise DataStreamInterruptedError(f"Task {self.uuid} got cancelled.")
+        elif self.__interrupted:
+            raise DataStreamInterruptedError(f"Stream {self.uuid} got closed.")
+
+    def __sendData(self, data, last, aborted=False):
+        message = {"offset": self.__sent, "data": data, "last": last}
+        if aborted:
+            message["aborted"] = True
+        with self.__condition:
+            self.__sent += len(data)
+            message = NetworkMessage.Builder(MessageTypes.FILE_DATA).withUUID(self.uuid).withData(message).build()
+            if not aborted:
+                self.__unacknowledged.append(message)
+            self.__send(message)
+
+
+class SpooledDataStream():
+    # Copies an incoming data stream into a file on a background thread, so the parts of a split upload can be read at
+    # their own offsets at the same time. A part only waits until its own data has arrived.
+    __COPY_SIZE = DATA_CHUNK_SIZE
+
+    def __init__(self, source, path):
+        self.__source = source
+        self.__path = path
+        self.__spooled = 0
+        self.__finished = False
+        self.__error = None
+        self.__condition = Condition()
+        self.__thread = Thread(target=self.__spool, name=f"Spool-{os.path.basename(path)}", daemon=True)
+        self.__logger = moduleLogger.getChild("SpooledDataStream")
+
+    def start(self):
+        self.__thread.start()
+
+    def openPart(self, offset):
+        return SpooledPartReader(self, self.__path, offset)
+
+    def waitFor(self, end):
+        with self.__condition:
+            while self.__spooled < end and not self.__finished:
+                self.__condition.wait()
+            if self.__spooled < end and self.__error:
+                raise DataStreamInterruptedError(str(self.__error))
+
+    def close(self):
+        try:
+            os.unlink(self.__path)
+        except FileNotFoundError:
+            pass
+
+    def __spool(self):
+        try:
+            with open(self.__path, "wb") as spoolFile:
+                data = self.__source.read(self.__COPY_SIZE)
+                while data:
+                    spoolFile.write(data)
+                    spoolFile.flush()
+                    with self.__condition:
+                        self.__spooled += len(data)
+                        self.__condition.notify_all()
+                    data = self.__source.read(self.__COPY_SIZE)
+        except (DataStreamInterruptedError, OSError) as e:
+            self.__logger.info(f"Spooling {self.__path} stopped: {e}")
+            self.__error = e
+        finally:
+            with self.__condition:
+                self.__finished = True
+                self.__condition.notify_all()
+
+
+class SpooledPartReader():
+
+    def __init__(self, spool, path, offset):
+        self.__spool = spool
+        self.__path = path
+        self.__position = offset
+        self.__handle = None
+
+    def read(self, size):
+        self.__spool.waitFor(self.__position + size)
+        if self.__handle is None:
+            self.__handle = open(self.__path, "rb")
+        self.__handle.seek(self.__position)
+        data = self.__handle.read(size)
+        self.__position += len(data)
+
+        return data
+
+    def close(self):
+        if self.__handle:
+            self.__handle.close()
+
+
+class AssembledFile():
+    # A preallocated file the parts of a split download are written into at their own offsets at the same time, so the
+    # parts can be fetched from their accounts concurrently. A reader only waits until the data before it has arrived.
+
+    def __init__(self, path, partSizes):
+        self.__partSizes = partSizes
+        self.__partOffsets = [sum(partSizes[:index]) for index in range(len(partSizes))]
+        self.__written = [0] * len(partSizes)
+        self.__openParts = len(partSizes)
+        self.__condition = Condition()
+        self.__descriptor = os.open(path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o600)
+        self.__preallocate(sum(partSizes))
+
+    def openPart(self, index):
+        return AssembledPartWriter(self, index)
+
+    def isComplete(self):
+        with self.__condition:
+            return self.__written == self.__partSizes
+
+    def read(self, position, size):
+        with self.__condition:
+            while self.__getContiguousSize() <= position and self.__openParts:
+                self.__condition.wait()
+            size = min(size, self.__getContiguousSize() - position)
+        if size <= 0:
+            return b""
+
+        return os.pread(self.__descriptor, size, position)
+
+    def close(self):
+        os.close(self.__descriptor)
+
+    def _write(self, index, data):
+        with memoryview(data) as view:
+            written = 0
+            while written < len(view):
+                written += os.pwrite(self.__descriptor, view[written:], self.__partOffsets[index] + self.__written[index] + written)
+        with self.__condition:
+            self.__written[index] += written
+            self.__condition.notify_all()
+
+        return written
+
+    def _closePart(self, index):
+        with self.__condition:
+            self.__openParts -= 1
+            self.__condition.notify_all()
+
+    def __getContiguousSize(self):
+        contiguousSize = 0
+        for written, partSize in zip(self.__written, self.__partSizes):
+            contiguousSize += written
+            if written < partSize:
+                break
+
+        return contiguousSize
+
+    def __preallocate(self, size):
+        try:
+            os.posix_fallocate(self.__descriptor, 0, size)
+        except (AttributeError, OSError):
+            os.ftruncate(self.__descriptor, size)
+
+
+class AssembledPartWriter(io.RawIOBase):
+
+    def __init__(self, assembledFile, index):
+        self.__assembledFile = assembledFile
+        self.__index = index
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        return self.__assembledFile._write(self.__index, data)
+
+    def close(self):
+        if not self.closed:
+            self.__assembledFile._closePart(self.__index)
+        super().close()
@@ -1,5 +1,4 @@
 import logging
-import time
 
 from threading import Thread
 from queue import Empty
@@ -8,38 +7,96 @@ from .message import *
 from .abstract import Singleton
 from .database import DatabaseAccess
 
-from model.task import Task, TaskArchive
+from model.task import Task, TaskArchive, TaskPriorities
 
 
 moduleLogger = logging.getLogger(__name__)
 
 
+class TaskScheduler():
+    # Decides the order the long tasks are run in. The pending task with the lowest rank runs first. The rank is fixed
+    # when a task is queued, so it can only depend on the task and the time it was queued at.
+
+    def rank(self, task, enqueuedAt):
+        raise NotImplementedError("Derived class must implement method 'rank'!")
+
+
+class FifoScheduler(TaskScheduler):
+
+    def rank(self, task, enqueuedAt):
+        return enqueuedAt
+
+
+class ShortestJobFirstScheduler(TaskScheduler):
+    # Small files are not held up behind large ones. A task is ranked as if it had been queued size / agingRate seconds
+    # later, so a waiting task keeps gaining on newer ones and a large file waits at most that long for small files.
+    DEFAULT_AGING_RATE = 10 * 1048576
+
+    def __init__(self, agingRate=DEFAULT_AGING_RATE):
+        self._agingRate = agingRate
+
+    def rank(self, task, enqueuedAt):
+        return enqueuedAt + self._getSize(task) / self._agingRate
+
+    def _getSize(self, task):
+        size = task.data.get("size", 0)
+        return size if type(size) == int and size > 0 else 0
+
+
+class PriorityScheduler(ShortestJobFirstScheduler):
+    # Tasks are ranked by size within their priority class, and as if queued classDelay seconds later per class below
+    # the highest. The class is sent by the client, otherwise downloads are high priority as the user waits for them.
+    DEFAULT_CLASS_DELAY = 60.0
+    __DEFAULT_PRIORITIES = {MessageTypes.DOWNLOAD_FILE: TaskPriorities.HIGH, MessageTypes.UPLOAD_FILE: TaskPriorities.NORMAL}
+
+    def __init__(self, agingRate=ShortestJobFirstScheduler.DEFAULT_AGING_RATE, classDelay=DEFAULT_CLASS_DELAY):
+        super().__init__(agingRate)
+        self.__classDelay = classDelay
+
+    def rank(self, task, enqueuedAt):
+        return super().rank(task, enqueuedAt) + self.__getPriority(task) * self.__classDelay
+
+    def __getPriority(self, task):
+        try:
+            return TaskPriorities(task.data["priority"])
+        except (KeyError, ValueError):
+            return self.__DEFAULT_PRIORITIES.get(task.taskType, TaskPriorities.NORMAL)
+
+
 class WorkerPool(metaclass=Singleton):
 
-    def __init__(self):
-        self.__databaseAccess = DatabaseAccess()
+    def __init__(self, longTaskWorkerCount=1, taskScheduler=None):
         self.__logger = moduleLogger.getChild("WorkerPool")
-        self.__instantWorker = InstantWorker(self.__databaseAccess)
+        MessageDispatcher().incoming_task_queue.setScheduler(taskScheduler or FifoScheduler())
+        # Every worker has its own database connection, they share a cursor otherwise.
+        self.__databaseAccesses = [DatabaseAccess() for i in range(longTaskWorkerCount + 1)]
+        self.__instantWorker = InstantWorker(self.__databaseAccesses[0])
         self.__instantWorkerThread = Thread(target=self.__instantWorker.start)
 
-        self.__longWorker = LongTaskWorker(self.__databaseAccess)
-        self.__longWorkerThread = Thread(target=self.__longWorker.start)
+        self.__longWorkers = [LongTaskWorker(databaseAccess) for databaseAccess in self.__databaseAccesses[1:]]
+        self.__longWorkerThreads = [Thread(target=worker.start) for worker in self.__longWorkers]
 
     def start(self):
         self.__instantWorkerThread.start()
-        self.__longWorkerThread.start()
+        for thread in self.__longWorkerThreads:
+            thread.start()
+        self.__logger.debug(f"Started with {len(self.__longWorkers)} long task worker(s)")
 
     def stop(self):
         self.__logger.debug("Stopping")
         self.__instantWorker.stop()
+        for worker in self.__longWorkers:
+            worker.stop()
         self.__instantWorkerThread.join()
-        self.__longWorker.stop()
-        self.__longWorkerThread.join()
+        for thread in self.__longWorkerThreads:
+            thread.join()
 
-        self.__databaseAccess.close()
+        for databaseAccess in self.__databaseAccesses:
+            databaseAccess.close()
 
 
 class Worker():
+    _TASK_WAIT_TIMEOUT = 1.0
 
     def __init__(self, databaseAccess):
         self._databaseAccess = databaseAccess
@@ -58,7 +115,7 @@ class Worker():
                 self._work()
                 self._finishTask()
             except Empty:
-                time.sleep(1.0)
+                pass
 
     def _getLogger(self):
         raise NotImplementedError("Derived class must implement method '_getLogger'! It should return a logger.")
@@ -78,6 +135,10 @@ class Worker():
 
 class LongTaskWorker(Worker):
 
+    def __init__(self, databaseAccess):
+        super().__init__(databaseAccess)
+        self._taskArchive = TaskArchive()
+
     def _createHandlerMap(self):
         return {
             MessageTypes.UPLOAD_FILE: UploadFileHandler(self._databaseAccess),
@@ -85,16 +146,28 @@ class LongTaskWorker(Worker):
         }
 
     def _work(self):
-        handler = self._handlerMap[self._currentTask.taskType]
-        handler.setTask(self._currentTask)
-        handler.handle()
+        # Tasks of the same path that arrived meanwhile are run right after, by this worker.
+        task = self._currentTask
+        while task:
+            handler = self._handlerMap[task.taskType]
+            handler.setTask(task)
+            try:
+                handler.handle()
+            except Exception:
+                self._logger.exception(f"Task {task.uuid} failed")
+            task = self._taskArchive.finishTask(task.data["fullPath"])
         self._currentTask = None
 
     def _getLogger(self):
         return moduleLogger.getChild("LongTaskWorker")
 
     def _getNewTask(self):
-        return self._messageDispatcher.incoming_task_queue.get_nowait()
+        while True:
+            task = self._messageDispatcher.incoming_task_queue.get(timeout=self._TASK_WAIT_TIMEOUT)
+            if self._taskArchive.startTask(task.data["fullPath"], task):
+                return task
+            # Handed over to the worker running the same path.
+            self._messageDispatcher.incoming_task_queue.task_done()
 
     def _finishTask(self):
         self._messageDispatcher.incoming_task_queue.task_done()
@@ -109,7 +182,8 @@ class InstantWorker(Worker):
             MessageTypes.SYNC_FILES: GetFileListHandler(self._databaseAccess),
             MessageTypes.GET_WORKSPACE: GetWorkspaceHandler(self._databaseAccess),
             MessageTypes.DELETE_FILE: DeleteFileHandler(self._databaseAccess),
-            MessageTypes.MOVE_FILE: MoveFileHandler(self._databaseAccess)
+            MessageTypes.MOVE_FILE: MoveFileHandler(self._databaseAccess),
+            MessageTypes.SET_BANDWIDTH_LIMITS: SetBandwidthLimitsHandler(self._databaseAccess)
         }
 
     def _work(self):
@@ -119,7 +193,7 @@ class InstantWorker(Worker):
         self._currentTask = None
 
     def _getNewTask(self):
-        return self._messageDispatcher.incoming_instant_task_queue.get_nowait()
+        return self._messageDispatcher.incoming_instant_task_queue.get(timeout=self._TASK_WAIT_TIMEOUT)
 
     def _getLogger(self):
         return moduleLogger.getChild("InstantWorker")
@@ -1,8 +1,9 @@
 import re
 
 from dataclasses import dataclass, field
-from typing import Dict, Any
+from typing import Dict, Any, List
 from enum import IntEnum
+from threading import RLock
 
 from control.abstract import Singleton
 
@@ -42,32 +43,85 @@ class CachedFileData:
     parts: Dict[str, FilePart] = field(default_factory=dict)
 
 
+@dataclass
+class FileListChanges:
+    added: List[FileData] = field(default_factory=list)
+    removed: List[FileData] = field(default_factory=list)
+    modified: List[FileData] = field(default_factory=list)
+
+    def isEmpty(self):
+        return not (self.added or self.removed or self.modified)
+
+    def serialize(self):
+        return {
+            "added": [fileData.serialize() for fileData in self.added],
+            "removed": [fileData.serialize() for fileData in self.removed],
+            "modified": [fileData.serialize() for fileData in self.modified]
+        }
+
+
 class CloudFilesCache(metaclass=Singleton):
 
     def __init__(self):
         self.__filesCache = {}
         self.__partPattern = "(__[0-9]+){2}\.enc"
         self.__totalCountPattern = "__[0-9]+"
+        # Bumped on every change, so a refresh can tell whether the cache changed while its file list was being retrieved.
+        self.version = 0
+        # Set once the accounts changed, the next refresh is not compared to files listed from the old accounts.
+        self.__rebaseline = False
+        self.__lock = RLock()
 
     def clearData(self):
-        self.__filesCache = {}
+        with self.__lock:
+            self.__filesCache = {}
+            self.__rebaseline = False
+            self.version += 1
 
     def insertFilePart(self, filePart):
-        realFilename = self.__getRealFilename(filePart.filename)
-        realFileFullPath = f"{filePart.path}/{realFilename}" if len(filePart.path) > 0 else realFilename
-        try:
-            self.__filesCache[realFileFullPath].data.size += filePart.size - 16
-            self.__filesCache[realFileFullPath].availablePartCount += 1
-            self.__filesCache[realFileFullPath].parts[filePart.filename] = filePart
-        except KeyError:
-            partName = filePart.filename
-            fileData = self.__filePartToFileData(filePart, realFilename, realFileFullPath)
-            self.__filesCache[realFileFullPath] = CachedFileData(
-                fileData, 1, self.__getFilePartCount(partName), {partName: filePart}
-            )
+        with self.__lock:
+            self.__insertFilePart(self.__filesCache, filePart)
+            self.version += 1
+
+    def refresh(self, fileParts, expectedVersion, busyPaths=()):
+        # Replaces the cache with the listed parts and returns how the full files changed. A file is only reported
+        # removed once none of its parts are listed anymore, a file missing some parts keeps its entry until then, so
+        # a listing that failed halfway does not remove anything. Entries of busyPaths, whose tasks update them
+        # themselves, are left as they are.
+        refreshedCache = {}
+        for filePart in fileParts:
+            self.__insertFilePart(refreshedCache, filePart)
+
+        with self.__lock:
+            if self.version != expectedVersion:
+                return None
+            if not self.__rebaseline:
+                for path, cachedFile in self.__filesCache.items():
+                    refreshedFile = refreshedCache.get(path)
+                    if refreshedFile and refreshedFile.availablePartCount < refreshedFile.totalPartCount:
+                        refreshedCache[path] = cachedFile
+            for path in busyPaths:
+                refreshedCache.pop(path, None)
+                if path in self.__filesCache:
+                    refreshedCache[path] = self.__filesCache[path]
+            changes = FileListChanges() if self.__rebaseline else self.__diffFullFiles(self.__filesCache, refreshedCache)
+            self.__filesCache = refreshedCache
+            self.__rebaseline = False
+            self.version += 1
+
+        return changes
+
+    def accountsChanged(self):
+        # Files of removed accounts are not removed files, the next refresh takes its listing as it is. Refreshes
+        # started before are discarded.
+        with self.__lock:
+            self.__rebaseline = True
+            self.version += 1
 
     def removeFile(self, path):
-        del self.__filesCache[path]
+        with self.__lock:
+            del self.__filesCache[path]
+            self.version += 1
 
     def getFile(self, path):
         return self.__filesCache.get(path)
@@ -76,12 +130,46 @@ class CloudFilesCache(metaclass=Singleton):
         fullFiles = [cachedFile.data.serialize() for key, cachedFile in self.__filesCache.items() if cachedFile.availablePartCount == cachedFile.totalPartCount]
         return fullFiles
 
+    def iterateFullFiles(self):
+        cachedFiles = list(self.__filesCache.values())
+        return (cachedFile.data.serialize() for cachedFile in cachedFiles if cachedFile.availablePartCount == cachedFile.totalPartCount)
+
     def getIncompleteFiles(self):
         return [cachedFile for key, cachedFile in self.__filesCache.items() if cachedFile.totalPartCount > cachedFile.availablePartCount]
 
     def moveFile(self, sourcePath, targetPath):
-        self.__filesCache[targetPath] = self.__filesCache[sourcePath]
-        del self.__filesCache[sourcePath]
+        with self.__lock:
+            self.__filesCache[targetPath] = self.__filesCache[sourcePath]
+            del self.__filesCache[sourcePath]
+            self.version += 1
+
+    def __insertFilePart(self, filesCache, filePart):
+        realFilename = self.__getRealFilename(filePart.filename)
+        realFileFullPath = f"{filePart.path}/{realFilename}" if len(filePart.path) > 0 else realFilename
+        try:
+            filesCache[realFileFullPath].data.size += filePart.size - 16
+            filesCache[realFileFullPath].availablePartCount += 1
+            filesCache[realFileFullPath].parts[filePart.filename] = filePart
+        except KeyError:
+            partName = filePart.filename
+            fileData = self.__filePartToFileData(filePart, realFilename, realFileFullPath)
+            filesCache[realFileFullPath] = CachedFileData(
+                fileData, 1, self.__getFilePartCount(partName), {partName: filePart}
+            )
+
+    def __diffFullFiles(self, oldCache, newCache):
+        oldFiles = {path: cachedFile.data for path, cachedFile in oldCache.items() if cachedFile.availablePartCount == cachedFile.totalPartCount}
+        newFiles = {path: cachedFile.data for path, cachedFile in newCache.items() if cachedFile.availablePartCount == cachedFile.totalPartCount}
+        changes = FileListChanges()
+        for path, fileData in newFiles.items():
+            oldFileData = oldFiles.get(path)
+            if oldFileData is None:
+                changes.added.append(fileData)
+            elif oldFileData.modified != fileData.modified or oldFileData.size != fileData.size:
+                changes.modified.append(fileData)
+        changes.removed = [fileData for path, fileData in oldFiles.items() if path not in newFiles]
+
+        return changes
 
     def __getRealFilename(self, fileName):
         match = re.search(self.__partPattern, fileName)
@@ -1,6 +1,14 @@
 from enum import IntEnum
 from uuid import uuid4
 
+import msgpack
+
+
+# Compact messages are msgpack arrays: [version, messageType, 16 byte binary uuid or None, data].
+COMPACT_MESSAGE_VERSION = 1
+# Lists of dicts sharing the same keys are sent once as a key row followed by positional value rows.
+_TABLE_EXT_TYPE = 1
+
 
 class NetworkMessageFormatError(Exception):
     pass
@@ -23,6 +31,59 @@ class MessageTypes(IntEnum):
     FILE_STATUS_UPDATE = 9
     FILE_TASK_CANCELLED = 10
 
+    SESSION_OPTIONS = 11
+
+    FILE_STATUS_UPDATE_BATCH = 12
+
+    PARTIAL_RESPONSE = 13
+
+    BATCH = 14
+
+    REMOTE_FILES_CHANGED = 15
+
+    PING = 16
+    PONG = 17
+
+    FILE_DATA = 18
+    FILE_DATA_ACK = 19
+    SESSION_RESUMED = 20
+
+    SET_BANDWIDTH_LIMITS = 21
+
+
+class MessageEncodings(IntEnum):
+    LEGACY = 0
+    COMPACT = 1
+
+
+class MessageChannels(IntEnum):
+    # Lower values are sent first, large messages are split so they can't hold back other channels.
+    CONTROL = 0
+    INTERACTIVE = 1
+    BULK = 2
+
+
+DEFAULT_MESSAGE_CHANNELS = {
+    MessageTypes.SESSION_OPTIONS: MessageChannels.CONTROL,
+    MessageTypes.PING: MessageChannels.CONTROL,
+    MessageTypes.PONG: MessageChannels.CONTROL,
+    MessageTypes.FILE_DATA_ACK: MessageChannels.CONTROL,
+    MessageTypes.SESSION_RESUMED: MessageChannels.CONTROL,
+    # Requests on the same file stay on one channel, so a move, a delete or a cancel can't overtake an earlier
+    # transfer of the file that is still queued.
+    MessageTypes.UPLOAD_FILE: MessageChannels.BULK,
+    MessageTypes.DOWNLOAD_FILE: MessageChannels.BULK,
+    MessageTypes.MOVE_FILE: MessageChannels.BULK,
+    MessageTypes.DELETE_FILE: MessageChannels.BULK,
+    MessageTypes.FILE_TASK_CANCELLED: MessageChannels.BULK,
+    MessageTypes.FILE_STATUS_UPDATE: MessageChannels.BULK,
+    MessageTypes.FILE_STATUS_UPDATE_BATCH: MessageChannels.BULK,
+    MessageTypes.PARTIAL_RESPONSE: MessageChannels.BULK,
+    MessageTypes.BATCH: MessageChannels.BULK,
+    MessageTypes.REMOTE_FILES_CHANGED: MessageChannels.BULK,
+    MessageTypes.FILE_DATA: MessageChannels.BULK
+}
+
 
 class NetworkMessageHeader:
 
@@ -56,13 +117,52 @@ class NetworkMessage:
                 raise NetworkMessageFormatError("Invalid network message format! Passed argument must be a dict!")
             self.header = NetworkMessageHeader(raw['header'])
             self.data = raw.get('data', None)
+            self.channel = DEFAULT_MESSAGE_CHANNELS.get(self.header.messageType, MessageChannels.INTERACTIVE)
         except KeyError:
             raise NetworkMessageFormatError("Invalid network message format! Passed dict must contain key: 'header'!")
 
+    @classmethod
+    def _fromValidFields(cls, messageType, uuid, data):
+        header = NetworkMessageHeader.__new__(NetworkMessageHeader)
+        header.raw = {"messageType": messageType, "uuid": uuid}
+        header.messageType = messageType
+        header.uuid = uuid
+
+        message = cls.__new__(cls)
+        message.raw = {"header": header.raw, "data": data}
+        message.header = header
+        message.data = data
+        message.channel = DEFAULT_MESSAGE_CHANNELS.get(messageType, MessageChannels.INTERACTIVE)
+
+        return message
+
+    @classmethod
+    def fromCompact(cls, compact):
+        if type(compact) != list or len(compact) != 4:
+            raise NetworkMessageFormatError("Invalid compact network message format! Must be a list of 4 elements!")
+        version, messageType, uuid, data = compact
+        if version != COMPACT_MESSAGE_VERSION:
+            raise NetworkMessageFormatError(f"Unsupported compact message version: {version}")
+        try:
+            messageType = MessageTypes(messageType)
+        except ValueError:
+            raise NetworkMessageFormatError(f"Unknown value for messageType: {messageType}")
+        if uuid is not None:
+            if type(uuid) != bytes or len(uuid) != 16:
+                raise NetworkMessageFormatError("Invalid compact header format, uuid must be 16 bytes long!")
+            uuid = uuid.hex()
+
+        return cls._fromValidFields(messageType, uuid, data)
+
+    def toCompact(self):
+        uuid = bytes.fromhex(self.header.uuid) if self.header.uuid else None
+        return [COMPACT_MESSAGE_VERSION, int(self.header.messageType), uuid, self.data]
+
     class Builder:
         __messageType = None
         __uuid = None
         __data = None
+        __channel = None
 
         def __init__(self, messageType):
             self.__messageType = messageType
@@ -79,5 +179,53 @@ class NetworkMessage:
             self.__data = data
             return self
 
+        def withChannel(self, channel):
+            self.__channel = channel
+            return self
+
         def build(self):
-            return NetworkMessage({"header": {"messageType": self.__messageType, "uuid": self.__uuid}, "data": self.__data})
+            if self.__uuid and (type(self.__uuid) != str or len(self.__uuid) != 32):
+                raise NetworkMessageFormatError(f"Invalid uuid, must be a str with a length of 32. Received: {self.__uuid}")
+            message = NetworkMessage._fromValidFields(MessageTypes(self.__messageType), self.__uuid, self.__data)
+            if self.__channel is not None:
+                message.channel = MessageChannels(self.__channel)
+            return message
+
+
+class MessageCodec():
+
+    def __init__(self):
+        self.encoding = MessageEncodings.LEGACY
+        self.__packer = msgpack.Packer()
+
+    def encode(self, message):
+        if self.encoding == MessageEncodings.COMPACT:
+            compact = message.toCompact()
+            compact[3] = self.__tabulate(compact[3])
+            return self.__packer.pack(compact)
+        return self.__packer.pack(message.raw)
+
+    def decode(self, payload):
+        # Both encodings can be told apart by their root type, so peers may switch any time.
+        unpacked = msgpack.unpackb(payload, ext_hook=self.__extHook)
+        if type(unpacked) == list:
+            return NetworkMessage.fromCompact(unpacked)
+        return NetworkMessage(unpacked)
+
+    def __tabulate(self, value):
+        if type(value) == list:
+            if len(value) > 1 and type(value[0]) == dict:
+                keys = list(value[0].keys())
+                if all(type(item) == dict and list(item.keys()) == keys for item in value):
+                    rows = [[self.__tabulate(field) for field in item.values()] for item in value]
+                    return msgpack.ExtType(_TABLE_EXT_TYPE, self.__packer.pack([keys, rows]))
+            return [self.__tabulate(item) for item in value]
+        elif type(value) == dict:
+            return {key: self.__tabulate(field) for key, field in value.items()}
+        return value
+
+    def __extHook(self, code, data):
+        if code == _TABLE_EXT_TYPE:
+            keys, rows = msgpack.unpackb(data, ext_hook=self.__extHook)
+            return [dict(zip(keys, row)) for row in rows]
+        raise NetworkMessageFormatError(f"Unknown msgpack extension type: {code}")
@@ -1,7 +1,13 @@
 import logging
+import heapq
+import time
 
+from collections import deque
+from itertools import count
 from enum import IntEnum
 from dataclasses import dataclass
+from queue import Empty
+from threading import RLock, Condition
 
 from control.abstract import Singleton
 
@@ -15,33 +21,172 @@ class Task():
     stale: bool = False
     uuid: str = None
     data: dict = None
+    sessionID: str = None
 
 
 class TaskArchive(metaclass=Singleton):
 
     def __init__(self):
         self.__taskStorage = {}
+        # Keys with a task in progress, and the tasks waiting for it to finish.
+        self.__runningKeys = {}
+        self.__lock = RLock()
         self.__logger = logging.getLogger(__name__).getChild("TaskArchive")
 
     def clearAllTasks(self):
-        for key, task in self.__taskStorage.items():
-            task.stale = True
-        self.__taskStorage = {}
+        with self.__lock:
+            for key, task in self.__taskStorage.items():
+                task.stale = True
+            self.__taskStorage = {}
+
+    def clearSessionTasks(self, sessionID):
+        with self.__lock:
+            for key in [key for key, task in self.__taskStorage.items() if task.sessionID == sessionID]:
+                self.__taskStorage[key].stale = True
+                del self.__taskStorage[key]
+        self.__logger.debug(f"Tasks of session {sessionID} cleared.")
 
     def addTask(self, key, task):
-        self.__taskStorage[key] = task
+        with self.__lock:
+            self.__taskStorage[key] = task
         self.__logger.debug(f"Task ({task.uuid}) added under key: {key}")
 
     def removeTask(self, key):
-        try:
-            self.__logger.debug(f"Task ({self.__taskStorage[key].uuid}) removed from key: {key}")
-            del self.__taskStorage[key]
-        except KeyError:
-            self.__logger.warning(f"Remove task error: Task cannot be found under key: {key}")
+        with self.__lock:
+            try:
+                self.__logger.debug(f"Task ({self.__taskStorage[key].uuid}) removed from key: {key}")
+                del self.__taskStorage[key]
+            except KeyError:
+                self.__logger.warning(f"Remove task error: Task cannot be found under key: {key}")
 
     def cancelTask(self, key):
-        try:
-            self.__taskStorage[key].stale = True
-            self.__logger.info(f"Task ({self.__taskStorage[key].uuid}) cancelled under key: {key}")
-        except KeyError:
-            self.__logger.warning(f"Cancel task error: Task cannot be found under key: {key}")
+        with self.__lock:
+            try:
+                self.__taskStorage[key].stale = True
+                self.__logger.info(f"Task ({self.__taskStorage[key].uuid}) cancelled under key: {key}")
+            except KeyError:
+                self.__logger.warning(f"Cancel task error: Task cannot be found under key: {key}")
+
+    def startTask(self, key, task):
+        # Only one task runs for a key at a time. If one is running already, the task is handed over to its worker
+        # which runs it next, and False is returned.
+        with self.__lock:
+            if key in self.__runningKeys:
+                # Only the latest task of a key is worth running after the current one.
+                for supersededTask in self.__runningKeys[key]:
+                    supersededTask.stale = True
+                    self.__logger.debug(f"Waiting task ({supersededTask.uuid}) superseded by ({task.uuid}) under key: {key}")
+                self.__runningKeys[key].clear()
+                self.__runningKeys[key].append(task)
+                self.__logger.debug(f"Task ({task.uuid}) waits for the running task of key: {key}")
+                return False
+            self.__runningKeys[key] = deque()
+            return True
+
+    def getRunningKeys(self):
+        with self.__lock:
+            return set(self.__runningKeys)
+
+    def finishTask(self, key):
+        # Returns the next task waiting for the key, which is then considered running.
+        with self.__lock:
+            waitingTasks = self.__runningKeys.get(key)
+            if waitingTasks:
+                return waitingTasks.popleft()
+            self.__runningKeys.pop(key, None)
+            return None
+
+
+class TaskPriorities(IntEnum):
+    HIGH = 0
+    NORMAL = 1
+    LOW = 2
+
+
+class PendingTaskQueue():
+    # Long tasks waiting for a worker, indexed by their key. A new task replaces the pending task of its key in place,
+    # keeping its arrival, so superseded tasks never reach a worker. The task with the lowest rank given by the
+    # scheduler is returned first, tasks of equal rank in arrival order. Without a scheduler it is a FIFO queue.Queue.
+
+    def __init__(self, keyOf, scheduler=None):
+        self.__keyOf = keyOf
+        self.__scheduler = scheduler
+        # key -> (task, enqueuedAt, sequence, version), the heap holds (rank, sequence, version, key) entries. Entries
+        # of replaced or removed tasks are left in the heap and skipped, as their version no longer matches.
+        self.__pending = {}
+        self.__heap = []
+        self.__sequence = count()
+        self.__versions = count()
+        self.__unfinishedTasks = 0
+        self.__condition = Condition()
+        self.__logger = logging.getLogger(__name__).getChild("PendingTaskQueue")
+
+    def setScheduler(self, scheduler):
+        with self.__condition:
+            self.__scheduler = scheduler
+            self.__rebuildHeap()
+
+    def put(self, task):
+        key = self.__keyOf(task)
+        with self.__condition:
+            superseded = self.__pending.get(key)
+            if superseded:
+                supersededTask, enqueuedAt, sequence, version = superseded
+                supersededTask.stale = True
+                self.__logger.debug(f"Pending task ({supersededTask.uuid}) superseded by ({task.uuid}) under key: {key}")
+            else:
+                enqueuedAt, sequence = time.monotonic(), next(self.__sequence)
+                self.__unfinishedTasks += 1
+            self.__push(key, task, enqueuedAt, sequence)
+            if len(self.__heap) > 2 * len(self.__pending) + 64:
+                self.__rebuildHeap()
+            self.__condition.notify()
+
+    def get(self, block=True, timeout=None):
+        with self.__condition:
+            if block and not self.__condition.wait_for(lambda: self.__pending, timeout):
+                raise Empty
+            if not self.__pending:
+                raise Empty
+            while True:
+                rank, sequence, version, key = heapq.heappop(self.__heap)
+                entry = self.__pending.get(key)
+                if entry and entry[3] == version:
+                    del self.__pending[key]
+                    return entry[0]
+
+    def get_nowait(self):
+        return self.get(block=False)
+
+    def discard(self, key):
+        with self.__condition:
+            entry = self.__pending.pop(key, None)
+            if entry:
+                self.__unfinishedTasks -= 1
+                self.__logger.debug(f"Pending task ({entry[0].uuid}) discarded under key: {key}")
+
+            return entry[0] if entry else None
+
+    def task_done(self):
+        with self.__condition:
+            if self.__unfinishedTasks <= 0:
+                raise ValueError("task_done() called too many times")
+            self.__unfinishedTasks -= 1
+
+    def qsize(self):
+        with self.__condition:
+            return len(self.__pending)
+
+    def empty(self):
+        return self.qsize() == 0
+
+    def __push(self, key, task, enqueuedAt, sequence):
+        version = next(self.__versions)
+        self.__pending[key] = (task, enqueuedAt, sequence, version)
+        rank = self.__scheduler.rank(task, enqueuedAt) if self.__scheduler else 0
+        heapq.heappush(self.__heap, (rank, sequence, version, key))
+
+    def __rebuildHeap(self):
+        self.__heap = []
+        for key, (task, enqueuedAt, sequence, version) in list(self.__pending.items()):
+            self.__push(key, task, enqueuedAt, sequence)
@@ -1,13 +1,23 @@
+import os
 import logging
 import argparse
 
 from sys import stdout
 
 from control.server import Server
+from control.transport import SocketOptions, CompressionOptions, KeepaliveOptions, ResumeOptions
+from control.worker import FifoScheduler, ShortestJobFirstScheduler, PriorityScheduler
+from control.bandwidth import BandwidthLimiter, TransferDirections
 import control.cli
 
 rootLogger = logging.getLogger()
 
+argumentToTaskSchedulerMap = {
+    "fifo": lambda agingRate: FifoScheduler(),
+    "sjf": lambda agingRate: ShortestJobFirstScheduler(agingRate),
+    "priority": lambda agingRate: PriorityScheduler(agingRate)
+}
+
 
 argumentToLogLevelMap = {
     "debug": logging.DEBUG,
@@ -21,6 +31,22 @@ parser = argparse.ArgumentParser(prog="CryptStorePi Server")
 parser.add_argument("--port", dest="port", type=int, action="store", required=True, help="Port the server should listen on.")
 parser.add_argument("--key", dest="key", type=control.cli.AESKeyArgumentValidator.validate, action="store", required=True, help="16 byte AES encryption key to be used during network communications.")
 parser.add_argument("--workspace", dest="workspace", type=control.cli.WorkspaceArgumentValidator.validate, action=control.cli.CreateWorkspaceAction, required=True, help="16 byte AES encryption key to be used during network communications.")
+parser.add_argument("--sendbuffer", dest="sendbuffer", type=int, action="store", default=None, required=False, help="Size of the kernel send buffer (SO_SNDBUF) of client connections, in bytes. Uses the system default if omitted.")
+parser.add_argument("--receivebuffer", dest="receivebuffer", type=int, action="store", default=None, required=False, help="Size of the kernel receive buffer (SO_RCVBUF) of client connections, in bytes. Uses the system default if omitted.")
+parser.add_argument("--nodelay", dest="nodelay", action=argparse.BooleanOptionalAction, default=True, required=False, help="Enable or disable TCP_NODELAY on client connections.")
+parser.add_argument("--compression", dest="compression", action=argparse.BooleanOptionalAction, default=True, required=False, help="Offer zstd/zlib compression of network messages to clients.")
+parser.add_argument("--compressionthreshold", dest="compressionthreshold", type=int, action="store", default=512, required=False, help="Messages smaller than this many bytes are sent uncompressed.")
+parser.add_argument("--pollinterval", dest="pollinterval", type=int, action="store", default=60, required=False, help="Seconds between polling the cloud accounts for remote changes. 0 disables polling.")
+parser.add_argument("--keepaliveinterval", dest="keepaliveinterval", type=float, action="store", default=5.0, required=False, help="Seconds of silence after which a client is pinged.")
+parser.add_argument("--keepalivetimeout", dest="keepalivetimeout", type=float, action="store", default=15.0, required=False, help="Seconds of silence after which a client is considered dead and disconnected.")
+parser.add_argument("--resumegraceperiod", dest="resumegraceperiod", type=float, action="store", default=120.0, required=False, help="Seconds the tasks of a disconnected client are kept running, waiting for it to resume its session. 0 disables resumption.")
+parser.add_argument("--replaybuffersize", dest="replaybuffersize", type=int, action="store", default=1024, required=False, help="Maximum number of messages kept for a disconnected client.")
+parser.add_argument("--longtaskworkers", dest="longtaskworkers", type=int, action="store", default=2, required=False, help="Number of uploads and downloads handled at the same time.")
+parser.add_argument("--taskscheduler", dest="taskscheduler", type=str, action="store", default="priority", required=False, choices=["fifo", "sjf", "priority"], help="Order of the queued uploads and downloads: arrival, smallest file first, or downloads before uploads and smallest file first.")
+parser.add_argument("--taskagingrate", dest="taskagingrate", type=int, action="store", default=ShortestJobFirstScheduler.DEFAULT_AGING_RATE, required=False, help="Bytes per second of waiting a queued file is moved ahead of newer ones by the sjf and priority schedulers, so large files are not starved.")
+parser.add_argument("--uploadlimit", dest="uploadlimit", type=int, action="store", default=0, required=False, help="Total upload bandwidth to the cloud accounts in bytes per second. 0 means unlimited. Can be changed at runtime, per account too.")
+parser.add_argument("--downloadlimit", dest="downloadlimit", type=int, action="store", default=0, required=False, help="Total download bandwidth from the cloud accounts in bytes per second. 0 means unlimited. Can be changed at runtime, per account too.")
+parser.add_argument("--cryptoworkers", dest="cryptoworkers", type=int, action="store", default=os.cpu_count() or 1, required=False, help="Number of processes encrypting and decrypting file data. 0 does it on the threads transferring the files.")
 parser.add_argument("--loglevel", dest="loglevel", type=str, action="store", default="debug", required=False, choices=["debug", "info", "warning", "error", "off"], help="Log level for the server")
 
 
@@ -36,7 +62,27 @@ if __name__ == "__main__":
     rootLogger.info("Starting server")
     googleLogger = logging.getLogger("googleapiclient")
     googleLogger.setLevel(60)  # TODO temporary
-    server = Server(control.cli.CONSOLE_ARGUMENTS.port, control.cli.CONSOLE_ARGUMENTS.key)
+    socketOptions = SocketOptions(
+        sendBufferSize=control.cli.CONSOLE_ARGUMENTS.sendbuffer,
+        receiveBufferSize=control.cli.CONSOLE_ARGUMENTS.receivebuffer,
+        noDelay=control.cli.CONSOLE_ARGUMENTS.nodelay
+    )
+    compressionOptions = CompressionOptions(
+        enabled=control.cli.CONSOLE_ARGUMENTS.compression,
+        threshold=control.cli.CONSOLE_ARGUMENTS.compressionthreshold
+    )
+    keepaliveOptions = KeepaliveOptions(
+        interval=control.cli.CONSOLE_ARGUMENTS.keepaliveinterval,
+        timeout=control.cli.CONSOLE_ARGUMENTS.keepalivetimeout
+    )
+    resumeOptions = ResumeOptions(
+        gracePeriod=control.cli.CONSOLE_ARGUMENTS.resumegraceperiod,
+        replayBufferSize=control.cli.CONSOLE_ARGUMENTS.replaybuffersize
+    )
+    BandwidthLimiter().setGlobalLimit(TransferDirections.UPLOAD, control.cli.CONSOLE_ARGUMENTS.uploadlimit or None)
+    BandwidthLimiter().setGlobalLimit(TransferDirections.DOWNLOAD, control.cli.CONSOLE_ARGUMENTS.downloadlimit or None)
+    taskScheduler = argumentToTaskSchedulerMap[control.cli.CONSOLE_ARGUMENTS.taskscheduler](control.cli.CONSOLE_ARGUMENTS.taskagingrate)
+    server = Server(control.cli.CONSOLE_ARGUMENTS.port, control.cli.CONSOLE_ARGUMENTS.key, socketOptions, compressionOptions, control.cli.CONSOLE_ARGUMENTS.pollinterval, keepaliveOptions, resumeOptions, control.cli.CONSOLE_ARGUMENTS.longtaskworkers, control.cli.CONSOLE_ARGUMENTS.cryptoworkers, taskScheduler)
     try:
         server.start()
     except KeyboardInterrupt:
@@ -1,4 +1,5 @@
 import unittest
+import gc
 import warnings
 import datetime
 
@@ -8,15 +9,19 @@ from io import BytesIO
 from control.account import (
     DropboxAccountWrapper, GoogleDriveAccountWrapper,
     InterruptibleGoogleDriveUploadFileHandle, InterruptibleGoogleDriveDownloadFileHandle,
-    TaskInterruptedException, CloudAPIFactory
+    TaskInterruptedException, CloudAPIFactory, CloudAPIWrapperRegistry
 )
+from control.httppool import PooledSession
+from control.ratecontrol import RetryPolicy
 from model.account import AccountTypes, AccountData
 from model.task import Task
 from model.message import MessageTypes
 from model.file import FilePart
 
-from dropbox.files import FileMetadata, FolderMetadata
+from dropbox.exceptions import ApiError
+from dropbox.files import FileMetadata, FolderMetadata, UploadSessionLookupError, UploadSessionFinishError, UploadSessionOffsetError
 from Crypto.Cipher import AES
+from requests.exceptions import ChunkedEncodingError
 
 warnings.filterwarnings("ignore", category=DeprecationWarning)
 
@@ -88,6 +93,26 @@ class TestDropboxAccountWrapper(unittest.TestCase):
         self.assertNotEqual(encoded, testSecretData)
         self.assertEqual(cipher.decrypt(encoded), testSecretData)
 
+    @patch.object(DropboxAccountWrapper, "_RETRY_POLICY", RetryPolicy(baseDelay=0.001))
+    @patch("dropbox.Dropbox")
+    def test_failed_upload_chunk_is_resumed_from_the_offset_of_the_session(self, mockDropbox):
+        mockDropbox.return_value.files_upload_session_start.return_value.session_id = "testSessionID"
+        offsetError = UploadSessionFinishError.lookup_failed(UploadSessionLookupError.incorrect_offset(UploadSessionOffsetError(correct_offset=16 + 5)))
+        mockDropbox.return_value.files_upload_session_finish.side_effect = [ApiError("requestID", offsetError, None, None), MagicMock()]
+
+        testSecretData = b"secret test data"
+        testFileData = {"userTimezone": "+0200", "utcModified": datetime.datetime(2020, 1, 1, 10, 5, 30).timestamp(), "path": "subDir"}
+        testTask = Task(taskType=MessageTypes.UPLOAD_FILE, data=testFileData)
+
+        cloudAccount = DropboxAccountWrapper(self.testAccountData)
+        with patch.object(DropboxAccountWrapper, "_DropboxAccountWrapper__toFilePart"):
+            cloudAccount.upload(BytesIO(testSecretData), len(testSecretData), "testFile__1__1.enc", testTask)
+
+        firstAttempt, secondAttempt = mockDropbox.return_value.files_upload_session_finish.call_args_list
+        self.assertEqual(firstAttempt[0][1].offset, 16)
+        self.assertEqual(secondAttempt[0][1].offset, 16 + 5)
+        self.assertEqual(secondAttempt[0][0], firstAttempt[0][0][5:])
+
     @patch("dropbox.files.UploadSessionCursor")
     @patch("dropbox.Dropbox")
     def test_upload_does_nothing_if_task_is_stale(self, mockDropbox, mockUploadCursor):
@@ -112,63 +137,127 @@ class TestDropboxAccountWrapper(unittest.TestCase):
         self.assertEqual(uploadSessionAppender.call_count, 0)
         self.assertIsNone(result)
 
-    @patch("requests.get")
-    def test_download_file_decodes_content_if_not_interrupted(self, mockRequest):
-        secretData = b"secret test data"
-        testEncoder = AES.new(self.testAccountData.cryptoKey.encode(), AES.MODE_CFB)
-        testIV = testEncoder.iv
+    @patch("dropbox.Dropbox")
+    def test_upload_cancelled_after_the_first_chunk_stops_reading_the_file(self, mockDropbox):
+        testFileData = {"userTimezone": "+0200", "utcModified": datetime.datetime(2020, 1, 1, 10, 5, 30).timestamp(), "path": "subDir"}
+        testTask = Task(taskType=MessageTypes.UPLOAD_FILE, data=testFileData)
+        testFileHandle = MagicMock()
+        testFileHandle.read.side_effect = lambda size: b"a" * size
 
-        ivResponse = MagicMock()
-        ivResponse.content = testIV
+        def cancel(*args):
+            testTask.stale = True
 
-        encryptedDataResponse = MagicMock()
-        encryptedDataResponse.content = testEncoder.encrypt(secretData)
+        mockDropbox.return_value.files_upload_session_start.return_value.session_id = "testSessionID"
+        mockDropbox.return_value.files_upload_session_append.side_effect = cancel
 
-        mockRequest.side_effect = [ivResponse, encryptedDataResponse]
+        cloudAccount = DropboxAccountWrapper(self.testAccountData)
+        cloudAccount.upload(testFileHandle, 20 * 1048576, "testFile__1__1.enc", testTask)
 
-        testDownloadFileHandle = BytesIO()
-        testFilePartInfo = FilePart(
+        # The first chunk is sent, the second one was read ahead while the first one was being sent.
+        self.assertEqual(mockDropbox.return_value.files_upload_session_append.call_count, 1)
+        self.assertEqual(testFileHandle.read.call_count, 2)
+
+    def __createStreamedResponse(self, *pieces, status_code=200, headers=None, error=None):
+        def iterContent(chunkSize):
+            yield from pieces
+            if error:
+                raise error
+
+        response = MagicMock(status_code=status_code, headers=headers or {})
+        response.iter_content.side_effect = iterContent
+        return response
+
+    def __createFilePartInfo(self, size):
+        return FilePart(
             filename="apple.txt__1__1.enc", modified=int(datetime.datetime(2020, 1, 1, 10, 10, 30).timestamp()),
-            size=len(encryptedDataResponse.content) + len(testIV), path="", fullPath="apple.txt__1__1.enc",
-            storingAccountID=self.testAccountData.id, extraInfo={}
+            size=size, path="", fullPath="apple.txt__1__1.enc", storingAccountID=self.testAccountData.id, extraInfo={}
         )
 
+    @patch("requests.Session.get")
+    def test_download_file_decodes_content_if_not_interrupted(self, mockRequest):
+        secretData = b"secret test data"
+        testEncoder = AES.new(self.testAccountData.cryptoKey.encode(), AES.MODE_CFB)
+        encryptedData = testEncoder.iv + testEncoder.encrypt(secretData)
+
+        # The IV arrives split across pieces, so it is collected before the ciphertext.
+        mockRequest.return_value = self.__createStreamedResponse(encryptedData[:10], encryptedData[10:20], encryptedData[20:])
+
+        testDownloadFileHandle = BytesIO()
         testDownloadFileTask = Task(taskType=MessageTypes.DOWNLOAD_FILE)
         cloudAccount = DropboxAccountWrapper(self.testAccountData)
-        cloudAccount.download(testDownloadFileHandle, testFilePartInfo, testDownloadFileTask)
+        cloudAccount.download(testDownloadFileHandle, self.__createFilePartInfo(len(encryptedData)), testDownloadFileTask)
 
-        testDownloadFileHandle.seek(0)
+        self.assertEqual(secretData, testDownloadFileHandle.getvalue())
+        self.assertEqual(mockRequest.call_count, 1)
+        self.assertNotIn("Range", mockRequest.call_args.kwargs["headers"])
+        self.assertTrue(mockRequest.call_args.kwargs["stream"])
 
-        self.assertEqual(secretData, testDownloadFileHandle.read())
+    @patch("requests.Session.get")
+    def test_download_larger_than_the_buffer_is_decoded_in_order(self, mockRequest):
+        secretData = bytes(range(256)) * 9000
+        testEncoder = AES.new(self.testAccountData.cryptoKey.encode(), AES.MODE_CFB)
+        encryptedData = testEncoder.iv + testEncoder.encrypt(secretData)
+        mockRequest.return_value = self.__createStreamedResponse(*[encryptedData[start:start + 65536] for start in range(0, len(encryptedData), 65536)])
 
-    @patch("requests.get")
-    def test_download_file_does_nothing_if_task_is_stale(self, mockRequest):
+        testDownloadFileHandle = BytesIO()
+        cloudAccount = DropboxAccountWrapper(self.testAccountData)
+        cloudAccount.download(testDownloadFileHandle, self.__createFilePartInfo(len(encryptedData)), Task(taskType=MessageTypes.DOWNLOAD_FILE))
+
+        self.assertEqual(secretData, testDownloadFileHandle.getvalue())
+
+    @patch("requests.Session.get")
+    def test_throttled_download_request_is_retried(self, mockRequest):
         secretData = b"secret test data"
         testEncoder = AES.new(self.testAccountData.cryptoKey.encode(), AES.MODE_CFB)
-        testIV = testEncoder.iv
+        encryptedData = testEncoder.iv + testEncoder.encrypt(secretData)
 
-        ivResponse = MagicMock()
-        ivResponse.content = testIV
+        throttledResponse = self.__createStreamedResponse(status_code=429, headers={"Retry-After": "0.01"})
+        mockRequest.side_effect = [throttledResponse, self.__createStreamedResponse(encryptedData)]
 
-        encryptedDataResponse = MagicMock()
-        encryptedDataResponse.content = testEncoder.encrypt(secretData)
+        testDownloadFileHandle = BytesIO()
+        cloudAccount = DropboxAccountWrapper(self.testAccountData)
+        cloudAccount.download(testDownloadFileHandle, self.__createFilePartInfo(len(encryptedData)), Task(taskType=MessageTypes.DOWNLOAD_FILE))
 
-        mockRequest.side_effect = [ivResponse, encryptedDataResponse]
+        self.assertEqual(mockRequest.call_count, 2)
+        self.assertEqual(secretData, testDownloadFileHandle.getvalue())
+
+    @patch.object(DropboxAccountWrapper, "_RETRY_POLICY", RetryPolicy(baseDelay=0.001))
+    @patch("requests.Session.get")
+    def test_interrupted_download_is_resumed_with_a_range_request(self, mockRequest):
+        secretData = b"secret test data" * 4
+        testEncoder = AES.new(self.testAccountData.cryptoKey.encode(), AES.MODE_CFB)
+        encryptedData = testEncoder.iv + testEncoder.encrypt(secretData)
+
+        brokenResponse = self.__createStreamedResponse(encryptedData[:40], error=ChunkedEncodingError("Connection broken"))
+        mockRequest.side_effect = [brokenResponse, self.__createStreamedResponse(encryptedData[40:])]
 
         testDownloadFileHandle = BytesIO()
-        testFilePartInfo = FilePart(
-            filename="apple.txt__1__1.enc", modified=int(datetime.datetime(2020, 1, 1, 10, 10, 30).timestamp()),
-            size=len(encryptedDataResponse.content) + len(testIV), path="", fullPath="apple.txt__1__1.enc",
-            storingAccountID=self.testAccountData.id, extraInfo={}
-        )
+        cloudAccount = DropboxAccountWrapper(self.testAccountData)
+        cloudAccount.download(testDownloadFileHandle, self.__createFilePartInfo(len(encryptedData)), Task(taskType=MessageTypes.DOWNLOAD_FILE))
+
+        self.assertEqual(secretData, testDownloadFileHandle.getvalue())
+        self.assertEqual(mockRequest.call_args.kwargs["headers"]["Range"], "bytes=40-")
 
+    @patch("requests.Session.get")
+    def test_download_file_does_nothing_if_task_is_stale(self, mockRequest):
+        secretData = b"secret test data"
+        testEncoder = AES.new(self.testAccountData.cryptoKey.encode(), AES.MODE_CFB)
+        encryptedData = testEncoder.iv + testEncoder.encrypt(secretData)
+        mockRequest.return_value = self.__createStreamedResponse(encryptedData)
+
+        testDownloadFileHandle = BytesIO()
         testDownloadFileTask = Task(taskType=MessageTypes.DOWNLOAD_FILE, stale=True)
         cloudAccount = DropboxAccountWrapper(self.testAccountData)
-        cloudAccount.download(testDownloadFileHandle, testFilePartInfo, testDownloadFileTask)
+        cloudAccount.download(testDownloadFileHandle, self.__createFilePartInfo(len(encryptedData)), testDownloadFileTask)
 
-        testDownloadFileHandle.seek(0)
+        self.assertEqual(b"", testDownloadFileHandle.getvalue())
 
-        self.assertEqual(b"", testDownloadFileHandle.read())
+    @patch("dropbox.Dropbox")
+    def test_sdk_client_shares_the_pooled_session_of_the_wrapper(self, mockDropbox):
+        cloudAccount = DropboxAccountWrapper(self.testAccountData)
+
+        self.assertIsInstance(mockDropbox.call_args.kwargs["session"], PooledSession)
+        self.assertEqual(cloudAccount.getConnectionStats(), {"connections": 0, "requests": 0, "reused": 0})
 
     @patch("dropbox.Dropbox")
     def test_deleteFile_delegates_call_properly(self, mockDropbox):
@@ -231,5 +320,62 @@ class TestInterruptibleGoogleDriveFileHandles(unittest.TestCase):
             pass
 
 
+class TestCloudAPIWrapperRegistry(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = CloudAPIWrapperRegistry()
+        self.registry.clear()
+        self.testAccountData = AccountData(AccountTypes.Dropbox, "testIdentifier", "sixteen byte key", {"apiToken": "testApiToken"}, 1)
+
+    def tearDown(self):
+        self.registry.clear()
+
+    @patch.object(CloudAPIFactory, "create")
+    def test_wrapper_of_an_account_is_reused(self, createMock):
+        createMock.side_effect = lambda accountData: MagicMock(accountData=accountData)
+
+        wrapper = CloudAPIFactory.fromAccountData(self.testAccountData)
+        sameAccountData = AccountData(AccountTypes.Dropbox, "testIdentifier", "sixteen byte key", {"apiToken": "testApiToken"}, 1)
+
+        self.assertIs(CloudAPIFactory.fromAccountData(sameAccountData), wrapper)
+        self.assertEqual(createMock.call_count, 1)
+
+    @patch.object(CloudAPIFactory, "create")
+    def test_wrapper_is_kept_when_asked_with_outdated_account_data(self, createMock):
+        createMock.side_effect = lambda accountData: MagicMock(accountData=accountData)
+
+        wrapper = self.registry.get(self.testAccountData)
+        outdatedAccountData = AccountData(AccountTypes.Dropbox, "testIdentifier", "sixteen byte key", {"apiToken": "oldApiToken"}, 1)
+
+        self.assertIs(self.registry.get(outdatedAccountData), wrapper)
+        self.assertIs(self.registry.get(self.testAccountData), wrapper)
+        self.assertEqual(createMock.call_count, 1)
+        wrapper.close.assert_not_called()
+
+    @patch.object(CloudAPIFactory, "create")
+    def test_invalidated_wrapper_is_not_reused(self, createMock):
+        createMock.side_effect = lambda accountData: MagicMock(accountData=accountData)
+
+        wrapper = self.registry.get(self.testAccountData)
+        self.registry.invalidate(self.testAccountData.id)
+
+        self.assertIsNot(self.registry.get(self.testAccountData), wrapper)
+        self.assertEqual(createMock.call_count, 2)
+        wrapper.close.assert_not_called()
+
+    @patch("dropbox.Dropbox")
+    @patch.object(PooledSession, "close")
+    def test_session_of_an_invalidated_wrapper_is_closed_after_its_last_user(self, closeMock, mockDropbox):
+        wrapper = self.registry.get(self.testAccountData)
+        self.registry.invalidate(self.testAccountData.id)
+        gc.collect()
+        closeMock.assert_not_called()
+
+        del wrapper
+        gc.collect()
+
+        closeMock.assert_called_once()
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,83 @@
+import unittest
+import time
+
+from threading import Thread
+
+from control.bandwidth import TokenBucket, BandwidthLimiter, TransferDirections
+from model.message import MessageTypes
+from model.task import Task
+
+
+class TestTokenBucket(unittest.TestCase):
+
+    def test_unlimited_bucket_does_not_wait(self):
+        bucket = TokenBucket()
+        start = time.monotonic()
+
+        bucket.consume(1 << 30)
+
+        self.assertLess(time.monotonic() - start, 0.05)
+
+    def test_transfers_beyond_the_burst_wait_for_the_rate(self):
+        bucket = TokenBucket(rate=10000, burst=0.1)
+        start = time.monotonic()
+
+        for i in range(3):
+            bucket.consume(1000)
+
+        self.assertGreaterEqual(time.monotonic() - start, 0.18)
+
+    def test_lifting_the_limit_wakes_up_waiting_transfers(self):
+        bucket = TokenBucket(rate=100, burst=1.0)
+        bucket.consume(100)
+        waiter = Thread(target=bucket.consume, args=(100,))
+        start = time.monotonic()
+
+        waiter.start()
+        time.sleep(0.05)
+        bucket.setRate(None)
+        waiter.join(timeout=0.5)
+
+        self.assertFalse(waiter.is_alive())
+        self.assertLess(time.monotonic() - start, 0.5)
+
+    def test_transfer_of_cancelled_task_stops_waiting(self):
+        bucket = TokenBucket(rate=100, burst=1.0)
+        bucket.consume(100)
+
+        bucket.consume(100, Task(taskType=MessageTypes.UPLOAD_FILE, stale=True))
+
+
+class TestBandwidthLimiter(unittest.TestCase):
+
+    def setUp(self):
+        self.limiter = BandwidthLimiter()
+
+    def tearDown(self):
+        for direction in TransferDirections:
+            self.limiter.setGlobalLimit(direction, None)
+            self.limiter.setAccountLimit(1, direction, None)
+
+    def test_limits_are_reported_globally_and_per_account(self):
+        self.limiter.setGlobalLimit(TransferDirections.UPLOAD, 1000)
+        self.limiter.setAccountLimit(1, TransferDirections.DOWNLOAD, 500)
+
+        limits = self.limiter.getLimits()
+
+        self.assertEqual(limits["upload"], 1000)
+        self.assertIsNone(limits["download"])
+        self.assertIn({"id": 1, "upload": None, "download": 500}, limits["accounts"])
+
+    def test_transfer_is_throttled_by_the_account_limit(self):
+        self.limiter.setAccountLimit(1, TransferDirections.UPLOAD, 100000)
+        start = time.monotonic()
+
+        self.limiter.throttle(1, TransferDirections.UPLOAD, 100000)
+        self.limiter.throttle(1, TransferDirections.UPLOAD, 20000)
+        self.limiter.throttle(2, TransferDirections.UPLOAD, 1 << 30)
+
+        self.assertGreaterEqual(time.monotonic() - start, 0.18)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,70 @@
+import unittest
+import os
+
+from io import BytesIO
+
+from Crypto.Cipher import AES
+
+from control.crypto import CryptoService
+from control.util import chunkSizeGenerator
+from model.message import MessageTypes
+from model.task import Task
+
+
+class TestCryptoService(unittest.TestCase):
+
+    def setUp(self):
+        self.key = b"sixteen byte key"
+        self.iv = os.urandom(16)
+        self.data = os.urandom(10000)
+        self.service = CryptoService()
+
+    def tearDown(self):
+        self.service.stop()
+
+    def __encryptInChunks(self):
+        encryptor = self.service.encryptor(self.key, self.iv)
+        chunks = list(encryptor.encryptChunks(BytesIO(self.data), chunkSizeGenerator(len(self.data), 3000)))
+
+        self.assertEqual([remaining for data, remaining in chunks], [7000, 4000, 1000, 0])
+        return b"".join(data for data, remaining in chunks)
+
+    def __decryptInChunks(self, encrypted):
+        decryptor = self.service.decryptor(self.key, self.iv)
+
+        return b"".join(decryptor.decryptChunks(encrypted[start:start + 3000] for start in range(0, len(encrypted), 3000)))
+
+    def test_chunks_are_encrypted_and_decrypted_in_the_calling_thread_until_started(self):
+        encrypted = self.__encryptInChunks()
+
+        self.assertEqual(encrypted, AES.new(self.key, AES.MODE_CFB, iv=self.iv).encrypt(self.data))
+        self.assertEqual(self.__decryptInChunks(encrypted), self.data)
+
+    def test_chunks_processed_by_the_worker_processes_match_a_single_cipher(self):
+        self.service.start(2, chunkSize=4096)
+
+        encrypted = self.__encryptInChunks()
+
+        self.assertEqual(encrypted, AES.new(self.key, AES.MODE_CFB, iv=self.iv).encrypt(self.data))
+        self.assertEqual(self.__decryptInChunks(encrypted), self.data)
+
+    def test_encryptor_generates_an_iv_if_none_is_given(self):
+        encryptor = self.service.encryptor(self.key)
+
+        self.assertEqual(len(encryptor.iv), 16)
+        self.assertEqual(encryptor.submit(self.data).result(), AES.new(self.key, AES.MODE_CFB, iv=encryptor.iv).encrypt(self.data))
+
+
+    def test_no_chunk_is_read_once_the_task_is_stale(self):
+        task = Task(taskType=MessageTypes.UPLOAD_FILE)
+        fileHandle = BytesIO(self.data)
+        chunks = self.service.encryptor(self.key, self.iv).encryptChunks(fileHandle, chunkSizeGenerator(len(self.data), 3000), task)
+
+        next(chunks)
+        task.stale = True
+
+        self.assertEqual(list(chunks), [])
+        self.assertEqual(fileHandle.tell(), 6000)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,131 @@
+import unittest
+
+from unittest.mock import patch, MagicMock
+
+from control.detector import RemoteChangeDetector
+from control.message import MessageDispatcher
+from control.account import CloudAPIFactory
+from model.account import AccountData, AccountTypes
+from model.message import MessageTypes
+from model.file import FilePart, CloudFilesCache
+from model.task import TaskArchive
+
+
+class TestRemoteChangeDetector(unittest.TestCase):
+
+    def setUp(self):
+        self.filesCache = CloudFilesCache()
+        self.filesCache.clearData()
+        self.filesCache.insertFilePart(self.__createFilePart("unchanged", 1))
+        self.filesCache.insertFilePart(self.__createFilePart("modified", 1))
+        self.filesCache.insertFilePart(self.__createFilePart("removed", 1))
+
+        self.fakeCloudAPI = MagicMock()
+        self.fakeDB = MagicMock()
+        self.fakeDB.getAllAccounts.return_value = [AccountData(id=1, identifier="testAccountID", accountType=AccountTypes.Dropbox, cryptoKey="sixteen byte key", data={"apiToken": "testApitoken"})]
+        self.detector = RemoteChangeDetector(self.fakeDB, 60)
+
+    def tearDown(self):
+        self.filesCache.clearData()
+
+    def __createFilePart(self, name, modified, index=1, count=1, accountID=1):
+        return FilePart(filename=f"{name}__{index}__{count}.enc", modified=modified, size=32, path="", fullPath=f"{name}__{index}__{count}.enc", storingAccountID=accountID)
+
+    @patch.object(MessageDispatcher, "dispatchToConnectedSessions")
+    @patch.object(CloudAPIFactory, "fromAccountData")
+    def test_poll_pushes_added_removed_and_modified_files(self, fakeAPIFactory, dispatchMock):
+        self.fakeCloudAPI.getFileList.return_value = [self.__createFilePart("unchanged", 1), self.__createFilePart("modified", 2), self.__createFilePart("added", 1)]
+        fakeAPIFactory.return_value = self.fakeCloudAPI
+
+        self.detector.poll()
+
+        message = dispatchMock.call_args[0][0]
+        self.assertEqual(message.header.messageType, MessageTypes.REMOTE_FILES_CHANGED)
+        self.assertEqual([fileData["fullPath"] for fileData in message.data["added"]], ["added"])
+        self.assertEqual([fileData["fullPath"] for fileData in message.data["removed"]], ["removed"])
+        self.assertEqual([(fileData["fullPath"], fileData["modified"]) for fileData in message.data["modified"]], [("modified", 2)])
+        self.assertIsNone(self.filesCache.getFile("removed"))
+        self.assertIsNotNone(self.filesCache.getFile("added"))
+
+    @patch.object(MessageDispatcher, "dispatchToConnectedSessions")
+    @patch.object(CloudAPIFactory, "fromAccountData")
+    def test_poll_does_not_push_anything_without_changes(self, fakeAPIFactory, dispatchMock):
+        self.fakeCloudAPI.getFileList.return_value = [self.__createFilePart("unchanged", 1), self.__createFilePart("modified", 1), self.__createFilePart("removed", 1)]
+        fakeAPIFactory.return_value = self.fakeCloudAPI
+
+        self.detector.poll()
+
+        self.assertEqual(dispatchMock.call_count, 0)
+
+    @patch.object(MessageDispatcher, "dispatchToConnectedSessions")
+    @patch.object(CloudAPIFactory, "fromAccountData")
+    def test_poll_is_discarded_if_the_cache_changed_meanwhile(self, fakeAPIFactory, dispatchMock):
+        def insertWhileListing():
+            self.filesCache.insertFilePart(self.__createFilePart("uploadedMeanwhile", 1))
+            return [self.__createFilePart("unchanged", 1)]
+        self.fakeCloudAPI.getFileList.side_effect = insertWhileListing
+        fakeAPIFactory.return_value = self.fakeCloudAPI
+
+        self.detector.poll()
+
+        self.assertEqual(dispatchMock.call_count, 0)
+        self.assertIsNotNone(self.filesCache.getFile("removed"))
+        self.assertIsNotNone(self.filesCache.getFile("uploadedMeanwhile"))
+
+    @patch.object(MessageDispatcher, "dispatchToConnectedSessions")
+    @patch.object(CloudAPIFactory, "fromAccountData")
+    def test_file_is_only_removed_once_none_of_its_parts_are_listed(self, fakeAPIFactory, dispatchMock):
+        self.filesCache.insertFilePart(self.__createFilePart("split", 1, 1, 2, accountID=1))
+        self.filesCache.insertFilePart(self.__createFilePart("split", 1, 2, 2, accountID=2))
+        unchangedParts = [self.__createFilePart("unchanged", 1), self.__createFilePart("modified", 1), self.__createFilePart("removed", 1)]
+        fakeAPIFactory.return_value = self.fakeCloudAPI
+
+        self.fakeCloudAPI.getFileList.return_value = unchangedParts + [self.__createFilePart("split", 1, 1, 2, accountID=1)]
+        self.detector.poll()
+
+        self.assertEqual(dispatchMock.call_count, 0)
+        self.assertEqual(self.filesCache.getFile("split").availablePartCount, 2)
+
+        self.fakeCloudAPI.getFileList.return_value = unchangedParts
+        self.detector.poll()
+
+        message = dispatchMock.call_args[0][0]
+        self.assertEqual([fileData["fullPath"] for fileData in message.data["removed"]], ["split"])
+
+    @patch.object(MessageDispatcher, "dispatchToConnectedSessions")
+    @patch.object(CloudAPIFactory, "fromAccountData")
+    def test_poll_after_the_accounts_changed_is_not_reported(self, fakeAPIFactory, dispatchMock):
+        self.fakeCloudAPI.getFileList.return_value = [self.__createFilePart("unchanged", 1)]
+        fakeAPIFactory.return_value = self.fakeCloudAPI
+
+        self.filesCache.accountsChanged()
+        self.detector.poll()
+
+        self.assertEqual(dispatchMock.call_count, 0)
+        self.assertIsNone(self.filesCache.getFile("removed"))
+
+        self.detector.poll()
+
+        self.assertEqual(dispatchMock.call_count, 0)
+
+    @patch.object(MessageDispatcher, "dispatchToConnectedSessions")
+    @patch.object(CloudAPIFactory, "fromAccountData")
+    @patch.object(TaskArchive, "getRunningKeys")
+    def test_entries_of_running_tasks_are_not_replaced(self, getRunningKeysMock, fakeAPIFactory, dispatchMock):
+        getRunningKeysMock.return_value = {"uploading"}
+        self.fakeCloudAPI.getFileList.return_value = [
+            self.__createFilePart("unchanged", 1), self.__createFilePart("modified", 1), self.__createFilePart("removed", 1),
+            self.__createFilePart("uploading", 1, 1, 2)
+        ]
+        fakeAPIFactory.return_value = self.fakeCloudAPI
+
+        self.detector.poll()
+        self.filesCache.insertFilePart(self.__createFilePart("uploading", 1, 1, 2))
+        self.filesCache.insertFilePart(self.__createFilePart("uploading", 1, 2, 2))
+
+        self.assertEqual(dispatchMock.call_count, 0)
+        self.assertEqual(self.filesCache.getFile("uploading").availablePartCount, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,48 @@
+import unittest
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Thread
+
+from control.httppool import PooledSession
+
+
+class KeepAliveRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        body = b"lorem ipsum"
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class TestPooledSession(unittest.TestCase):
+
+    def setUp(self):
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), KeepAliveRequestHandler)
+        self.serverThread = Thread(target=self.server.serve_forever, daemon=True)
+        self.serverThread.start()
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}/"
+        self.session = PooledSession()
+
+    def tearDown(self):
+        self.session.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_stats_are_empty_before_the_first_request(self):
+        self.assertEqual(self.session.getConnectionStats(), {"connections": 0, "requests": 0, "reused": 0})
+
+    def test_sequential_requests_reuse_the_same_connection(self):
+        for _ in range(3):
+            self.assertEqual(self.session.get(self.url).content, b"lorem ipsum")
+
+        self.assertEqual(self.session.getConnectionStats(), {"connections": 1, "requests": 3, "reused": 2})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,11 +1,13 @@
 import unittest
 
 from unittest.mock import patch, MagicMock
-from queue import Empty
+from queue import Queue, Empty
+from uuid import uuid4
 
-from control.message import MessageDispatcher
+from control.message import MessageDispatcher, StatusUpdateCoalescer
 from model.message import NetworkMessage, MessageTypes
-from model.task import TaskArchive
+from control.stream import DataStreamInterruptedError
+from model.task import Task, TaskArchive
 
 
 class MessageDispatcherTests(unittest.TestCase):
@@ -316,3 +318,175 @@ class MessageDispatcherTests(unittest.TestCase):
 
         self.assertEqual(addTaskMock.call_count, 1)
         self.assertEqual(addTaskMock.call_args[0][0], testData["fullPath"])
+
+    def test_newer_long_task_replaces_the_pending_task_of_the_same_path(self):
+        firstMessage, otherPathMessage, replacingMessage = [
+            NetworkMessage.Builder(MessageTypes.UPLOAD_FILE).withRandomUUID().withData({"fullPath": path}).build()
+            for path in ["testFullPath", "otherFullPath", "testFullPath"]
+        ]
+        for message in [firstMessage, otherPathMessage, replacingMessage]:
+            self.dispatcher.dispatchIncomingMessage(message)
+
+        queuedTasks = [self.dispatcher.incoming_task_queue.get_nowait() for i in range(2)]
+        for task in queuedTasks:
+            self.dispatcher.incoming_task_queue.task_done()
+
+        self.assertEqual([task.uuid for task in queuedTasks], [replacingMessage.header.uuid, otherPathMessage.header.uuid])
+        self.assertTrue(self.dispatcher.incoming_task_queue.empty())
+
+    def test_cancelled_long_task_is_removed_from_the_pending_tasks(self):
+        uploadMessage = NetworkMessage.Builder(MessageTypes.UPLOAD_FILE).withRandomUUID().withData({"fullPath": "testFullPath"}).build()
+        cancelMessage = NetworkMessage.Builder(MessageTypes.FILE_TASK_CANCELLED).withRandomUUID().withData({"fullPath": "testFullPath"}).build()
+
+        self.dispatcher.dispatchIncomingMessage(uploadMessage)
+        self.dispatcher.dispatchIncomingMessage(cancelMessage)
+
+        self.assertTrue(self.dispatcher.incoming_task_queue.empty())
+
+    def test_dispatch_response_with_session_id_is_routed_to_the_session_queue(self):
+        fakeSession = MagicMock()
+        fakeSession.id = "testSessionID"
+        fakeSession.outgoingQueue = Queue()
+        testMessage = NetworkMessage.Builder(MessageTypes.RESPONSE).withRandomUUID().build()
+
+        self.dispatcher.registerSession(fakeSession)
+        self.dispatcher.dispatchResponse(testMessage, fakeSession.id)
+        self.dispatcher.unregisterSession(fakeSession.id)
+
+        try:
+            self.dispatcher.outgoing_message_queue.get_nowait()
+            self.dispatcher.outgoing_message_queue.task_done()
+            self.fail("Session bound response got queued to the broadcast queue 'outgoing_message_queue'! Should be sent to the session's outgoingQueue!")
+        except Empty:
+            pass
+
+        self.assertEqual(fakeSession.outgoingQueue.get_nowait(), testMessage)
+
+    def test_dispatch_response_for_unknown_session_is_dropped(self):
+        testMessage = NetworkMessage.Builder(MessageTypes.RESPONSE).withRandomUUID().build()
+
+        self.dispatcher.dispatchResponse(testMessage, "unknownSessionID")
+
+        try:
+            self.dispatcher.outgoing_message_queue.get_nowait()
+            self.dispatcher.outgoing_message_queue.task_done()
+            self.fail("Response of an unknown session got queued to the broadcast queue 'outgoing_message_queue'! Should be dropped!")
+        except Empty:
+            pass
+
+    def test_incoming_message_task_remembers_its_session(self):
+        testMessage = NetworkMessage.Builder(MessageTypes.GET_WORKSPACE).withRandomUUID().build()
+
+        self.dispatcher.dispatchIncomingMessage(testMessage, "testSessionID")
+
+        task = self.dispatcher.incoming_instant_task_queue.get_nowait()
+        self.dispatcher.incoming_instant_task_queue.task_done()
+        self.assertEqual(task.sessionID, "testSessionID")
+
+    def test_status_updates_are_held_back_until_a_response_is_sent_to_the_same_session(self):
+        fakeSession = MagicMock()
+        fakeSession.id = "testSessionID"
+        fakeSession.outgoingQueue = Queue()
+        testStatusUpdates = [NetworkMessage.Builder(MessageTypes.FILE_STATUS_UPDATE).withRandomUUID().withData({"fullPath": f"file_{index}"}).build() for index in range(3)]
+        testResponse = NetworkMessage.Builder(MessageTypes.RESPONSE).withRandomUUID().build()
+
+        self.dispatcher.registerSession(fakeSession)
+        for statusUpdate in testStatusUpdates:
+            self.dispatcher.dispatchResponse(statusUpdate, fakeSession.id)
+        self.assertTrue(fakeSession.outgoingQueue.empty())
+        self.dispatcher.dispatchResponse(testResponse, fakeSession.id)
+        self.dispatcher.unregisterSession(fakeSession.id)
+
+        batch = fakeSession.outgoingQueue.get_nowait()
+        self.assertEqual(batch.header.messageType, MessageTypes.FILE_STATUS_UPDATE_BATCH)
+        self.assertEqual(batch.data["updates"], [{"uuid": update.header.uuid, "data": update.data} for update in testStatusUpdates])
+        self.assertEqual(fakeSession.outgoingQueue.get_nowait(), testResponse)
+
+
+    @patch.object(TaskArchive, "addTask")
+    def test_batch_items_are_dispatched_to_their_queues_and_answered_with_per_item_results(self, addTaskMock):
+        fakeSession = MagicMock()
+        fakeSession.id = "testSessionID"
+        fakeSession.outgoingQueue = Queue()
+        testItems = [
+            {"messageType": MessageTypes.DOWNLOAD_FILE, "uuid": uuid4().hex, "data": {"fullPath": "downloaded"}},
+            {"messageType": MessageTypes.DELETE_FILE, "uuid": uuid4().hex, "data": {"fullPath": "deleted"}},
+            {"messageType": MessageTypes.GET_WORKSPACE, "uuid": uuid4().hex, "data": None},
+            {"messageType": MessageTypes.MOVE_FILE, "uuid": uuid4().hex, "data": {}}
+        ]
+        testMessage = NetworkMessage.Builder(MessageTypes.BATCH).withRandomUUID().withData({"items": testItems}).build()
+
+        self.dispatcher.registerSession(fakeSession)
+        self.dispatcher.dispatchIncomingMessage(testMessage, fakeSession.id)
+        self.dispatcher.unregisterSession(fakeSession.id)
+
+        longTask = self.dispatcher.incoming_task_queue.get_nowait()
+        self.dispatcher.incoming_task_queue.task_done()
+        instantTask = self.dispatcher.incoming_instant_task_queue.get_nowait()
+        self.dispatcher.incoming_instant_task_queue.task_done()
+        self.assertTrue(self.dispatcher.incoming_instant_task_queue.empty())
+        self.assertEqual((longTask.taskType, longTask.uuid, longTask.sessionID), (MessageTypes.DOWNLOAD_FILE, testItems[0]["uuid"], fakeSession.id))
+        self.assertEqual((instantTask.taskType, instantTask.uuid), (MessageTypes.DELETE_FILE, testItems[1]["uuid"]))
+
+        response = fakeSession.outgoingQueue.get_nowait()
+        self.assertEqual(response.header.uuid, testMessage.header.uuid)
+        self.assertEqual([result["uuid"] for result in response.data["results"]], [item["uuid"] for item in testItems])
+        self.assertEqual([result["accepted"] for result in response.data["results"]], [True, True, False, False])
+
+    def test_file_data_is_fed_to_the_open_stream_of_the_same_session_only(self):
+        fakeSession = MagicMock()
+        fakeSession.id = "testSessionID"
+        fakeSession.outgoingQueue = Queue()
+        testTask = Task(taskType=MessageTypes.UPLOAD_FILE, uuid=uuid4().hex, sessionID=fakeSession.id)
+
+        self.dispatcher.registerSession(fakeSession)
+        stream = self.dispatcher.openIncomingDataStream(testTask)
+        foreignData = NetworkMessage.Builder(MessageTypes.FILE_DATA).withUUID(testTask.uuid).withData({"offset": 0, "data": b"foreign", "last": True}).build()
+        self.dispatcher.dispatchIncomingMessage(foreignData, "otherSessionID")
+        testData = NetworkMessage.Builder(MessageTypes.FILE_DATA).withUUID(testTask.uuid).withData({"offset": 0, "data": b"Lorem ipsum", "last": True}).build()
+        self.dispatcher.dispatchIncomingMessage(testData, fakeSession.id)
+        data = stream.read(100)
+        self.dispatcher.unregisterSession(fakeSession.id)
+
+        self.assertEqual(data, b"Lorem ipsum")
+        acknowledgements = [fakeSession.outgoingQueue.get_nowait() for index in range(2)]
+        self.assertEqual([(message.header.messageType, message.data["offset"]) for message in acknowledgements], [(MessageTypes.FILE_DATA_ACK, 0), (MessageTypes.FILE_DATA_ACK, 11)])
+        with self.assertRaises(DataStreamInterruptedError):
+            stream.read(1)
+
+
+class StatusUpdateCoalescerTests(unittest.TestCase):
+
+    def __createStatusUpdate(self, index):
+        return NetworkMessage.Builder(MessageTypes.FILE_STATUS_UPDATE).withRandomUUID().withData({"fullPath": f"file_{index}"}).build()
+
+    def test_batch_is_released_when_it_reaches_the_size_cap(self):
+        coalescer = StatusUpdateCoalescer(60, 3)
+
+        self.assertIsNone(coalescer.add("testSessionID", self.__createStatusUpdate(0)))
+        self.assertIsNone(coalescer.add("testSessionID", self.__createStatusUpdate(1)))
+        batch = coalescer.add("testSessionID", self.__createStatusUpdate(2))
+
+        self.assertEqual(batch.header.messageType, MessageTypes.FILE_STATUS_UPDATE_BATCH)
+        self.assertEqual([update["data"]["fullPath"] for update in batch.data["updates"]], ["file_0", "file_1", "file_2"])
+        self.assertIsNone(coalescer.timeUntilNextFlush())
+
+    def test_batches_are_released_per_session_after_the_window(self):
+        coalescer = StatusUpdateCoalescer(0, 10)
+        coalescer.add("firstSessionID", self.__createStatusUpdate(0))
+        coalescer.add("firstSessionID", self.__createStatusUpdate(1))
+        coalescer.add("secondSessionID", self.__createStatusUpdate(2))
+
+        self.assertEqual(coalescer.timeUntilNextFlush(), 0.0)
+        batches = dict(coalescer.takeDue())
+
+        self.assertEqual(len(batches["firstSessionID"].data["updates"]), 2)
+        self.assertEqual(batches["secondSessionID"].header.messageType, MessageTypes.FILE_STATUS_UPDATE)
+        self.assertEqual(coalescer.takeDue(), [])
+
+    def test_batches_are_not_released_before_the_window(self):
+        coalescer = StatusUpdateCoalescer(60, 10)
+        coalescer.add("testSessionID", self.__createStatusUpdate(0))
+
+        self.assertEqual(coalescer.takeDue(), [])
+        self.assertGreater(coalescer.timeUntilNextFlush(), 0)
@@ -0,0 +1,116 @@
+import unittest
+import time
+
+from email.utils import format_datetime
+from datetime import datetime, timedelta, timezone
+
+from control.ratecontrol import AdaptiveRateController, RetryPolicy, ProviderThrottledError, TransientCloudError, parseRetryAfter
+from model.message import MessageTypes
+from model.task import Task
+
+
+class TestAdaptiveRateController(unittest.TestCase):
+
+    def setUp(self):
+        self.controller = AdaptiveRateController(concurrency=4, maxConcurrency=8, rate=20.0, maxRate=50.0)
+
+    def __getRetryAfter(self, exception):
+        return exception.retryAfter if isinstance(exception, ProviderThrottledError) else None
+
+    def test_throttled_call_is_retried_after_retry_after_with_halved_limits(self):
+        responses = [ProviderThrottledError("throttled", retryAfter=0.1), "lorem ipsum"]
+
+        def call():
+            response = responses.pop(0)
+            if isinstance(response, Exception):
+                raise response
+            return response
+
+        start = time.monotonic()
+        result = self.controller.call(call, self.__getRetryAfter)
+
+        self.assertEqual(result, "lorem ipsum")
+        self.assertGreaterEqual(time.monotonic() - start, 0.1)
+        self.assertEqual(self.controller.concurrency, 2)
+        self.assertEqual(self.controller.rate, 10.0)
+
+    def test_healthy_responses_ramp_the_limits_back_up(self):
+        for i in range(4):
+            self.controller.call(lambda: None, self.__getRetryAfter)
+
+        self.assertEqual(self.controller.concurrency, 5)
+        self.assertEqual(self.controller.rate, 21.0)
+
+    def test_other_errors_are_raised_without_retrying(self):
+        calls = []
+
+        def call():
+            calls.append(None)
+            raise ValueError("Lorem ipsum")
+
+        with self.assertRaises(ValueError):
+            self.controller.call(call, self.__getRetryAfter)
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(self.controller.concurrency, 4)
+
+    def test_call_gives_up_after_the_maximum_attempts(self):
+        def call():
+            raise ProviderThrottledError("throttled", retryAfter=0.001)
+
+        with self.assertRaises(ProviderThrottledError):
+            self.controller.call(call, self.__getRetryAfter)
+
+        self.assertEqual(self.controller.concurrency, 1)
+
+
+class TestRetryPolicy(unittest.TestCase):
+
+    def setUp(self):
+        self.policy = RetryPolicy(maxAttempts=3, baseDelay=0.001)
+        self.calls = 0
+
+    def __failTimes(self, failures, error):
+        def call():
+            self.calls += 1
+            if self.calls <= failures:
+                raise error
+            return "lorem ipsum"
+        return call
+
+    def __isTransient(self, exception):
+        return isinstance(exception, TransientCloudError)
+
+    def test_transient_errors_are_retried(self):
+        self.assertEqual(self.policy.call(self.__failTimes(2, TransientCloudError("Lorem ipsum")), self.__isTransient), "lorem ipsum")
+        self.assertEqual(self.calls, 3)
+
+    def test_gives_up_after_the_maximum_attempts(self):
+        with self.assertRaises(TransientCloudError):
+            self.policy.call(self.__failTimes(3, TransientCloudError("Lorem ipsum")), self.__isTransient)
+        self.assertEqual(self.calls, 3)
+
+    def test_permanent_errors_and_cancelled_tasks_are_not_retried(self):
+        with self.assertRaises(ValueError):
+            self.policy.call(self.__failTimes(1, ValueError("Lorem ipsum")), self.__isTransient)
+        with self.assertRaises(TransientCloudError):
+            self.policy.call(self.__failTimes(2, TransientCloudError("Lorem ipsum")), self.__isTransient, Task(taskType=MessageTypes.UPLOAD_FILE, stale=True))
+        self.assertEqual(self.calls, 2)
+
+
+class TestParseRetryAfter(unittest.TestCase):
+
+    def test_seconds_and_http_dates_are_parsed(self):
+        inTenSeconds = format_datetime(datetime.now(timezone.utc) + timedelta(seconds=10), usegmt=True)
+
+        self.assertEqual(parseRetryAfter("5"), 5.0)
+        self.assertAlmostEqual(parseRetryAfter(inTenSeconds), 10.0, delta=1.5)
+
+    def test_missing_and_invalid_values_give_zero(self):
+        self.assertEqual(parseRetryAfter(None), 0.0)
+        self.assertEqual(parseRetryAfter("lorem ipsum"), 0.0)
+        self.assertEqual(parseRetryAfter("-3"), 0.0)
+
+
+if __name__ == '__main__':
+    unittest.main()
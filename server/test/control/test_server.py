@@ -0,0 +1,298 @@
+import unittest
+import socket
+import selectors
+import time
+
+from queue import Empty
+from threading import Timer
+from unittest.mock import patch
+
+import msgpack
+from Crypto.Cipher import AES
+
+from control.message import MessageDispatcher
+from control.server import Server, LoopWaker
+from control.session import ClientSession, DetachedSession
+from control.transport import FrameReader, KeepaliveOptions, ResumeOptions
+from model.message import NetworkMessage, MessageTypes, MessageCodec
+
+
+class TestServerSessionResumption(unittest.TestCase):
+
+    @patch("control.server.TaskArchive")
+    @patch("control.server.WorkerPool")
+    @patch("control.server.MessageDispatcher")
+    def setUp(self, dispatcherMock, workerPoolMock, taskArchiveMock):
+        self.key = b"sixteen byte key"
+        self.server = Server(0, self.key.decode(), resumeOptions=ResumeOptions(gracePeriod=10.0, replayBufferSize=2))
+        self.dispatcher = dispatcherMock.return_value
+        self.taskArchive = taskArchiveMock.return_value
+        self.sockets = []
+
+    def tearDown(self):
+        self.server._server.close()
+        self.server._selector.close()
+        self.server._waker.close()
+        for sock in self.sockets:
+            sock.close()
+
+    def __connectSession(self, resumable=True):
+        serverSocket, clientSocket = socket.socketpair()
+        self.sockets.extend([serverSocket, clientSocket])
+        session = ClientSession(serverSocket, ("localhost", 0), self.key, resumeHandler=self.server._resumeSession)
+        session.resumable = resumable
+        self.server._sessions[session.id] = session
+
+        session.startHandshake()
+        session.sendPendingOutput()
+        clientReader = FrameReader()
+        clientReader.readFrom(clientSocket)
+        flags, payload = next(clientReader.frames())
+        hello = msgpack.unpackb(payload)
+        decoder = AES.new(self.key, AES.MODE_CFB, iv=hello["iv"])
+        decoder.decrypt(hello["encodeTest"])
+        clientReader.setDecoder(decoder)
+
+        return session, (clientSocket, clientReader)
+
+    def __receive(self, session, client):
+        clientSocket, clientReader = client
+        session.collectOutgoingMessages()
+        session.sendPendingOutput()
+        clientReader.readFrom(clientSocket)
+
+        return [MessageCodec().decode(payload) for flags, payload in clientReader.frames()]
+
+    def __response(self):
+        return NetworkMessage.Builder(MessageTypes.RESPONSE).withRandomUUID().withData({"lorem": "ipsum"}).build()
+
+    def test_disconnected_session_is_cleaned_up_when_not_resumable(self):
+        session, client = self.__connectSession(resumable=False)
+
+        self.server._handleDisconnect(session)
+
+        self.assertEqual(self.server._sessions, {})
+        self.assertEqual(self.server._detachedSessions, {})
+        self.dispatcher.unregisterSession.assert_called_once_with(session.id)
+        self.taskArchive.clearSessionTasks.assert_called_once_with(session.id)
+
+    def test_disconnected_resumable_session_is_detached_with_its_unsent_messages(self):
+        session, client = self.__connectSession()
+        response = self.__response()
+        session.outgoingQueue.put(response)
+        session.outgoingQueue.put(NetworkMessage.Builder(MessageTypes.PING).withData({"timestamp": 1.0}).build())
+
+        self.server._handleDisconnect(session)
+
+        detached = self.server._detachedSessions[session.token]
+        self.assertEqual(self.server._sessions, {})
+        self.assertEqual(detached.id, session.id)
+        self.assertIs(self.dispatcher.registerSession.call_args[0][0], detached)
+        self.taskArchive.clearSessionTasks.assert_not_called()
+        self.assertEqual(detached.outgoingQueue.drain(), [response])
+
+    def test_expired_detached_sessions_reset_their_tasks(self):
+        session, client = self.__connectSession()
+        self.server._handleDisconnect(session)
+        self.server._detachedSessions[session.token].deadline = 0.0
+
+        self.server._expireDetachedSessions()
+
+        self.assertEqual(self.server._detachedSessions, {})
+        self.dispatcher.unregisterSession.assert_called_once_with(session.id)
+        self.taskArchive.clearSessionTasks.assert_called_once_with(session.id)
+
+    def test_resumed_session_takes_over_the_detached_one_and_replays_missed_messages(self):
+        oldSession, oldClient = self.__connectSession()
+        self.server._handleDisconnect(oldSession)
+        missedResponse = self.__response()
+        self.server._detachedSessions[oldSession.token].outgoingQueue.put(missedResponse)
+
+        newSession, newClient = self.__connectSession(resumable=False)
+        self.server._resumeSession(newSession, oldSession.token)
+        received = self.__receive(newSession, newClient)
+
+        self.assertEqual(newSession.id, oldSession.id)
+        self.assertEqual(newSession.token, oldSession.token)
+        self.assertIs(self.server._sessions[oldSession.id], newSession)
+        self.assertEqual(self.server._detachedSessions, {})
+        self.assertIs(self.dispatcher.registerSession.call_args[0][0], newSession)
+        self.dispatcher.resumeDataStreams.assert_called_once_with(oldSession.id)
+        self.taskArchive.clearSessionTasks.assert_not_called()
+
+        self.assertEqual([message.header.messageType for message in received], [MessageTypes.SESSION_RESUMED, MessageTypes.RESPONSE])
+        self.assertEqual(received[0].data, {"resumed": True, "sessionToken": oldSession.token, "replayed": 1, "dropped": 0})
+        self.assertEqual(received[1].header.uuid, missedResponse.header.uuid)
+
+    def test_resuming_supersedes_a_connection_the_server_still_considers_alive(self):
+        oldSession, oldClient = self.__connectSession()
+        newSession, newClient = self.__connectSession(resumable=False)
+
+        self.server._resumeSession(newSession, oldSession.token)
+
+        self.assertEqual(newSession.id, oldSession.id)
+        self.assertEqual(list(self.server._sessions.values()), [newSession])
+        self.taskArchive.clearSessionTasks.assert_not_called()
+
+    def test_resuming_an_unknown_session_is_rejected(self):
+        session, client = self.__connectSession()
+        originalID = session.id
+
+        self.server._resumeSession(session, "unknownToken")
+        received = self.__receive(session, client)
+
+        self.assertEqual(session.id, originalID)
+        self.assertEqual([(message.header.messageType, message.data) for message in received], [(MessageTypes.SESSION_RESUMED, {"resumed": False})])
+
+    def test_broadcasts_are_kept_for_detached_sessions(self):
+        session, client = self.__connectSession()
+        self.server._handleDisconnect(session)
+        otherSession, otherClient = self.__connectSession()
+        self.server._selector.register(otherSession.connection, selectors.EVENT_READ, data=otherSession)
+        broadcast = NetworkMessage.Builder(MessageTypes.REMOTE_FILES_CHANGED).withRandomUUID().withData({}).build()
+        self.dispatcher.outgoing_message_queue.get_nowait.side_effect = [broadcast, Empty()]
+
+        self.server._collectOutgoingMessages()
+
+        self.assertEqual(self.server._detachedSessions[session.token].outgoingQueue.drain(), [broadcast])
+
+    def test_request_missing_fields_disconnects_only_its_session(self):
+        session, client = self.__connectSession(resumable=False)
+        otherSession, otherClient = self.__connectSession(resumable=False)
+        request = NetworkMessage.Builder(MessageTypes.DELETE_FILE).withRandomUUID().withData({}).build()
+        self.dispatcher.dispatchIncomingMessage.side_effect = KeyError("fullPath")
+
+        with patch.object(session, "receive", return_value=True), patch.object(session, "incomingMessages", return_value=iter([request])):
+            self.server._handleSessionEvents(session, selectors.EVENT_READ)
+
+        self.assertEqual(list(self.server._sessions.values()), [otherSession])
+        self.taskArchive.clearSessionTasks.assert_called_once_with(session.id)
+
+    def test_pong_missing_its_timestamp_disconnects_its_session(self):
+        session, client = self.__connectSession(resumable=False)
+
+        def incomingMessages():
+            raise TypeError("'NoneType' object is not subscriptable")
+            yield
+
+        with patch.object(session, "receive", return_value=True), patch.object(session, "incomingMessages", side_effect=incomingMessages):
+            self.server._handleSessionEvents(session, selectors.EVENT_READ)
+
+        self.assertEqual(self.server._sessions, {})
+
+
+class TestLoopWaker(unittest.TestCase):
+
+    def setUp(self):
+        self.waker = LoopWaker()
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.waker, selectors.EVENT_READ)
+
+    def tearDown(self):
+        self.selector.close()
+        self.waker.close()
+
+    def test_wake_makes_the_waker_readable_until_consumed(self):
+        self.assertEqual(self.selector.select(0), [])
+
+        self.waker.wake()
+        self.assertEqual(len(self.selector.select(0)), 1)
+        self.waker.consume()
+
+        self.assertEqual(self.selector.select(0), [])
+
+    def test_wake_does_not_block_when_the_pipe_is_full(self):
+        for _ in range(1 << 16):
+            self.waker.wake()
+
+        self.waker.consume()
+
+        self.assertEqual(self.selector.select(0), [])
+
+
+class TestServerLoop(unittest.TestCase):
+
+    @patch("control.server.TaskArchive")
+    @patch("control.server.WorkerPool")
+    def setUp(self, workerPoolMock, taskArchiveMock):
+        self.server = Server(0, "sixteen byte key", keepaliveOptions=KeepaliveOptions(interval=8.0, timeout=20.0))
+        self.server._selector.register(self.server._waker, selectors.EVENT_READ)
+        self.dispatcher = MessageDispatcher()
+        self.sockets = []
+
+    def tearDown(self):
+        self.dispatcher.setOutgoingMessageListener(None)
+        for session in self.server._sessions.values():
+            self.dispatcher.unregisterSession(session.id)
+        self.server._server.close()
+        self.server._selector.close()
+        self.server._waker.close()
+        for sock in self.sockets:
+            sock.close()
+
+    def __addSession(self):
+        serverSocket, clientSocket = socket.socketpair()
+        self.sockets.extend([serverSocket, clientSocket])
+        session = ClientSession(serverSocket, ("localhost", 0), b"sixteen byte key")
+        session.startHandshake()
+        session.sendPendingOutput()
+        self.server._sessions[session.id] = session
+        self.server._selector.register(serverSocket, selectors.EVENT_READ, data=session)
+        self.dispatcher.registerSession(session)
+
+        return session
+
+    def __response(self):
+        return NetworkMessage.Builder(MessageTypes.RESPONSE).withRandomUUID().withData({"lorem": "ipsum"}).build()
+
+    def test_response_dispatched_by_a_worker_wakes_the_blocked_select(self):
+        session = self.__addSession()
+        worker = Timer(0.1, self.dispatcher.dispatchResponse, args=(self.__response(), session.id))
+
+        started = time.monotonic()
+        worker.start()
+        readyKeys = self.server._selector.select(5)
+        worker.join()
+
+        self.assertLess(time.monotonic() - started, 2)
+        self.assertEqual([key.fileobj for key, events in readyKeys], [self.server._waker])
+
+    def test_idle_session_is_not_registered_for_write(self):
+        session = self.__addSession()
+
+        self.server._updateSessionInterest(session)
+
+        self.assertEqual(self.server._selector.get_key(session.connection).events, selectors.EVENT_READ)
+
+    def test_session_is_registered_for_write_only_while_it_has_output(self):
+        session = self.__addSession()
+        session.outgoingQueue.put(self.__response())
+
+        self.server._collectOutgoingMessages()
+        self.assertEqual(self.server._selector.get_key(session.connection).events, selectors.EVENT_READ | selectors.EVENT_WRITE)
+        self.server._handleSessionEvents(session, selectors.EVENT_WRITE)
+
+        self.assertEqual(self.server._selector.get_key(session.connection).events, selectors.EVENT_READ)
+
+    def test_select_blocks_without_timers_due(self):
+        self.assertIsNone(self.server._getSelectTimeout())
+
+    def test_select_timeout_is_the_nearest_deadline(self):
+        self.__addSession()
+        self.server._nextKeepaliveCheck = time.monotonic() + 2.0
+        self.server._detachedSessions["token"] = DetachedSession("sessionID", "token", time.monotonic() + 0.5, 1)
+
+        self.assertAlmostEqual(self.server._getSelectTimeout(), 0.5, delta=0.1)
+
+        del self.server._detachedSessions["token"]
+        self.assertAlmostEqual(self.server._getSelectTimeout(), 2.0, delta=0.1)
+
+    def test_overdue_keepalive_check_does_not_give_a_negative_timeout(self):
+        self.__addSession()
+        self.server._nextKeepaliveCheck = time.monotonic() - 1.0
+
+        self.assertEqual(self.server._getSelectTimeout(), 0.0)
+
+
+if __name__ == '__main__':
+    unittest.main()
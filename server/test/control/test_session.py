@@ -0,0 +1,153 @@
+import unittest
+import socket
+import time
+
+from unittest.mock import MagicMock
+
+import msgpack
+from Crypto.Cipher import AES
+
+from control.session import ClientSession, ReplayBuffer
+from control.transport import FrameReader, FrameWriter, FrameFlags, DEFAULT_FRAGMENT_SIZE
+from model.message import NetworkMessage, MessageTypes, MessageCodec
+
+
+class TestClientSession(unittest.TestCase):
+
+    def setUp(self):
+        self.key = b"sixteen byte key"
+        self.serverSocket, self.clientSocket = socket.socketpair()
+        self.session = ClientSession(self.serverSocket, ("localhost", 0), self.key)
+        self.session.startHandshake()
+        self.session.sendPendingOutput()
+
+        self.codec = MessageCodec()
+        self.clientReader = FrameReader()
+        self.clientReader.readFrom(self.clientSocket)
+        flags, payload = next(self.clientReader.frames())
+        self.hello = msgpack.unpackb(payload)
+        encoder = AES.new(self.key, AES.MODE_CFB, iv=self.hello["iv"])
+        decoder = AES.new(self.key, AES.MODE_CFB, iv=self.hello["iv"])
+        decoder.decrypt(self.hello["encodeTest"])
+        self.clientReader.setDecoder(decoder)
+        self.clientWriter = FrameWriter(encoder)
+
+    def tearDown(self):
+        self.serverSocket.close()
+        self.clientSocket.close()
+
+    def __sendToSession(self, message):
+        self.clientWriter.writeFrame(self.codec.encode(message))
+        self.clientWriter.sendTo(self.clientSocket)
+        self.session.receive()
+        return list(self.session.incomingMessages())
+
+    def __receiveFromSession(self):
+        self.session.sendPendingOutput()
+        self.clientReader.readFrom(self.clientSocket)
+        return [self.codec.decode(payload) for flags, payload in self.clientReader.frames()]
+
+    def test_hello_advertises_keepalive(self):
+        self.assertIn("keepaliveInterval", self.hello)
+        self.assertIn("keepaliveTimeout", self.hello)
+
+    def test_keepalive_is_enabled_by_session_options(self):
+        self.assertFalse(self.session.keepaliveEnabled)
+
+        dispatched = self.__sendToSession(NetworkMessage.Builder(MessageTypes.SESSION_OPTIONS).withData({"keepalive": True}).build())
+
+        self.assertEqual(dispatched, [])
+        self.assertTrue(self.session.keepaliveEnabled)
+
+    def test_ping_is_answered_with_pong_carrying_the_same_timestamp(self):
+        dispatched = self.__sendToSession(NetworkMessage.Builder(MessageTypes.PING).withData({"timestamp": 42.0}).build())
+        replies = self.__receiveFromSession()
+
+        self.assertEqual(dispatched, [])
+        self.assertEqual([(reply.header.messageType, reply.data) for reply in replies], [(MessageTypes.PONG, {"timestamp": 42.0})])
+
+    def test_pong_updates_round_trip_time(self):
+        self.session.sendPing()
+        ping = self.__receiveFromSession()[0]
+
+        self.__sendToSession(NetworkMessage.Builder(MessageTypes.PONG).withData(ping.data).build())
+
+        self.assertEqual(ping.header.messageType, MessageTypes.PING)
+        self.assertIsNotNone(self.session.roundTripTime.value)
+        self.assertGreaterEqual(self.session.roundTripTime.value, 0)
+
+    def test_receiving_data_updates_last_received_time(self):
+        before = time.monotonic()
+
+        self.__sendToSession(NetworkMessage.Builder(MessageTypes.GET_WORKSPACE).withRandomUUID().build())
+
+        self.assertGreaterEqual(self.session.lastReceived, before)
+
+    def test_hello_advertises_fragment_size(self):
+        self.assertEqual(self.hello["fragmentSize"], DEFAULT_FRAGMENT_SIZE)
+
+    def test_interactive_messages_overtake_queued_bulk_messages(self):
+        self.__sendToSession(NetworkMessage.Builder(MessageTypes.SESSION_OPTIONS).withData({"multiplexing": True}).build())
+        bulkMessage = NetworkMessage.Builder(MessageTypes.REMOTE_FILES_CHANGED).withRandomUUID().withData({"files": ["a" * 64] * 4096}).build()
+        interactiveMessage = NetworkMessage.Builder(MessageTypes.RESPONSE).withRandomUUID().withData({"moveSuccessful": True}).build()
+
+        self.session.outgoingQueue.put(bulkMessage)
+        self.session.collectOutgoingMessages()
+        self.session.outgoingQueue.put(interactiveMessage)
+        self.session.collectOutgoingMessages()
+
+        received = []
+        while len(received) < 2:
+            self.session.sendPendingOutput()
+            self.session.collectOutgoingMessages()
+            self.clientReader.readFrom(self.clientSocket)
+            received.extend([self.codec.decode(payload) for flags, payload in self.clientReader.frames()])
+
+        self.assertEqual([message.header.uuid for message in received], [interactiveMessage.header.uuid, bulkMessage.header.uuid])
+        self.assertEqual(received[1].data, bulkMessage.data)
+
+
+    def test_written_callback_is_called_once_the_message_is_framed(self):
+        message = NetworkMessage.Builder(MessageTypes.RESPONSE).withRandomUUID().withData({"files": []}).build()
+        written = MagicMock()
+
+        self.assertTrue(self.session.whenWritten(message, written))
+        self.session.outgoingQueue.put(message)
+        written.assert_not_called()
+        self.session.collectOutgoingMessages()
+
+        written.assert_called_once_with()
+
+    def test_written_callbacks_are_called_when_the_session_closes(self):
+        message = NetworkMessage.Builder(MessageTypes.RESPONSE).withRandomUUID().build()
+        written = MagicMock()
+
+        self.session.whenWritten(message, written)
+        self.session.close()
+
+        written.assert_called_once_with()
+        self.assertFalse(self.session.whenWritten(message, written))
+
+class TestReplayBuffer(unittest.TestCase):
+
+    def test_only_the_newest_messages_are_kept(self):
+        replayBuffer = ReplayBuffer(2)
+        messages = [NetworkMessage.Builder(MessageTypes.RESPONSE).withRandomUUID().build() for i in range(3)]
+        for message in messages:
+            replayBuffer.put(message)
+
+        self.assertEqual(replayBuffer.drain(), messages[1:])
+        self.assertEqual(replayBuffer.droppedCount, 1)
+        self.assertEqual(replayBuffer.drain(), [])
+
+    def test_control_messages_and_file_data_are_not_kept(self):
+        replayBuffer = ReplayBuffer(10)
+        replayBuffer.put(NetworkMessage.Builder(MessageTypes.PING).withData({"timestamp": 1.0}).build())
+        replayBuffer.put(NetworkMessage.Builder(MessageTypes.FILE_DATA).withRandomUUID().withData({"offset": 0, "data": b"", "last": True}).build())
+
+        self.assertEqual(replayBuffer.drain(), [])
+        self.assertEqual(replayBuffer.droppedCount, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
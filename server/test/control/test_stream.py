@@ -0,0 +1,218 @@
+import unittest
+import os
+import tempfile
+
+from threading import Thread
+from uuid import uuid4
+
+from control.stream import IncomingDataStream, OutgoingDataStream, SpooledDataStream, AssembledFile, DataStreamInterruptedError
+from model.message import MessageTypes
+from model.task import Task
+
+
+class TestIncomingDataStream(unittest.TestCase):
+
+    def setUp(self):
+        self.sentMessages = []
+        self.task = Task(taskType=MessageTypes.UPLOAD_FILE, uuid=uuid4().hex, sessionID="testSession")
+        self.stream = IncomingDataStream(self.task, self.sentMessages.append)
+
+    def __acknowledgedOffsets(self):
+        return [message.data["offset"] for message in self.sentMessages if message.header.messageType == MessageTypes.FILE_DATA_ACK]
+
+    def test_start_acknowledges_offset_zero(self):
+        self.stream.start()
+
+        self.assertEqual(self.__acknowledgedOffsets(), [0])
+        self.assertEqual(self.sentMessages[0].header.uuid, self.task.uuid)
+
+    def test_read_returns_fed_data_and_acknowledges_it(self):
+        self.stream.feed(0, b"Lorem ", False)
+        self.stream.feed(6, b"ipsum", True)
+
+        self.assertEqual(self.stream.read(6), b"Lorem ")
+        self.assertEqual(self.stream.read(100), b"ipsum")
+        self.assertEqual(self.stream.read(100), b"")
+        self.assertEqual(self.__acknowledgedOffsets(), [6, 11])
+
+    def test_read_waits_until_enough_data_arrived(self):
+        result = []
+        reader = Thread(target=lambda: result.append(self.stream.read(11)))
+        reader.start()
+
+        self.stream.feed(0, b"Lorem ", False)
+        self.stream.feed(6, b"ipsum", False)
+        reader.join(timeout=5)
+
+        self.assertEqual(result, [b"Lorem ipsum"])
+
+    def test_read_is_interrupted_when_the_task_goes_stale(self):
+        self.task.stale = True
+
+        with self.assertRaises(DataStreamInterruptedError):
+            self.stream.read(10)
+
+    def test_resume_tells_where_to_continue_from(self):
+        self.stream.feed(0, b"Lorem ", False)
+        self.stream.read(2)
+
+        self.stream.resume()
+
+        self.assertEqual(self.sentMessages[-1].data, {"offset": 2, "resumeFrom": 6})
+
+    def test_data_at_an_unexpected_offset_closes_the_stream(self):
+        self.stream.feed(5, b"ipsum", True)
+
+        with self.assertRaises(DataStreamInterruptedError):
+            self.stream.read(5)
+
+
+class TestOutgoingDataStream(unittest.TestCase):
+
+    def setUp(self):
+        self.sentMessages = []
+        self.task = Task(taskType=MessageTypes.DOWNLOAD_FILE, uuid=uuid4().hex, sessionID="testSession")
+        self.stream = OutgoingDataStream(self.task, self.sentMessages.append, chunkSize=4, window=8)
+
+    def test_written_data_is_sent_in_chunks_and_finished_with_an_empty_last_message(self):
+        self.stream.write(b"Lorem ")
+        self.stream.finish()
+
+        self.assertEqual([message.header.messageType for message in self.sentMessages], [MessageTypes.FILE_DATA] * 3)
+        self.assertEqual([message.data for message in self.sentMessages], [
+            {"offset": 0, "data": b"Lore", "last": False},
+            {"offset": 4, "data": b"m ", "last": False},
+            {"offset": 6, "data": b"", "last": True}
+        ])
+
+    def test_write_waits_for_acknowledgements_beyond_the_window(self):
+        writer = Thread(target=self.stream.write, args=(b"a" * 12,))
+        writer.start()
+        writer.join(timeout=0.2)
+
+        self.assertTrue(writer.is_alive())
+        self.assertEqual(len(self.sentMessages), 2)
+
+        self.stream.acknowledge(4)
+        writer.join(timeout=5)
+
+        self.assertFalse(writer.is_alive())
+        self.assertEqual(len(self.sentMessages), 3)
+
+    def test_write_is_interrupted_when_the_stream_is_closed(self):
+        self.stream.write(b"a" * 8)
+        self.stream.close()
+
+        with self.assertRaises(DataStreamInterruptedError):
+            self.stream.write(b"a")
+
+    def test_unacknowledged_data_is_sent_again_from_the_offset_of_a_resume(self):
+        self.stream.write(b"Lorem ")
+        self.stream.finish()
+        self.stream.acknowledge(4)
+
+        self.stream.acknowledge(4, resume=True)
+
+        self.assertEqual([message.data for message in self.sentMessages[3:]], [
+            {"offset": 4, "data": b"m ", "last": False},
+            {"offset": 6, "data": b"", "last": True}
+        ])
+
+    def test_wait_until_complete_returns_once_the_client_confirmed_every_byte(self):
+        self.stream.write(b"Lorem ")
+        self.stream.finish()
+        waiter = Thread(target=self.stream.waitUntilComplete)
+        waiter.start()
+        waiter.join(timeout=0.2)
+
+        self.assertTrue(waiter.is_alive())
+
+        self.stream.acknowledge(6, complete=True)
+        waiter.join(timeout=5)
+
+        self.assertFalse(waiter.is_alive())
+
+    def test_aborted_streams_are_marked_in_the_last_message(self):
+        self.stream.finish(aborted=True)
+
+        self.assertEqual(self.sentMessages[0].data, {"offset": 0, "data": b"", "last": True, "aborted": True})
+
+
+class TestSpooledDataStream(unittest.TestCase):
+
+    def setUp(self):
+        self.task = Task(taskType=MessageTypes.UPLOAD_FILE, uuid=uuid4().hex, sessionID="testSession")
+        self.source = IncomingDataStream(self.task, lambda message: None)
+        self.path = os.path.join(tempfile.mkdtemp(), self.task.uuid)
+        self.spool = SpooledDataStream(self.source, self.path)
+        self.spool.start()
+
+    def tearDown(self):
+        self.spool.close()
+        os.rmdir(os.path.dirname(self.path))
+
+    def test_parts_are_read_at_their_own_offsets_once_their_data_arrived(self):
+        firstPart, secondPart = self.spool.openPart(0), self.spool.openPart(6)
+        result = []
+        reader = Thread(target=lambda: result.append(secondPart.read(5)))
+        reader.start()
+
+        self.source.feed(0, b"Lorem ", False)
+        reader.join(timeout=0.2)
+        self.assertTrue(reader.is_alive())
+
+        self.source.feed(6, b"ipsum", True)
+        reader.join(timeout=5)
+
+        self.assertEqual(result, [b"ipsum"])
+        self.assertEqual(firstPart.read(6), b"Lorem ")
+        firstPart.close()
+        secondPart.close()
+
+    def test_reading_a_part_is_interrupted_when_the_source_is(self):
+        part = self.spool.openPart(0)
+        self.task.stale = True
+
+        with self.assertRaises(DataStreamInterruptedError):
+            part.read(5)
+
+
+if __name__ == '__main__':
+    unittest.main()
+
+
+class TestAssembledFile(unittest.TestCase):
+
+    def setUp(self):
+        workspace = tempfile.TemporaryDirectory()
+        self.addCleanup(workspace.cleanup)
+        self.assembledFile = AssembledFile(f"{workspace.name}/assembled", [5, 5])
+        self.addCleanup(self.assembledFile.close)
+
+    def test_parts_are_written_at_their_own_offsets(self):
+        with self.assembledFile.openPart(1) as secondPart:
+            secondPart.write(b"ipsum")
+        with self.assembledFile.openPart(0) as firstPart:
+            firstPart.write(b"Lor")
+            firstPart.write(b"em")
+
+        self.assertTrue(self.assembledFile.isComplete())
+        self.assertEqual(self.assembledFile.read(0, 10), b"Loremipsum")
+
+    def test_reader_only_gets_data_once_the_parts_before_it_are_complete(self):
+        firstPart, secondPart = self.assembledFile.openPart(0), self.assembledFile.openPart(1)
+        secondPart.write(b"ipsum")
+        firstPart.write(b"Lor")
+
+        self.assertEqual(self.assembledFile.read(0, 10), b"Lor")
+        firstPart.write(b"em")
+        self.assertEqual(self.assembledFile.read(3, 10), b"emipsum")
+
+    def test_reader_stops_when_the_parts_are_closed_incomplete(self):
+        firstPart, secondPart = self.assembledFile.openPart(0), self.assembledFile.openPart(1)
+        firstPart.write(b"Lorem")
+        secondPart.close()
+        firstPart.close()
+
+        self.assertEqual(self.assembledFile.read(5, 5), b"")
+        self.assertFalse(self.assembledFile.isComplete())
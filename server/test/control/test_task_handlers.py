@@ -1,5 +1,9 @@
 import unittest
+import os
+import tempfile
+import time
 
+from threading import Event
 from unittest.mock import patch, MagicMock, PropertyMock
 from uuid import uuid4
 
@@ -7,7 +11,8 @@ from uuid import uuid4
 from io import BytesIO
 import control.cli
 from control.message import *
-from control.account import CloudAPIFactory
+from control.account import CloudAPIFactory, CloudAPIWrapperRegistry
+from control.bandwidth import BandwidthLimiter, TransferDirections
 from model.account import AccountData, AccountTypes
 from model.task import Task
 from model.message import MessageTypes
@@ -69,6 +74,71 @@ class TestSetAccountListHandler(unittest.TestCase):
         self.assertEqual(dispatchResponseMock.call_args[0][0].header.messageType, MessageTypes.RESPONSE)
         self.assertEqual(dispatchResponseMock.call_args[0][0].header.uuid, testTask.uuid)
 
+    @patch.object(CloudFilesCache, "accountsChanged")
+    @patch.object(CloudAPIWrapperRegistry, "invalidate")
+    @patch.object(MessageDispatcher, "dispatchResponse")
+    def test_wrappers_of_changed_and_deleted_accounts_are_invalidated(self, dispatchResponseMock, invalidateMock, accountsChangedMock):
+        unchangedAccount, changedAccount, deletedAccount = [
+            AccountData(id=accID, identifier=f"account{accID}", accountType=AccountTypes.Dropbox, cryptoKey="sixteen byte key", data={"apiToken": "testApiToken"})
+            for accID in [1, 2, 3]
+        ]
+        self.fakeDB.getAllAccounts.return_value = [unchangedAccount, changedAccount, deletedAccount]
+        newAccounts = [unchangedAccount.serialize(), {**changedAccount.serialize(), "data": {"apiToken": "newApiToken"}}]
+        testTask = Task(taskType=MessageTypes.SET_ACCOUNT_LIST, uuid=uuid4().hex, data={"accounts": newAccounts})
+
+        self.testHandler.setTask(testTask)
+        self.testHandler.handle()
+
+        self.assertEqual(sorted(callArgs[0][0] for callArgs in invalidateMock.call_args_list), [2, 3])
+        accountsChangedMock.assert_called_once()
+
+    @patch.object(CloudFilesCache, "accountsChanged")
+    @patch.object(MessageDispatcher, "dispatchResponse")
+    def test_unchanged_accounts_keep_the_files_cache_diff(self, dispatchResponseMock, accountsChangedMock):
+        account = AccountData(id=1, identifier="account1", accountType=AccountTypes.Dropbox, cryptoKey="sixteen byte key", data={"apiToken": "testApiToken"})
+        self.fakeDB.getAllAccounts.return_value = [account]
+
+        self.testHandler.setTask(Task(taskType=MessageTypes.SET_ACCOUNT_LIST, uuid=uuid4().hex, data={"accounts": [account.serialize()]}))
+        self.testHandler.handle()
+
+        accountsChangedMock.assert_not_called()
+
+
+class TestSetBandwidthLimitsHandler(unittest.TestCase):
+
+    @patch("control.database.DatabaseAccess")
+    def setUp(self, fakeDB):
+        self.testHandler = SetBandwidthLimitsHandler(fakeDB)
+
+    def tearDown(self):
+        for direction in TransferDirections:
+            BandwidthLimiter().setGlobalLimit(direction, None)
+            BandwidthLimiter().setAccountLimit(1, direction, None)
+
+    @patch.object(MessageDispatcher, "dispatchResponse")
+    def test_handler_changes_the_given_limits_and_responds_with_all_limits(self, dispatchResponseMock):
+        testTask = Task(taskType=MessageTypes.SET_BANDWIDTH_LIMITS, uuid=uuid4().hex, data={"upload": 1000, "accounts": [{"id": 1, "download": 500}]})
+
+        self.testHandler.setTask(testTask)
+        self.testHandler.handle()
+
+        response = dispatchResponseMock.call_args[0][0]
+        self.assertEqual(response.header.uuid, testTask.uuid)
+        self.assertEqual(response.data["upload"], 1000)
+        self.assertIsNone(response.data["download"])
+        self.assertIn({"id": 1, "upload": None, "download": 500}, response.data["accounts"])
+
+    @patch.object(MessageDispatcher, "dispatchResponse")
+    def test_invalid_limits_are_rejected_without_changing_any(self, dispatchResponseMock):
+        testTask = Task(taskType=MessageTypes.SET_BANDWIDTH_LIMITS, uuid=uuid4().hex, data={"upload": 1000, "download": -5})
+
+        self.testHandler.setTask(testTask)
+        self.testHandler.handle()
+
+        response = dispatchResponseMock.call_args[0][0]
+        self.assertIn("error", response.data)
+        self.assertIsNone(response.data["upload"])
+
 
 class TestGetFileListHandler(unittest.TestCase):
 
@@ -107,6 +177,69 @@ class TestGetFileListHandler(unittest.TestCase):
         self.assertEqual(dispatchResponseMock.call_args[0][0].data[0]["path"], fakeGetFileListResponse[0].path)
         self.assertEqual(dispatchResponseMock.call_args[0][0].data[0]["fullPath"], "full_file")
 
+    @patch.object(CloudAPIFactory, "fromAccountData")
+    @patch.object(MessageDispatcher, "dispatchPagedResponse")
+    def test_get_file_list_with_page_size_sends_ordered_pages_and_ends_with_a_response(self, dispatchPagedResponseMock, fakeAPIFactory):
+        fakeCloudAPI = MagicMock()
+        fakeCloudAPI.getFileList.return_value = [
+            FilePart(filename=f"file_{index}__1__1.enc", modified=1, size=32, path="", fullPath=f"file_{index}__1__1.enc", storingAccountID=1) for index in range(5)
+        ]
+        self.fakeDB.getAllAccounts.return_value = [AccountData(id=1, identifier="testAccountID", accountType=AccountTypes.Dropbox, cryptoKey="sixteen byte key", data={"apiToken": "testApitoken"})]
+        fakeAPIFactory.return_value = fakeCloudAPI
+        testTask = Task(taskType=MessageTypes.SYNC_FILES, uuid=uuid4().hex, data={"pageSize": 2})
+
+        testHandler = GetFileListHandler(self.fakeDB)
+        testHandler.setTask(testTask)
+        testHandler.handle()
+
+        pages = list(dispatchPagedResponseMock.call_args[0][0])
+        self.assertEqual([page.header.messageType for page in pages], [MessageTypes.PARTIAL_RESPONSE, MessageTypes.PARTIAL_RESPONSE, MessageTypes.RESPONSE])
+        self.assertEqual([page.header.uuid for page in pages], [testTask.uuid] * 3)
+        self.assertEqual([page.data["continuationToken"] for page in pages], [0, 1, 2])
+        self.assertEqual([page.data["last"] for page in pages], [False, False, True])
+        self.assertEqual(sorted(file["filename"] for page in pages for file in page.data["files"]), [f"file_{index}" for index in range(5)])
+
+    @patch.object(CloudAPIFactory, "fromAccountData")
+    @patch.object(MessageDispatcher, "dispatchResponse")
+    def test_next_page_is_only_sent_once_the_previous_one_is_written(self, dispatchResponseMock, fakeAPIFactory):
+        writtenCallbacks = []
+        fakeSession = MagicMock(id="testSessionID")
+        fakeSession.whenWritten.side_effect = lambda message, callback: writtenCallbacks.append(callback) or True
+        fakeAPIFactory.return_value.getFileList.return_value = [
+            FilePart(filename=f"file_{index}__1__1.enc", modified=1, size=32, path="", fullPath=f"file_{index}__1__1.enc", storingAccountID=1) for index in range(3)
+        ]
+        self.fakeDB.getAllAccounts.return_value = [AccountData(id=1, identifier="testAccountID", accountType=AccountTypes.Dropbox, cryptoKey="sixteen byte key", data={"apiToken": "testApitoken"})]
+        testHandler = GetFileListHandler(self.fakeDB)
+        testHandler.setTask(Task(taskType=MessageTypes.SYNC_FILES, uuid=uuid4().hex, data={"pageSize": 1}, sessionID="testSessionID"))
+        MessageDispatcher().registerSession(fakeSession)
+        self.addCleanup(MessageDispatcher().unregisterSession, "testSessionID")
+
+        testHandler.handle()
+        for sentCount in range(1, 3):
+            self.assertEqual(dispatchResponseMock.call_count, sentCount)
+            writtenCallbacks[-1]()
+
+        self.assertEqual(dispatchResponseMock.call_count, 3)
+        self.assertEqual(dispatchResponseMock.call_args[0][0].header.messageType, MessageTypes.RESPONSE)
+
+    @patch.object(CloudAPIFactory, "fromAccountData")
+    @patch.object(MessageDispatcher, "dispatchResponse")
+    def test_no_more_pages_are_sent_to_a_closed_session(self, dispatchResponseMock, fakeAPIFactory):
+        fakeSession = MagicMock(id="testSessionID")
+        fakeSession.whenWritten.return_value = False
+        fakeAPIFactory.return_value.getFileList.return_value = [
+            FilePart(filename=f"file_{index}__1__1.enc", modified=1, size=32, path="", fullPath=f"file_{index}__1__1.enc", storingAccountID=1) for index in range(3)
+        ]
+        self.fakeDB.getAllAccounts.return_value = [AccountData(id=1, identifier="testAccountID", accountType=AccountTypes.Dropbox, cryptoKey="sixteen byte key", data={"apiToken": "testApitoken"})]
+        testHandler = GetFileListHandler(self.fakeDB)
+        testHandler.setTask(Task(taskType=MessageTypes.SYNC_FILES, uuid=uuid4().hex, data={"pageSize": 1}, sessionID="testSessionID"))
+        MessageDispatcher().registerSession(fakeSession)
+        self.addCleanup(MessageDispatcher().unregisterSession, "testSessionID")
+
+        testHandler.handle()
+
+        dispatchResponseMock.assert_not_called()
+
 
 class FakeGlobalConsoleArguments:
     def __init__(self, workspace):
@@ -143,13 +276,14 @@ class TestUploadFileHandler(unittest.TestCase):
         cls.fakeDB = fakeDB
 
     @patch("control.cli.CONSOLE_ARGUMENTS", FakeGlobalConsoleArguments("testWorkspace"))
+    @patch.object(MessageDispatcher, "dispatchToConnectedSessions")
     @patch.object(MessageDispatcher, "dispatchResponse")
     @patch("os.unlink")
     @patch.object(CloudFilesCache, "getFile")
     @patch.object(CloudFilesCache, "insertFilePart")
     @patch.object(CloudAPIFactory, "fromAccountData")
     @patch("control.message.open")
-    def test_uploads_file_to_single_account_and_cleans_up_server_side_file_and_creates_new_filescache_entry_and_sends_response(self, openMock, cloudApiMock, insertFilePartMock, getFileMock, os_unlinkMock, dispatchResponseMock):
+    def test_uploads_file_to_single_account_and_cleans_up_server_side_file_and_creates_new_filescache_entry_and_sends_response(self, openMock, cloudApiMock, insertFilePartMock, getFileMock, os_unlinkMock, dispatchResponseMock, dispatchToSessionsMock):
         fakeFile = BytesIO(b"Lorem ipsum")
         openMock.return_value = fakeFile
         fakeAccounts = [AccountData(id=1, identifier="testAccountID", accountType=AccountTypes.Dropbox, cryptoKey="sixteen byte key", data={"apiToken": "testApitoken"})]
@@ -201,6 +335,9 @@ class TestUploadFileHandler(unittest.TestCase):
         self.assertEqual(dispatchResponseMock.call_args[0][0].data["modified"], testTaskData["utcModified"])
         self.assertEqual(dispatchResponseMock.call_args[0][0].data["status"], FileStatuses.SYNCED)
 
+        self.assertEqual(dispatchToSessionsMock.call_args[0][0].header.messageType, MessageTypes.REMOTE_FILES_CHANGED)
+        self.assertEqual([fileData["fullPath"] for fileData in dispatchToSessionsMock.call_args[0][0].data["added"]], [testTaskData["fullPath"]])
+
     @patch("control.cli.CONSOLE_ARGUMENTS", FakeGlobalConsoleArguments("testWorkspace"))
     @patch.object(MessageDispatcher, "dispatchResponse")
     @patch("os.unlink")
@@ -314,6 +451,136 @@ class TestUploadFileHandler(unittest.TestCase):
 
         self.assertEqual(dispatchResponseMock.call_count, 0)
 
+    @patch("control.cli.CONSOLE_ARGUMENTS", FakeGlobalConsoleArguments("testWorkspace"))
+    @patch.object(MessageDispatcher, "dispatchResponse")
+    @patch("os.unlink")
+    @patch.object(CloudFilesCache, "getFile")
+    @patch.object(CloudFilesCache, "insertFilePart")
+    @patch.object(CloudAPIFactory, "fromAccountData")
+    @patch("control.message.open")
+    def test_parts_are_uploaded_from_their_own_handles_at_their_offsets(self, openMock, cloudApiMock, insertFilePartMock, getFileMock, os_unlinkMock, dispatchResponseMock):
+        partHandles = [BytesIO(b"Lorem ipsum"), BytesIO(b"Lorem ipsum")]
+        openMock.side_effect = partHandles
+        fakeAccounts = [
+            AccountData(id=1, identifier="testAccountID1", accountType=AccountTypes.Dropbox, cryptoKey="sixteen byte key", data={"apiToken": "testApitoken1"}),
+            AccountData(id=2, identifier="testAccountID2", accountType=AccountTypes.Dropbox, cryptoKey="sixteen byte key", data={"apiToken": "testApitoken2"})
+        ]
+        self.fakeDB.getAllAccounts.return_value = fakeAccounts
+        getFileMock.return_value = None
+        uploadedData = {}
+
+        def fakeUpload(handle, size, name, task):
+            uploadedData[name] = handle.read(size)
+            return MagicMock()
+        fakeCloudAccount1, fakeCloudAccount2 = MagicMock(), MagicMock()
+        fakeCloudAccount1.upload.side_effect = fakeUpload
+        fakeCloudAccount2.upload.side_effect = fakeUpload
+        cloudApiMock.side_effect = [fakeCloudAccount1, fakeCloudAccount2]
+
+        testTaskData = {"filename": "apple.txt", "size": 11, "fullPath": "subDir/apple.txt", "status": None, "utcModified": 10, "path": "subDir"}
+        testTask = Task(taskType=MessageTypes.UPLOAD_FILE, data=testTaskData, uuid=uuid4().hex)
+        testHandler = UploadFileHandler(self.fakeDB)
+        testHandler.setTask(testTask)
+
+        testHandler.handle()
+
+        self.assertEqual(uploadedData, {"apple.txt__1__2.enc": b"Lorem ", "apple.txt__2__2.enc": b"ipsum"})
+        self.assertEqual(insertFilePartMock.call_count, 2)
+        self.assertEqual(dispatchResponseMock.call_args[0][0].data["status"], FileStatuses.SYNCED)
+
+    @patch("control.cli.CONSOLE_ARGUMENTS", FakeGlobalConsoleArguments("testWorkspace"))
+    @patch.object(MessageDispatcher, "dispatchResponse")
+    @patch("os.unlink")
+    @patch.object(CloudFilesCache, "getFile")
+    @patch.object(CloudFilesCache, "insertFilePart")
+    @patch.object(CloudAPIFactory, "fromAccountData")
+    @patch("control.message.open")
+    def test_failed_part_removes_the_uploaded_parts_and_no_response_is_sent(self, openMock, cloudApiMock, insertFilePartMock, getFileMock, os_unlinkMock, dispatchResponseMock):
+        openMock.side_effect = lambda *args: BytesIO(b"Lorem ipsum")
+        fakeAccounts = [
+            AccountData(id=1, identifier="testAccountID1", accountType=AccountTypes.Dropbox, cryptoKey="sixteen byte key", data={"apiToken": "testApitoken1"}),
+            AccountData(id=2, identifier="testAccountID2", accountType=AccountTypes.Dropbox, cryptoKey="sixteen byte key", data={"apiToken": "testApitoken2"})
+        ]
+        self.fakeDB.getAllAccounts.return_value = fakeAccounts
+        getFileMock.return_value = None
+        fakeCloudAccount1, fakeCloudAccount2 = MagicMock(), MagicMock()
+        fakeCloudAccount2.upload.side_effect = ConnectionError("Lorem ipsum")
+        cloudApiMock.side_effect = [fakeCloudAccount1, fakeCloudAccount2]
+
+        testTaskData = {"filename": "apple.txt", "size": 11, "fullPath": "subDir/apple.txt", "status": None, "utcModified": 10, "path": "subDir"}
+        testTask = Task(taskType=MessageTypes.UPLOAD_FILE, data=testTaskData, uuid=uuid4().hex)
+        testHandler = UploadFileHandler(self.fakeDB)
+        testHandler.setTask(testTask)
+
+        testHandler.handle()
+
+        self.assertTrue(testTask.stale)
+        self.assertEqual(fakeCloudAccount1.deleteFile.call_args[0][0], fakeCloudAccount1.upload.return_value)
+        self.assertEqual(fakeCloudAccount2.deleteFile.call_count, 0)
+        self.assertEqual(insertFilePartMock.call_count, 0)
+        self.assertEqual(dispatchResponseMock.call_count, 0)
+
+
+class TestStreamedUploadFileHandler(unittest.TestCase):
+
+    @classmethod
+    @patch("control.database.DatabaseAccess")
+    def setUpClass(cls, fakeDB):
+        cls.fakeDB = fakeDB
+
+    @patch.object(MessageDispatcher, "closeDataStream")
+    @patch.object(MessageDispatcher, "openIncomingDataStream")
+    @patch.object(MessageDispatcher, "dispatchResponse")
+    @patch("os.unlink")
+    @patch.object(CloudFilesCache, "getFile")
+    @patch.object(CloudFilesCache, "insertFilePart")
+    @patch.object(CloudAPIFactory, "fromAccountData")
+    @patch("control.message.open")
+    def test_streamed_upload_reads_the_data_stream_instead_of_a_staging_file(self, openMock, cloudApiMock, insertFilePartMock, getFileMock, os_unlinkMock, dispatchResponseMock, openStreamMock, closeStreamMock):
+        fakeStream = BytesIO(b"Lorem ipsum")
+        openStreamMock.return_value = fakeStream
+        fakeAccounts = [AccountData(id=1, identifier="testAccountID", accountType=AccountTypes.Dropbox, cryptoKey="sixteen byte key", data={"apiToken": "testApitoken"})]
+        self.fakeDB.getAllAccounts.return_value = fakeAccounts
+        getFileMock.return_value = None
+
+        testTaskData = {"filename": "apple.txt", "size": 11, "fullPath": "subDir/apple.txt", "status": None, "utcModified": 10, "path": "subDir", "streamed": True}
+        testTask = Task(taskType=MessageTypes.UPLOAD_FILE, data=testTaskData, uuid=uuid4().hex)
+        testHandler = UploadFileHandler(self.fakeDB)
+        testHandler.setTask(testTask)
+
+        testHandler.handle()
+
+        self.assertEqual(openMock.call_count, 0)
+        self.assertEqual(os_unlinkMock.call_count, 0)
+        self.assertEqual(openStreamMock.call_args[0][0], testTask)
+        self.assertEqual(cloudApiMock.return_value.upload.call_args[0][0], fakeStream)
+        self.assertEqual(closeStreamMock.call_args[0][0], testTask.uuid)
+
+        self.assertEqual(dispatchResponseMock.call_count, 1)
+        self.assertEqual(dispatchResponseMock.call_args[0][0].data["status"], FileStatuses.SYNCED)
+
+    @patch.object(MessageDispatcher, "closeDataStream")
+    @patch.object(MessageDispatcher, "openIncomingDataStream")
+    @patch.object(MessageDispatcher, "dispatchResponse")
+    @patch.object(CloudFilesCache, "getFile")
+    @patch.object(CloudAPIFactory, "fromAccountData")
+    def test_interrupted_upload_stream_does_not_send_response(self, cloudApiMock, getFileMock, dispatchResponseMock, openStreamMock, closeStreamMock):
+        fakeAccounts = [AccountData(id=1, identifier="testAccountID", accountType=AccountTypes.Dropbox, cryptoKey="sixteen byte key", data={"apiToken": "testApitoken"})]
+        self.fakeDB.getAllAccounts.return_value = fakeAccounts
+        getFileMock.return_value = None
+        cloudApiMock.return_value.upload.side_effect = DataStreamInterruptedError("closed")
+
+        testTaskData = {"filename": "apple.txt", "size": 11, "fullPath": "subDir/apple.txt", "status": None, "utcModified": 10, "path": "subDir", "streamed": True}
+        testTask = Task(taskType=MessageTypes.UPLOAD_FILE, data=testTaskData, uuid=uuid4().hex)
+        testHandler = UploadFileHandler(self.fakeDB)
+        testHandler.setTask(testTask)
+
+        testHandler.handle()
+
+        self.assertTrue(testTask.stale)
+        self.assertEqual(closeStreamMock.call_count, 1)
+        self.assertEqual(dispatchResponseMock.call_count, 0)
+
 
 class TestDownloadFileHandler(unittest.TestCase):
 
@@ -327,9 +594,9 @@ class TestDownloadFileHandler(unittest.TestCase):
     @patch.object(MessageDispatcher, "dispatchResponse")
     @patch.object(CloudFilesCache, "getFile")
     @patch.object(CloudAPIFactory, "fromAccountData")
-    @patch("control.message.open")
-    def test_downloads_file_and_moves_it_to_client_workspace_and_sends_response(self, openMock, cloudApiMock, getFileMock, dispatchResponseMock, os_renameMock):
-        openMock.return_value = BytesIO()
+    @patch("control.message.AssembledFile")
+    def test_downloads_file_and_moves_it_to_client_workspace_and_sends_response(self, assembledFileMock, cloudApiMock, getFileMock, dispatchResponseMock, os_renameMock):
+        assembledFileMock.return_value.isComplete.return_value = True
         testFileData = FileData(filename="apple.txt", modified=10, size=10, path="subDir", fullPath="subDir/apple.txt")
         testFilePart = FilePart(
             filename="apple.txt__1__1.enc", modified=10,
@@ -350,9 +617,9 @@ class TestDownloadFileHandler(unittest.TestCase):
         testHandler.setTask(testTask)
         testHandler.handle()
 
-        self.assertEqual(openMock.call_count, 1)
-        self.assertEqual(openMock.call_args[0][0], f"testWorkspace/server/{testTask.uuid}")
-        self.assertEqual(openMock.call_args[0][1], "wb")
+        self.assertEqual(assembledFileMock.call_count, 1)
+        self.assertEqual(assembledFileMock.call_args[0][0], f"testWorkspace/server/{testTask.uuid}")
+        self.assertEqual(assembledFileMock.call_args[0][1], [testFileData.size])
 
         self.assertEqual(cloudApiMock.call_count, 1)
         self.assertEqual(cloudApiMock.call_args[0][0], fakeAccounts[0])
@@ -379,9 +646,9 @@ class TestDownloadFileHandler(unittest.TestCase):
     @patch.object(MessageDispatcher, "dispatchResponse")
     @patch.object(CloudFilesCache, "getFile")
     @patch.object(CloudAPIFactory, "fromAccountData")
-    @patch("control.message.open")
-    def test_stops_download_and_does_not_send_response_and_cleans_up_if_file_download_is_interrupted(self, openMock, cloudApiMock, getFileMock, dispatchResponseMock, os_removeMock):
-        openMock.return_value = BytesIO()
+    @patch("control.message.AssembledFile")
+    def test_stops_download_and_does_not_send_response_and_cleans_up_if_file_download_is_interrupted(self, assembledFileMock, cloudApiMock, getFileMock, dispatchResponseMock, os_removeMock):
+        assembledFileMock.return_value.isComplete.return_value = True
         testFileData = FileData(filename="apple.txt", modified=10, size=10, path="subDir", fullPath="subDir/apple.txt")
         testFilePart = FilePart(
             filename="apple.txt__1__1.enc", modified=10,
@@ -402,9 +669,9 @@ class TestDownloadFileHandler(unittest.TestCase):
         testHandler.setTask(testTask)
         testHandler.handle()
 
-        self.assertEqual(openMock.call_count, 1)
-        self.assertEqual(openMock.call_args[0][0], f"testWorkspace/server/{testTask.uuid}")
-        self.assertEqual(openMock.call_args[0][1], "wb")
+        self.assertEqual(assembledFileMock.call_count, 1)
+        self.assertEqual(assembledFileMock.call_args[0][0], f"testWorkspace/server/{testTask.uuid}")
+        self.assertEqual(assembledFileMock.call_args[0][1], [testFileData.size])
 
         self.assertEqual(dispatchResponseMock.call_count, 0)
 
@@ -412,6 +679,166 @@ class TestDownloadFileHandler(unittest.TestCase):
         self.assertEqual(os_removeMock.call_args[0][0], f"testWorkspace/server/{testTask.uuid}")
 
 
+    def __createSplitFile(self):
+        testFileData = FileData(filename="apple.txt", modified=10, size=10, path="subDir", fullPath="subDir/apple.txt")
+        testFileParts = [
+            FilePart(
+                filename=f"apple.txt__{index}__2.enc", modified=10, size=5 + 16, path="subDir",
+                fullPath=f"subDir/apple.txt__{index}__2.enc", storingAccountID=index
+            ) for index in (1, 2)
+        ]
+        self.fakeDB.getAllAccounts.return_value = [
+            AccountData(id=index, identifier=f"testAccountID{index}", accountType=AccountTypes.Dropbox, cryptoKey="sixteen byte key", data={"apiToken": f"testApitoken{index}"})
+            for index in (1, 2)
+        ]
+
+        return testFileData, CachedFileData(data=testFileData, availablePartCount=2, totalPartCount=2, parts={part.fullPath: part for part in testFileParts})
+
+    def __createWorkspace(self):
+        workspace = tempfile.TemporaryDirectory()
+        self.addCleanup(workspace.cleanup)
+        os.mkdir(f"{workspace.name}/server")
+        os.mkdir(f"{workspace.name}/client")
+
+        return workspace.name
+
+    @patch.object(MessageDispatcher, "dispatchResponse")
+    @patch.object(CloudFilesCache, "getFile")
+    @patch.object(CloudAPIFactory, "fromAccountData")
+    def test_parts_are_downloaded_concurrently_to_their_offsets(self, cloudApiMock, getFileMock, dispatchResponseMock):
+        testFileData, getFileMock.return_value = self.__createSplitFile()
+        secondPartWritten = Event()
+
+        def fakeDownload(accountData):
+            fakeCloudAccount = MagicMock()
+            if accountData.id == 1:
+                fakeCloudAccount.download.side_effect = lambda fileHandle, part, task: secondPartWritten.wait(5) and fileHandle.write(b"Lorem")
+            else:
+                fakeCloudAccount.download.side_effect = lambda fileHandle, part, task: fileHandle.write(b"ipsum") and secondPartWritten.set()
+            return fakeCloudAccount
+        cloudApiMock.side_effect = fakeDownload
+
+        workspace = self.__createWorkspace()
+        testTask = Task(taskType=MessageTypes.DOWNLOAD_FILE, data=testFileData.serialize(), uuid=uuid4().hex)
+        with patch("control.cli.CONSOLE_ARGUMENTS", FakeGlobalConsoleArguments(workspace)):
+            testHandler = DownloadFileHandler(self.fakeDB)
+            testHandler.setTask(testTask)
+            testHandler.handle()
+
+        self.assertFalse(testTask.stale)
+        with open(f"{workspace}/client/{testTask.uuid}", "rb") as downloadedFile:
+            self.assertEqual(downloadedFile.read(), b"Loremipsum")
+        self.assertEqual(dispatchResponseMock.call_count, 1)
+
+    @patch.object(MessageDispatcher, "dispatchResponse")
+    @patch.object(CloudFilesCache, "getFile")
+    @patch.object(CloudAPIFactory, "fromAccountData")
+    def test_failing_part_cancels_the_other_parts_and_cleans_up(self, cloudApiMock, getFileMock, dispatchResponseMock):
+        testFileData, getFileMock.return_value = self.__createSplitFile()
+
+        def waitUntilStale(fileHandle, part, task):
+            while not task.stale:
+                time.sleep(0.01)
+
+        fakeCloudAccount1, fakeCloudAccount2 = MagicMock(), MagicMock()
+        fakeCloudAccount1.download.side_effect = waitUntilStale
+        fakeCloudAccount2.download.side_effect = ConnectionError("Lorem ipsum")
+        cloudApiMock.side_effect = [fakeCloudAccount1, fakeCloudAccount2]
+
+        workspace = self.__createWorkspace()
+        testTask = Task(taskType=MessageTypes.DOWNLOAD_FILE, data=testFileData.serialize(), uuid=uuid4().hex)
+        with patch("control.cli.CONSOLE_ARGUMENTS", FakeGlobalConsoleArguments(workspace)):
+            testHandler = DownloadFileHandler(self.fakeDB)
+            testHandler.setTask(testTask)
+            testHandler.handle()
+
+        self.assertTrue(testTask.stale)
+        self.assertEqual(os.listdir(f"{workspace}/server"), [])
+        self.assertEqual(os.listdir(f"{workspace}/client"), [])
+        self.assertEqual(dispatchResponseMock.call_count, 0)
+
+
+class TestStreamedDownloadFileHandler(unittest.TestCase):
+
+    @classmethod
+    @patch("control.database.DatabaseAccess")
+    def setUpClass(cls, fakeDB):
+        cls.fakeDB = fakeDB
+
+    @patch("os.rename")
+    @patch.object(MessageDispatcher, "closeDataStream")
+    @patch.object(MessageDispatcher, "openOutgoingDataStream")
+    @patch.object(MessageDispatcher, "dispatchResponse")
+    @patch.object(CloudFilesCache, "getFile")
+    @patch.object(CloudAPIFactory, "fromAccountData")
+    @patch("control.message.open")
+    def test_streamed_download_writes_to_the_data_stream_and_sends_response(self, openMock, cloudApiMock, getFileMock, dispatchResponseMock, openStreamMock, closeStreamMock, os_renameMock):
+        testFileData = FileData(filename="apple.txt", modified=10, size=10, path="subDir", fullPath="subDir/apple.txt")
+        testFilePart = FilePart(
+            filename="apple.txt__1__1.enc", modified=10,
+            size=testFileData.size + 16, path="subDir",
+            fullPath="subDir/apple.txt__1__1.enc", storingAccountID=1
+        )
+        self.fakeDB.getAllAccounts.return_value = [AccountData(id=1, identifier="testAccountID1", accountType=AccountTypes.Dropbox, cryptoKey="sixteen byte key", data={"apiToken": "testApitoken1"})]
+        getFileMock.return_value = CachedFileData(data=testFileData, availablePartCount=1, totalPartCount=1, parts={"subDir/apple.txt__1__1.enc": testFilePart})
+
+        testTask = Task(taskType=MessageTypes.DOWNLOAD_FILE, data={**testFileData.serialize(), "streamed": True}, uuid=uuid4().hex)
+        testHandler = DownloadFileHandler(self.fakeDB)
+        testHandler.setTask(testTask)
+        testHandler.handle()
+
+        self.assertEqual(openMock.call_count, 0)
+        self.assertEqual(os_renameMock.call_count, 0)
+        self.assertEqual(cloudApiMock.return_value.download.call_args[0][0], openStreamMock.return_value)
+        self.assertEqual(openStreamMock.return_value.finish.call_args[1], {"aborted": False})
+        self.assertEqual(closeStreamMock.call_args[0][0], testTask.uuid)
+
+        self.assertEqual(dispatchResponseMock.call_count, 1)
+        self.assertEqual(dispatchResponseMock.call_args[0][0].data["status"], FileStatuses.DOWNLOADING_TO_LOCAL)
+        self.assertNotIn("streamed", dispatchResponseMock.call_args[0][0].data)
+        self.assertTrue(testTask.data["streamed"])
+
+
+    @patch.object(MessageDispatcher, "closeDataStream")
+    @patch.object(MessageDispatcher, "openOutgoingDataStream")
+    @patch.object(MessageDispatcher, "dispatchResponse")
+    @patch.object(CloudFilesCache, "getFile")
+    @patch.object(CloudAPIFactory, "fromAccountData")
+    def test_streamed_download_of_split_file_sends_the_parts_in_order(self, cloudApiMock, getFileMock, dispatchResponseMock, openStreamMock, closeStreamMock):
+        testFileData = FileData(filename="apple.txt", modified=10, size=10, path="subDir", fullPath="subDir/apple.txt")
+        testFileParts = {
+            f"subDir/apple.txt__{index}__2.enc": FilePart(
+                filename=f"apple.txt__{index}__2.enc", modified=10, size=5 + 16, path="subDir",
+                fullPath=f"subDir/apple.txt__{index}__2.enc", storingAccountID=index
+            ) for index in (1, 2)
+        }
+        self.fakeDB.getAllAccounts.return_value = [
+            AccountData(id=index, identifier=f"testAccountID{index}", accountType=AccountTypes.Dropbox, cryptoKey="sixteen byte key", data={"apiToken": f"testApitoken{index}"})
+            for index in (1, 2)
+        ]
+        getFileMock.return_value = CachedFileData(data=testFileData, availablePartCount=2, totalPartCount=2, parts=testFileParts)
+        fakeCloudAccount1, fakeCloudAccount2 = MagicMock(), MagicMock()
+        fakeCloudAccount1.download.side_effect = lambda fileHandle, part, task: fileHandle.write(b"Lorem")
+        fakeCloudAccount2.download.side_effect = lambda fileHandle, part, task: fileHandle.write(b"ipsum")
+        cloudApiMock.side_effect = [fakeCloudAccount1, fakeCloudAccount2]
+        sentData = []
+        openStreamMock.return_value.write.side_effect = sentData.append
+
+        workspace = tempfile.TemporaryDirectory()
+        self.addCleanup(workspace.cleanup)
+        os.mkdir(f"{workspace.name}/server")
+        testTask = Task(taskType=MessageTypes.DOWNLOAD_FILE, data={**testFileData.serialize(), "streamed": True}, uuid=uuid4().hex)
+        with patch("control.cli.CONSOLE_ARGUMENTS", FakeGlobalConsoleArguments(workspace.name)):
+            testHandler = DownloadFileHandler(self.fakeDB)
+            testHandler.setTask(testTask)
+            testHandler.handle()
+
+        self.assertEqual(b"".join(sentData), b"Loremipsum")
+        self.assertEqual(openStreamMock.return_value.finish.call_args[1], {"aborted": False})
+        self.assertEqual(os.listdir(f"{workspace.name}/server"), [])
+        self.assertEqual(dispatchResponseMock.call_count, 1)
+
+
 class TestDeleteFileHandler(unittest.TestCase):
 
     @classmethod
@@ -469,6 +896,25 @@ class TestDeleteFileHandler(unittest.TestCase):
         self.assertEqual(fakeCloudAccount2.deleteFile.call_count, 1)
         self.assertEqual(fakeCloudAccount2.deleteFile.call_args[0][0], testFileParts[1])
 
+    @patch.object(MessageDispatcher, "dispatchToConnectedSessions")
+    @patch.object(CloudFilesCache, "removeFile")
+    @patch.object(CloudAPIFactory, "fromAccountData")
+    @patch.object(CloudFilesCache, "getFile")
+    def test_deleted_file_is_reported_to_the_other_sessions(self, getFileMock, cloudApiMock, removeFileMock, dispatchMock):
+        testFileData = FileData(filename="apple.txt", modified=10, size=10, path="", fullPath="apple.txt")
+        testFilePart = FilePart(filename="apple.txt__1__1.enc", modified=10, size=26, path="", fullPath="apple.txt__1__1.enc", storingAccountID=1)
+        self.fakeDB.getAllAccounts.return_value = [AccountData(id=1, identifier="testAccountID1", accountType=AccountTypes.Dropbox, cryptoKey="sixteen byte key", data={"apiToken": "testApitoken1"})]
+        getFileMock.return_value = CachedFileData(data=testFileData, availablePartCount=1, totalPartCount=1, parts={testFilePart.filename: testFilePart})
+
+        testHandler = DeleteFileHandler(self.fakeDB)
+        testHandler.setTask(Task(taskType=MessageTypes.DELETE_FILE, data={"fullPath": "apple.txt"}, sessionID="testSessionID"))
+        testHandler.handle()
+
+        message, exceptSessionID = dispatchMock.call_args[0]
+        self.assertEqual(message.header.messageType, MessageTypes.REMOTE_FILES_CHANGED)
+        self.assertEqual(message.data, {"added": [], "removed": [testFileData.serialize()], "modified": []})
+        self.assertEqual(exceptSessionID, "testSessionID")
+
 
 class TestMoveFileHandler(unittest.TestCase):
 
@@ -477,12 +923,13 @@ class TestMoveFileHandler(unittest.TestCase):
     def setUpClass(cls, fakeDB):
         cls.fakeDB = fakeDB
 
+    @patch.object(MessageDispatcher, "dispatchToConnectedSessions")
     @patch.object(CloudFilesCache, "moveFile")
     @patch.object(MessageDispatcher, "dispatchResponse")
     @patch.object(CloudFilesCache, "removeFile")
     @patch.object(CloudAPIFactory, "fromAccountData")
     @patch.object(CloudFilesCache, "getFile")
-    def test_removes_destination_path_on_all_accounts_then_moves_synced_files_and_sends_successful_response(self, getFileMock, cloudApiMock, removeFileMock, dispatchResponseMock, moveFileMock):
+    def test_removes_destination_path_on_all_accounts_then_moves_synced_files_and_sends_successful_response(self, getFileMock, cloudApiMock, removeFileMock, dispatchResponseMock, moveFileMock, dispatchToSessionsMock):
         testSourceFileData = FileData(filename="apple.txt", modified=10, size=10, path="", fullPath="apple.txt")
         testTargetFileData = FileData(filename="apple.txt", modified=10, size=20, path="subDir", fullPath="subDir/apple.txt")
 
@@ -541,6 +988,10 @@ class TestMoveFileHandler(unittest.TestCase):
         self.assertEqual(moveFileMock.call_args[0][0], "apple.txt")
         self.assertEqual(moveFileMock.call_args[0][1], "subDir/apple.txt")
 
+        changes = dispatchToSessionsMock.call_args[0][0].data
+        self.assertEqual([fileData["fullPath"] for fileData in changes["removed"]], ["subDir/apple.txt", "apple.txt"])
+        self.assertEqual([fileData["fullPath"] for fileData in changes["added"]], ["subDir/apple.txt"])
+
     @patch.object(CloudFilesCache, "moveFile")
     @patch.object(MessageDispatcher, "dispatchResponse")
     @patch.object(CloudFilesCache, "removeFile")
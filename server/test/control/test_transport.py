@@ -0,0 +1,274 @@
+import unittest
+import socket
+import os
+import zlib
+
+from unittest.mock import patch
+
+import msgpack
+from Crypto.Cipher import AES
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from control.transport import FrameReader, FrameWriter, FrameMultiplexer, FrameFlags, FrameFormatError, FrameCompressor, Compressions, RoundTripTimeEstimator, SUPPORTED_COMPRESSIONS, FRAME_HEADER, MAX_FRAME_SIZE, decompressPayload
+
+
+class TestFramedTransport(unittest.TestCase):
+
+    def setUp(self):
+        self.key = b"sixteen byte key"
+        self.sender, self.receiver = socket.socketpair()
+        encoder = AES.new(self.key, AES.MODE_CFB)
+        decoder = AES.new(self.key, AES.MODE_CFB, iv=encoder.iv)
+        self.writer = FrameWriter(encoder)
+        self.reader = FrameReader(decoder, initialBufferSize=64)
+
+    def tearDown(self):
+        self.sender.close()
+        self.receiver.close()
+
+    def __sendAll(self):
+        while self.writer.sendTo(self.sender) > 0:
+            pass
+
+    def __readFrames(self, expectedCount):
+        frames = []
+        while len(frames) < expectedCount:
+            self.assertGreater(self.reader.readFrom(self.receiver), 0)
+            frames.extend([(flags, bytes(payload)) for flags, payload in self.reader.frames()])
+        return frames
+
+    def test_frames_are_encrypted_on_the_wire_and_decrypted_by_the_reader(self):
+        testPayload = msgpack.packb({"header": {"messageType": 0, "uuid": None}, "data": "secret"})
+
+        self.writer.writeFrame(testPayload)
+        self.__sendAll()
+        frames = self.__readFrames(1)
+
+        self.assertEqual(frames, [(FrameFlags.NONE, testPayload)])
+
+    def test_plaintext_frames_are_not_encrypted(self):
+        testPayload = b"session data"
+
+        self.writer.writeFrame(testPayload, FrameFlags.PLAINTEXT)
+        self.__sendAll()
+        rawFrame = self.receiver.recv(1024)
+
+        self.assertEqual(rawFrame, FRAME_HEADER.pack(len(testPayload), FrameFlags.PLAINTEXT) + testPayload)
+
+    def test_reader_grows_its_buffer_for_frames_bigger_than_the_buffer(self):
+        testPayloads = [bytes([index]) * (index * 100) for index in range(1, 6)]
+
+        for payload in testPayloads:
+            self.writer.writeFrame(payload)
+        self.__sendAll()
+        frames = self.__readFrames(len(testPayloads))
+
+        self.assertEqual([payload for flags, payload in frames], testPayloads)
+
+    def test_reader_reassembles_frames_split_across_reads(self):
+        testPayload = b"lorem ipsum dolor sit amet" * 3
+        self.writer.writeFrame(testPayload)
+        self.writer.writeFrame(testPayload)
+        self.__sendAll()
+
+        frames = []
+        while len(frames) < 2:
+            self.reader.readFrom(self.receiver)
+            frames.extend([bytes(payload) for flags, payload in self.reader.frames()])
+
+        self.assertEqual(frames, [testPayload, testPayload])
+
+    def test_reader_rejects_oversized_frames(self):
+        self.sender.sendall(FRAME_HEADER.pack(MAX_FRAME_SIZE + 1, FrameFlags.NONE))
+        self.reader.readFrom(self.receiver)
+
+        with self.assertRaises(FrameFormatError):
+            list(self.reader.frames())
+
+    def test_reader_limits_frames_until_the_limit_is_raised(self):
+        reader = FrameReader(maxFrameSize=1024)
+        self.sender.sendall(FRAME_HEADER.pack(1025, FrameFlags.PLAINTEXT) + b"a" * 1025)
+        received = 0
+        while received < FRAME_HEADER.size + 1025:
+            received += reader.readFrom(self.receiver)
+
+        with self.assertRaises(FrameFormatError):
+            list(reader.frames())
+        reader.setMaxFrameSize(2048)
+
+        self.assertEqual([bytes(payload) for flags, payload in reader.frames()], [b"a" * 1025])
+
+    @patch("control.transport.MAX_MESSAGE_SIZE", 8)
+    def test_reader_rejects_fragmented_messages_above_the_message_size(self):
+        fragment = FRAME_HEADER.pack(4, FrameFlags.PLAINTEXT | FrameFlags.MORE_FRAGMENTS) + b"abcd"
+        self.sender.sendall(fragment * 3)
+        self.reader.readFrom(self.receiver)
+
+        with self.assertRaises(FrameFormatError):
+            list(self.reader.frames())
+
+    def test_frames_above_the_threshold_are_compressed(self):
+        testPayload = msgpack.packb([{"path": "some/long/path", "filename": "file.txt", "fullPath": "some/long/path/file.txt"}] * 50)
+        self.writer.setCompressor(FrameCompressor(Compressions.ZLIB, 128))
+
+        self.writer.writeFrame(testPayload)
+        self.__sendAll()
+        frames = self.__readFrames(1)
+
+        self.assertEqual(frames, [(FrameFlags.COMPRESSED_ZLIB, testPayload)])
+
+    def test_frames_below_the_threshold_are_not_compressed(self):
+        testPayload = b"a" * 127
+        self.writer.setCompressor(FrameCompressor(Compressions.ZLIB, 128))
+
+        self.writer.writeFrame(testPayload)
+        self.__sendAll()
+        frames = self.__readFrames(1)
+
+        self.assertEqual(frames, [(FrameFlags.NONE, testPayload)])
+
+    def test_incompressible_frames_are_sent_uncompressed(self):
+        testPayload = os.urandom(1024)
+        self.writer.setCompressor(FrameCompressor(Compressions.ZLIB, 128))
+
+        self.writer.writeFrame(testPayload)
+        self.__sendAll()
+        frames = self.__readFrames(1)
+
+        self.assertEqual(frames, [(FrameFlags.NONE, testPayload)])
+
+    @unittest.skipUnless(Compressions.ZSTD in SUPPORTED_COMPRESSIONS, "zstandard is not installed")
+    def test_zstd_compressed_frames(self):
+        testPayload = b"lorem ipsum dolor sit amet" * 100
+        self.writer.setCompressor(FrameCompressor(Compressions.ZSTD, 128))
+
+        self.writer.writeFrame(testPayload)
+        self.__sendAll()
+        frames = self.__readFrames(1)
+
+        self.assertEqual(frames, [(FrameFlags.COMPRESSED_ZSTD, testPayload)])
+
+    @unittest.skipUnless(Compressions.ZSTD in SUPPORTED_COMPRESSIONS, "zstandard is not installed")
+    def test_zstd_frames_expanding_beyond_the_limit_are_rejected(self):
+        compressed = zstandard.ZstdCompressor().compress(bytes(1 << 20))
+
+        self.assertEqual(len(decompressPayload(compressed, FrameFlags.COMPRESSED_ZSTD, 1 << 20)), 1 << 20)
+        with self.assertRaises(FrameFormatError):
+            decompressPayload(compressed, FrameFlags.COMPRESSED_ZSTD, 1 << 16)
+
+    def test_zlib_frames_expanding_beyond_the_limit_are_rejected(self):
+        compressed = zlib.compress(bytes(1 << 20))
+
+        with self.assertRaises(FrameFormatError):
+            decompressPayload(compressed, FrameFlags.COMPRESSED_ZLIB, 1 << 16)
+
+    def test_unsupported_compression_is_rejected(self):
+        with self.assertRaises(ValueError):
+            FrameCompressor("lzma", 128)
+
+
+
+class TestFrameMultiplexer(unittest.TestCase):
+
+    def setUp(self):
+        self.key = b"sixteen byte key"
+        self.sender, self.receiver = socket.socketpair()
+        encoder = AES.new(self.key, AES.MODE_CFB)
+        decoder = AES.new(self.key, AES.MODE_CFB, iv=encoder.iv)
+        self.writer = FrameWriter(encoder)
+        self.reader = FrameReader(decoder, initialBufferSize=64)
+        self.multiplexer = FrameMultiplexer(bytes, 3, fragmentSize=16)
+
+    def tearDown(self):
+        self.sender.close()
+        self.receiver.close()
+
+    def __transfer(self, expectedCount):
+        while self.writer.sendTo(self.sender) > 0:
+            pass
+        payloads = []
+        while len(payloads) < expectedCount:
+            self.assertGreater(self.reader.readFrom(self.receiver), 0)
+            payloads.extend([bytes(payload) for flags, payload in self.reader.frames()])
+        return payloads
+
+    def test_large_messages_are_split_into_fragments_and_reassembled(self):
+        testPayload = bytes(range(100))
+
+        self.multiplexer.enqueue(2, testPayload)
+        self.multiplexer.fill(self.writer, MAX_FRAME_SIZE)
+
+        self.assertEqual(self.writer.pendingSize(), 7 * FRAME_HEADER.size + len(testPayload))
+        self.assertEqual(self.__transfer(1), [testPayload])
+
+    def test_higher_priority_messages_overtake_a_partially_sent_message(self):
+        bulkPayload = b"b" * 100
+        interactivePayload = b"interactive"
+
+        self.multiplexer.enqueue(2, bulkPayload)
+        self.multiplexer.fill(self.writer, 1)
+        self.multiplexer.enqueue(1, interactivePayload)
+        self.multiplexer.fill(self.writer, MAX_FRAME_SIZE)
+
+        self.assertEqual(self.__transfer(2), [interactivePayload, bulkPayload])
+        self.assertFalse(self.multiplexer.hasPendingData())
+
+    def test_messages_of_the_same_channel_keep_their_order(self):
+        testPayloads = [bytes([index]) * (index * 10) for index in range(1, 6)]
+
+        for payload in testPayloads:
+            self.multiplexer.enqueue(1, payload)
+        self.multiplexer.fill(self.writer, MAX_FRAME_SIZE)
+
+        self.assertEqual(self.__transfer(len(testPayloads)), testPayloads)
+
+    def test_fill_stops_at_the_pending_size_limit(self):
+        self.multiplexer.enqueue(2, b"b" * 100)
+
+        self.multiplexer.fill(self.writer, 32)
+
+        self.assertLess(self.writer.pendingSize(), 32 + FRAME_HEADER.size + 16)
+        self.assertTrue(self.multiplexer.hasPendingData())
+
+    def test_messages_are_reported_written_after_their_last_fragment(self):
+        written = []
+        multiplexer = FrameMultiplexer(bytes, 3, fragmentSize=16, onWritten=written.append)
+        testPayload = b"b" * 40
+
+        multiplexer.enqueue(2, testPayload)
+        multiplexer.fill(self.writer, 1)
+        self.assertEqual(written, [])
+        multiplexer.fill(self.writer, MAX_FRAME_SIZE)
+
+        self.assertEqual(written, [testPayload])
+
+    def test_messages_are_not_fragmented_without_a_fragment_size(self):
+        self.multiplexer.setFragmentSize(None)
+        testPayload = b"a" * 100
+
+        self.multiplexer.enqueue(2, testPayload)
+        self.multiplexer.fill(self.writer, MAX_FRAME_SIZE)
+
+        self.assertEqual(self.writer.pendingSize(), FRAME_HEADER.size + len(testPayload))
+        self.assertEqual(self.__transfer(1), [testPayload])
+
+
+class TestRoundTripTimeEstimator(unittest.TestCase):
+
+    def test_first_sample_is_taken_as_is_and_later_ones_are_smoothed(self):
+        estimator = RoundTripTimeEstimator()
+
+        estimator.addSample(0.8)
+        self.assertEqual(estimator.value, 0.8)
+
+        estimator.addSample(0.0)
+        self.assertAlmostEqual(estimator.value, 0.7)
+        self.assertEqual(estimator.lastSample, 0.0)
+
+
+if __name__ == '__main__':
+    unittest.main()
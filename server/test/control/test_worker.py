@@ -0,0 +1,116 @@
+import unittest
+
+from queue import Queue, Empty
+from unittest.mock import MagicMock
+from uuid import uuid4
+
+from control.message import MessageDispatcher
+from control.worker import LongTaskWorker, FifoScheduler, ShortestJobFirstScheduler, PriorityScheduler
+from model.message import MessageTypes
+from model.task import Task, TaskArchive, TaskPriorities, PendingTaskQueue
+
+
+class TestLongTaskWorker(unittest.TestCase):
+
+    def setUp(self):
+        self.dispatcher = MessageDispatcher()
+        self.originalQueue = self.dispatcher.incoming_task_queue
+        self.dispatcher.incoming_task_queue = Queue()
+        self.taskArchive = TaskArchive()
+        self.worker = LongTaskWorker(MagicMock())
+        self.handledTasks = []
+        handler = MagicMock()
+        handler.setTask.side_effect = self.handledTasks.append
+        self.worker._handlerMap = {MessageTypes.UPLOAD_FILE: handler, MessageTypes.DOWNLOAD_FILE: handler}
+
+    def tearDown(self):
+        self.dispatcher.incoming_task_queue = self.originalQueue
+
+    def __createTask(self, path, taskType=MessageTypes.UPLOAD_FILE):
+        return Task(taskType=taskType, uuid=uuid4().hex, data={"fullPath": path})
+
+    def test_task_of_a_path_in_progress_is_run_by_the_worker_of_that_path(self):
+        path = f"{uuid4().hex}.txt"
+        runningTask, waitingTask = self.__createTask(path), self.__createTask(path, MessageTypes.DOWNLOAD_FILE)
+        self.dispatcher.incoming_task_queue.put(runningTask)
+        self.dispatcher.incoming_task_queue.put(waitingTask)
+        otherWorker = LongTaskWorker(MagicMock())
+        otherWorker._TASK_WAIT_TIMEOUT = 0.01
+
+        self.worker._currentTask = self.worker._getNewTask()
+        with self.assertRaises(Empty):
+            otherWorker._getNewTask()
+        self.worker._work()
+
+        self.assertEqual(self.handledTasks, [runningTask, waitingTask])
+        self.assertTrue(self.taskArchive.startTask(path, runningTask))
+        self.taskArchive.finishTask(path)
+
+    def test_failing_task_does_not_stop_the_worker(self):
+        path = f"{uuid4().hex}.txt"
+        self.worker._handlerMap[MessageTypes.UPLOAD_FILE].handle.side_effect = ValueError("Lorem ipsum")
+        self.dispatcher.incoming_task_queue.put(self.__createTask(path))
+
+        self.worker._currentTask = self.worker._getNewTask()
+        self.worker._work()
+
+        self.assertIsNone(self.worker._currentTask)
+        self.assertTrue(self.taskArchive.startTask(path, self.__createTask(path)))
+        self.taskArchive.finishTask(path)
+
+
+class TestTaskSchedulers(unittest.TestCase):
+
+    def __createTask(self, size, taskType=MessageTypes.UPLOAD_FILE, **extraData):
+        return Task(taskType=taskType, uuid=uuid4().hex, data={"fullPath": uuid4().hex, "size": size, **extraData})
+
+    def __drain(self, queue):
+        tasks = []
+        while not queue.empty():
+            tasks.append(queue.get_nowait())
+            queue.task_done()
+
+        return tasks
+
+    def test_fifo_scheduler_runs_tasks_in_arrival_order(self):
+        queue = PendingTaskQueue(lambda task: task.data["fullPath"], FifoScheduler())
+        tasks = [self.__createTask(size) for size in [4096, 10, 100]]
+        for task in tasks:
+            queue.put(task)
+
+        self.assertEqual(self.__drain(queue), tasks)
+
+    def test_shortest_job_first_scheduler_runs_small_files_first(self):
+        queue = PendingTaskQueue(lambda task: task.data["fullPath"], ShortestJobFirstScheduler(agingRate=1048576))
+        largeTask, smallTask, mediumTask = [self.__createTask(size) for size in [1 << 32, 200, 1 << 20]]
+        for task in [largeTask, smallTask, mediumTask]:
+            queue.put(task)
+
+        self.assertEqual(self.__drain(queue), [smallTask, mediumTask, largeTask])
+
+    def test_waiting_large_file_is_not_starved_by_newer_small_files(self):
+        scheduler = ShortestJobFirstScheduler(agingRate=1048576)
+        largeTask, smallTask = self.__createTask(1 << 20), self.__createTask(200)
+
+        self.assertLess(scheduler.rank(largeTask, 0.0), scheduler.rank(smallTask, 1.5))
+        self.assertGreater(scheduler.rank(largeTask, 0.0), scheduler.rank(smallTask, 0.5))
+
+    def test_priority_scheduler_ranks_by_class_before_size(self):
+        queue = PendingTaskQueue(lambda task: task.data["fullPath"], PriorityScheduler())
+        uploadTask = self.__createTask(200)
+        downloadTask = self.__createTask(1 << 20, MessageTypes.DOWNLOAD_FILE)
+        lowPriorityTask = self.__createTask(10, priority=TaskPriorities.LOW)
+        for task in [lowPriorityTask, uploadTask, downloadTask]:
+            queue.put(task)
+
+        self.assertEqual(self.__drain(queue), [downloadTask, uploadTask, lowPriorityTask])
+
+    def test_invalid_size_and_priority_fall_back_to_defaults(self):
+        scheduler = PriorityScheduler()
+        task = self.__createTask("large", priority=42)
+
+        self.assertEqual(scheduler.rank(task, 10.0), 10.0 + TaskPriorities.NORMAL * PriorityScheduler.DEFAULT_CLASS_DELAY)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -2,9 +2,11 @@ import unittest
 
 import logging
 
+from queue import Empty
 from uuid import uuid4
 
-from model.message import NetworkMessage, MessageTypes, NetworkMessageFormatError
+from model.message import NetworkMessage, MessageTypes, MessageChannels, NetworkMessageFormatError, MessageCodec, MessageEncodings, COMPACT_MESSAGE_VERSION
+from model.task import Task, TaskArchive, PendingTaskQueue
 
 
 logging.disable(logging.CRITICAL)
@@ -62,6 +64,13 @@ class NetworkMessageBuilderSunnyTests(unittest.TestCase):
         self.assertIsNone(message.header.uuid)
         self.assertIsNone(message.data)
 
+    def test_requests_on_files_share_one_channel(self):
+        fileRequestTypes = [MessageTypes.UPLOAD_FILE, MessageTypes.DOWNLOAD_FILE, MessageTypes.MOVE_FILE, MessageTypes.DELETE_FILE, MessageTypes.FILE_TASK_CANCELLED]
+
+        channels = {NetworkMessage.Builder(messageType).withRandomUUID().build().channel for messageType in fileRequestTypes}
+
+        self.assertEqual(channels, {MessageChannels.BULK})
+
 
 class NetworkMessageBuilderRainyTests(unittest.TestCase):
 
@@ -116,3 +125,135 @@ class NetworkMessageRainyTests(unittest.TestCase):
             self.fail(f"NetworkMessageRainyTests.test_invalid_header_data_uuid_wrong_length passed for invalid length 'uuid' key in 'header': '{invalidLengthUUID}'")
         except NetworkMessageFormatError as e:
             self.assertEqual(str(e), f"Invalid header format, key 'uuid' must be of type str with a length of 32. Received length: {len(invalidLengthUUID)}")
+
+
+class MessageCodecTests(unittest.TestCase):
+
+    def setUp(self):
+        self.codec = MessageCodec()
+
+    def test_compact_encoding_round_trip(self):
+        self.codec.encoding = MessageEncodings.COMPACT
+        testFiles = [{"filename": f"file_{index}", "modified": index, "size": 10, "path": "", "fullPath": f"file_{index}"} for index in range(3)]
+        testMessage = NetworkMessage.Builder(MessageTypes.RESPONSE).withRandomUUID().withData({"files": testFiles, "last": True}).build()
+
+        decoded = self.codec.decode(self.codec.encode(testMessage))
+
+        self.assertEqual(decoded.header.messageType, MessageTypes.RESPONSE)
+        self.assertEqual(decoded.header.uuid, testMessage.header.uuid)
+        self.assertEqual(decoded.data, {"files": testFiles, "last": True})
+
+    def test_compact_encoding_sends_keys_of_uniform_records_only_once(self):
+        testFiles = [{"filename": f"file_{index}", "fullPath": f"file_{index}"} for index in range(100)]
+        testMessage = NetworkMessage.Builder(MessageTypes.RESPONSE).withRandomUUID().withData(testFiles).build()
+
+        legacy = self.codec.encode(testMessage)
+        self.codec.encoding = MessageEncodings.COMPACT
+        compact = self.codec.encode(testMessage)
+
+        self.assertEqual(compact.count(b"fullPath"), 1)
+        self.assertLess(len(compact), len(legacy))
+
+    def test_legacy_messages_are_decoded_regardless_of_encoding(self):
+        testMessage = NetworkMessage.Builder(MessageTypes.GET_WORKSPACE).withRandomUUID().build()
+        legacy = self.codec.encode(testMessage)
+        self.codec.encoding = MessageEncodings.COMPACT
+
+        decoded = self.codec.decode(legacy)
+
+        self.assertEqual(decoded.header.messageType, MessageTypes.GET_WORKSPACE)
+        self.assertEqual(decoded.header.uuid, testMessage.header.uuid)
+
+    def test_compact_message_with_unsupported_version_is_rejected(self):
+        with self.assertRaises(NetworkMessageFormatError):
+            NetworkMessage.fromCompact([COMPACT_MESSAGE_VERSION + 1, MessageTypes.RESPONSE, None, None])
+
+    def test_compact_message_with_invalid_uuid_is_rejected(self):
+        with self.assertRaises(NetworkMessageFormatError):
+            NetworkMessage.fromCompact([COMPACT_MESSAGE_VERSION, MessageTypes.RESPONSE, b"short", None])
+
+class TaskArchiveTests(unittest.TestCase):
+
+    def setUp(self):
+        self.archive = TaskArchive()
+        self.archive.clearAllTasks()
+
+    def test_clear_session_tasks_only_cancels_tasks_of_the_given_session(self):
+        ownTask = Task(taskType=MessageTypes.UPLOAD_FILE, uuid=uuid4().hex, sessionID="sessionA")
+        otherTask = Task(taskType=MessageTypes.UPLOAD_FILE, uuid=uuid4().hex, sessionID="sessionB")
+        self.archive.addTask("own.txt", ownTask)
+        self.archive.addTask("other.txt", otherTask)
+
+        self.archive.clearSessionTasks("sessionA")
+
+        self.assertTrue(ownTask.stale)
+        self.assertFalse(otherTask.stale)
+
+    def test_task_of_a_running_path_is_handed_over_to_its_worker(self):
+        path = f"{uuid4().hex}.txt"
+        firstTask = Task(taskType=MessageTypes.UPLOAD_FILE, uuid=uuid4().hex, data={"fullPath": path})
+        secondTask = Task(taskType=MessageTypes.DOWNLOAD_FILE, uuid=uuid4().hex, data={"fullPath": path})
+
+        self.assertTrue(self.archive.startTask(path, firstTask))
+        self.assertFalse(self.archive.startTask(path, secondTask))
+        self.assertIs(self.archive.finishTask(path), secondTask)
+        self.assertIsNone(self.archive.finishTask(path))
+        self.assertTrue(self.archive.startTask(path, firstTask))
+        self.archive.finishTask(path)
+
+    def test_newer_waiting_task_of_a_running_path_supersedes_the_older_one(self):
+        path = f"{uuid4().hex}.txt"
+        runningTask, olderTask, newerTask = [Task(taskType=MessageTypes.UPLOAD_FILE, uuid=uuid4().hex, data={"fullPath": path}) for i in range(3)]
+
+        self.archive.startTask(path, runningTask)
+        self.archive.startTask(path, olderTask)
+        self.archive.startTask(path, newerTask)
+
+        self.assertTrue(olderTask.stale)
+        self.assertIs(self.archive.finishTask(path), newerTask)
+        self.assertIsNone(self.archive.finishTask(path))
+
+    def test_tasks_of_different_paths_run_at_the_same_time(self):
+        firstPath, secondPath = f"{uuid4().hex}.txt", f"{uuid4().hex}.txt"
+
+        self.assertTrue(self.archive.startTask(firstPath, Task(taskType=MessageTypes.UPLOAD_FILE, data={"fullPath": firstPath})))
+        self.assertTrue(self.archive.startTask(secondPath, Task(taskType=MessageTypes.UPLOAD_FILE, data={"fullPath": secondPath})))
+        self.archive.finishTask(firstPath)
+        self.archive.finishTask(secondPath)
+
+
+class PendingTaskQueueTests(unittest.TestCase):
+
+    def setUp(self):
+        self.queue = PendingTaskQueue(lambda task: task.data["fullPath"])
+
+    def __createTask(self, path):
+        return Task(taskType=MessageTypes.UPLOAD_FILE, uuid=uuid4().hex, data={"fullPath": path})
+
+    def test_task_replaces_the_pending_task_of_its_key_in_place(self):
+        firstTask, otherTask, replacingTask = self.__createTask("first.txt"), self.__createTask("other.txt"), self.__createTask("first.txt")
+
+        for task in [firstTask, otherTask, replacingTask]:
+            self.queue.put(task)
+
+        self.assertTrue(firstTask.stale)
+        self.assertEqual(self.queue.qsize(), 2)
+        self.assertIs(self.queue.get_nowait(), replacingTask)
+        self.assertIs(self.queue.get_nowait(), otherTask)
+
+    def test_discarded_task_is_not_returned(self):
+        task = self.__createTask("first.txt")
+        self.queue.put(task)
+
+        self.assertIs(self.queue.discard("first.txt"), task)
+        with self.assertRaises(Empty):
+            self.queue.get(timeout=0.01)
+
+    def test_task_done_can_not_be_called_more_often_than_tasks_were_put(self):
+        self.queue.put(self.__createTask("first.txt"))
+        self.queue.put(self.__createTask("first.txt"))
+        self.queue.get_nowait()
+        self.queue.task_done()
+
+        with self.assertRaises(ValueError):
+            self.queue.task_done()